@@ -0,0 +1,95 @@
+import os
+import sys
+import gc
+import time
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+# Banco SQLite temporário, a menos que BENCHMARK_DATABASE_URL seja informado
+if 'BENCHMARK_DATABASE_URL' in os.environ:
+    os.environ['DATABASE_URL'] = os.environ['BENCHMARK_DATABASE_URL']
+else:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.main import app, db
+from src.models.produto import Produto, SERIALIZADOR_PRODUTO
+
+TAMANHOS_PADRAO = [10000, 100000, 1000000]
+LOTE = 10000
+
+PREFIXO_CODIGO = 'BENCH-'
+
+def produtos_alheios():
+    """Quantidade de produtos que não foram criados pelo benchmark"""
+    return db.session.query(Produto.id).filter(~Produto.codigo.startswith(PREFIXO_CODIGO)).count()
+
+def popular_produtos(total):
+    """Garante exatamente ``total`` produtos na tabela usando inserts em lote (apaga só os
+    produtos do próprio benchmark)"""
+    tabela = Produto.__table__
+    db.session.execute(tabela.delete().where(tabela.c.codigo.startswith(PREFIXO_CODIGO)))
+    agora = datetime.utcnow()
+    for inicio in range(0, total, LOTE):
+        db.session.execute(tabela.insert(), [{
+            'nome': f'Produto {i:07d}',
+            'categoria': f'Categoria {i % 20}',
+            'codigo': f'{PREFIXO_CODIGO}{i:07d}',
+            'estoque': i % 500,
+            'estoque_minimo': 10,
+            'preco': 1.5 + (i % 100),
+            'unidade': 'unidade',
+            'descricao': 'Produto gerado para benchmark',
+            'ativo': True,
+            'data_criacao': agora,
+            'data_atualizacao': agora
+        } for i in range(inicio, min(inicio + LOTE, total))])
+    db.session.commit()
+
+def caminho_orm():
+    produtos = Produto.query.filter_by(ativo=True).all()
+    return [produto.to_dict() for produto in produtos]
+
+def caminho_core():
+    rows = db.session.execute(SERIALIZADOR_PRODUTO.select().where(Produto.ativo == True))
+    return SERIALIZADOR_PRODUTO.lista(rows)
+
+def medir(funcao):
+    """Retorna (linhas por segundo, pico de memória em MB) de uma execução da função"""
+    db.session.remove()
+    gc.collect()
+    inicio = time.perf_counter()
+    linhas = len(funcao())
+    duracao = time.perf_counter() - inicio
+
+    # Memória medida numa segunda execução: o tracemalloc distorce o tempo
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    funcao()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.session.remove()
+
+    return linhas / duracao, pico / (1024 * 1024)
+
+def main():
+    tamanhos = [int(arg) for arg in sys.argv[1:]] or TAMANHOS_PADRAO
+    with app.app_context():
+        # Os caminhos medidos leem a tabela inteira: só roda num banco sem outros produtos
+        alheios = produtos_alheios()
+        if alheios:
+            print(f'❌ O banco de BENCHMARK_DATABASE_URL tem {alheios} produtos que não são do benchmark; '
+                  'use um banco vazio')
+            sys.exit(2)
+        print(f"{'linhas':>10} {'caminho':>8} {'linhas/s':>12} {'pico MB':>10}")
+        for total in tamanhos:
+            popular_produtos(total)
+            for nome, funcao in [('to_dict', caminho_orm), ('core', caminho_core)]:
+                linhas_por_segundo, pico = medir(funcao)
+                print(f'{total:>10} {nome:>8} {linhas_por_segundo:>12,.0f} {pico:>10.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -29,12 +29,61 @@ db.init_app(app)
 
 # Import all models to ensure they are registered
 from src.models.obra import Obra, Etapa, Mobiliario, Lixeira
-from src.models.produto import Produto, MovimentacaoEstoque, Categoria
-from src.models.sistema import HistoricoAcesso, ConfiguracaoSistema, Feed, ComentarioFeed
+from src.models.produto import Produto, MovimentacaoEstoque, Categoria, ResumoEstoqueCategoria, SnapshotEstoque, ConsumoMensal, garantir_resumo_estoque, garantir_consumo_mensal
+from src.models.produto import SNAPSHOT_INTERVALO_HORAS, manter_snapshots_estoque, DeltaResumoEstoque
+from src.models.produto import RESUMO_CONSOLIDACAO_SEGUNDOS, manter_resumo_estoque
+from src.models.busca import configurar_busca
+from src.models.importacao import ImportacaoPlanilha, IMPORTACAO_INTERVALO_SEGUNDOS, processar_importacoes_pendentes
+from src.models.importacao import IMPORTACAO_LIMPEZA_SEGUNDOS, limpar_importacoes_antigas
+from src.models.sistema import HistoricoAcesso, ConfiguracaoSistema, Feed, ComentarioFeed, GeracaoColecao, ChaveIdempotencia, garantir_geracoes
+from src.models.sistema import IncrementoGeracao, GERACOES_CONSOLIDACAO_SEGUNDOS, manter_geracoes
+from src.utils.migracoes import indices_ausentes, adicionar_colunas_ausentes
+from src.utils.tarefas import iniciar_tarefa_periodica
+from src.utils.particionamento import manter_particoes
 
 with app.app_context():
 
     db.create_all()
+    # Colunas novas em tabelas existentes (ex.: movimentacoes_estoque.obra_id)
+    adicionar_colunas_ausentes(db.engine)
+    garantir_geracoes()
+    garantir_resumo_estoque()
+    garantir_consumo_mensal()
+    app.config["BUSCA_INDEXADA"] = configurar_busca()
+
+    # create_all() não adiciona índices novos a tabelas que já existem
+    ausentes = indices_ausentes(db.engine)
+    if ausentes:
+        print(f"[AVISO] Índices ausentes: {', '.join(index.name for index in ausentes)}. "
+              "Execute: python src/manutencao.py indices")
+
+# Snapshots periódicos de estoque para GET /api/produtos/estoque?em= (SNAPSHOT_INTERVALO_HORAS=0
+# desativa a thread; use então "python src/manutencao.py snapshot" num agendador externo)
+if SNAPSHOT_INTERVALO_HORAS > 0:
+    iniciar_tarefa_periodica(app, "snapshots-estoque", min(SNAPSHOT_INTERVALO_HORAS * 3600, 600), manter_snapshots_estoque)
+
+# Deltas do resumo de estoque somados à tabela de resumo (RESUMO_CONSOLIDACAO_SEGUNDOS=0
+# desativa a thread; use então "python src/manutencao.py resumo")
+if RESUMO_CONSOLIDACAO_SEGUNDOS > 0:
+    iniciar_tarefa_periodica(app, "resumo-estoque", RESUMO_CONSOLIDACAO_SEGUNDOS, manter_resumo_estoque)
+
+# Incrementos de geração somados à tabela de gerações (GERACOES_CONSOLIDACAO_SEGUNDOS=0
+# desativa a thread neste processo)
+if GERACOES_CONSOLIDACAO_SEGUNDOS > 0:
+    iniciar_tarefa_periodica(app, "geracoes-colecao", GERACOES_CONSOLIDACAO_SEGUNDOS, manter_geracoes)
+
+# Importações de planilha enviadas com Prefer: respond-async; cada worker reivindica as
+# pendentes (IMPORTACAO_INTERVALO_SEGUNDOS=0 desativa a thread neste processo). A limpeza das
+# abandonadas e antigas roda a cada IMPORTACAO_LIMPEZA_SEGUNDOS
+if IMPORTACAO_INTERVALO_SEGUNDOS > 0:
+    iniciar_tarefa_periodica(app, "importacoes-planilha", IMPORTACAO_INTERVALO_SEGUNDOS, processar_importacoes_pendentes)
+if IMPORTACAO_LIMPEZA_SEGUNDOS > 0:
+    iniciar_tarefa_periodica(app, "importacoes-limpeza", IMPORTACAO_LIMPEZA_SEGUNDOS, limpar_importacoes_antigas)
+
+# Partições futuras de movimentacoes_estoque, quando a tabela foi particionada
+# ("python src/manutencao.py particionar"); só no Postgres
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+    iniciar_tarefa_periodica(app, "particoes-movimentacoes", 6 * 3600, manter_particoes)
 
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
@@ -0,0 +1,222 @@
+import os
+import sys
+import argparse
+from datetime import date
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import func
+from src.main import app, db
+from src.utils.migracoes import criar_indices_ausentes, indices_ausentes, relatorio_planos
+from src.utils.idempotencia import limpar_chaves_expiradas
+from src.models.produto import MovimentacaoEstoque, consolidar_resumo, manter_snapshots_estoque, recalcular_consumo, recalcular_resumo
+from src.models.obra import atribuir_obras_movimentacoes
+from src.models.importacao import limpar_importacoes_antigas, processar_importacoes_pendentes
+from src.utils.importacao import importar_movimentacoes
+from src.utils.planilha import Planilha
+from src.models.sistema import marcar_tabelas_alteradas
+from src.utils.particionamento import (
+    ARQUIVO_DIRETORIO, arquivar_particoes, criar_particoes_futuras, particionar_movimentacoes, tabela_particionada
+)
+
+# Tarefas de manutenção executadas fora do servidor web:
+#   python src/manutencao.py indices [--sem-concorrencia] [--apenas-relatorio]
+#   python src/manutencao.py limpar-idempotencia
+#   python src/manutencao.py snapshot [--forcar]
+#   python src/manutencao.py consumo [--produto ID ...]
+#   python src/manutencao.py resumo [--recalcular]
+#   python src/manutencao.py atribuir-obras
+#   python src/manutencao.py importar-movimentacoes ARQUIVO [--usuario NOME] [--motivo TEXTO]
+#   python src/manutencao.py importacoes-planilha
+#   python src/manutencao.py particionar [--meses-futuros N]
+#   python src/manutencao.py arquivar --retencao-meses N [--diretorio DIR]
+
+def imprimir_relatorio(relatorio):
+    for titulo, linhas in relatorio.items():
+        print(f'  {titulo}')
+        for linha in linhas:
+            print(f'    {linha}')
+
+def comando_indices(args):
+    """Cria os índices declarados nos models que faltam em um banco já existente"""
+    with app.app_context():
+        engine = db.engine
+        ausentes = indices_ausentes(engine)
+        if not ausentes:
+            print('✅ Todos os índices já existem')
+        else:
+            print(f'Índices ausentes: {", ".join(index.name for index in ausentes)}')
+
+        print('📋 Planos de execução antes:')
+        imprimir_relatorio(relatorio_planos(engine))
+        if args.apenas_relatorio or not ausentes:
+            return
+
+        criados = criar_indices_ausentes(engine, concorrente=not args.sem_concorrencia)
+        print(f'✅ {len(criados)} índice(s) criado(s)')
+        print('📋 Planos de execução depois:')
+        imprimir_relatorio(relatorio_planos(engine))
+
+def comando_limpar_idempotencia(args):
+    """Apaga as Idempotency-Keys expiradas"""
+    with app.app_context():
+        removidas = limpar_chaves_expiradas()
+        print(f'✅ {removidas} chave(s) expirada(s) removida(s)')
+
+def comando_snapshot(args):
+    """Grava um lote de snapshot de estoque (se o último estiver vencido ou com --forcar)"""
+    with app.app_context():
+        momento = manter_snapshots_estoque(forcar=args.forcar)
+        if momento is None:
+            print('Último snapshot ainda recente; nada a fazer (use --forcar)')
+        else:
+            print(f'✅ Snapshot de estoque gravado em {momento.isoformat()}')
+
+def comando_importacoes_planilha(args):
+    """Processa as importações de planilha pendentes (workers com IMPORTACAO_INTERVALO_SEGUNDOS=0)"""
+    with app.app_context():
+        processadas = processar_importacoes_pendentes()
+        removidas = limpar_importacoes_antigas()
+        print(f'✅ {processadas} importações de planilha processadas, {removidas} antigas removidas')
+
+def comando_consumo(args):
+    """Reconstrói o consumo mensal a partir do ledger (backfill). Os meses anteriores à
+    movimentação mais antiga do ledger (partições arquivadas) não têm mais as movimentações
+    de origem e são preservados."""
+    with app.app_context():
+        mais_antiga = db.session.query(func.min(MovimentacaoEstoque.data_movimentacao)).scalar()
+        desde = date(mais_antiga.year, mais_antiga.month, 1) if mais_antiga else None
+        recalcular_consumo(db.session.connection(), args.produto, desde)
+        marcar_tabelas_alteradas(db.session, 'consumo_mensal')
+        db.session.commit()
+        alvo = f'{len(args.produto)} produto(s)' if args.produto else 'todos os produtos'
+        print(f'✅ Consumo mensal recalculado para {alvo}')
+
+def comando_resumo(args):
+    """Consolida os deltas pendentes do resumo de estoque (ou o reconstrói a partir dos produtos)"""
+    with app.app_context():
+        if args.recalcular:
+            recalcular_resumo(db.session.connection())
+            marcar_tabelas_alteradas(db.session, 'produtos')
+            db.session.commit()
+            print('✅ Resumo de estoque reconstruído')
+        else:
+            consolidados = consolidar_resumo(db.session.connection())
+            db.session.commit()
+            print(f'✅ {consolidados} deltas do resumo consolidados')
+
+def comando_atribuir_obras(args):
+    """Preenche obra_id das dispensações antigas a partir do local de uso no motivo"""
+    with app.app_context():
+        atualizadas, sem_obra = atribuir_obras_movimentacoes(db.session.connection())
+        if atualizadas:
+            marcar_tabelas_alteradas(db.session, 'movimentacoes_estoque')
+        db.session.commit()
+        print(f'✅ {atualizadas} dispensação(ões) atribuída(s) a obras')
+        if sem_obra:
+            print(f'Locais sem obra correspondente ({len(sem_obra)}):')
+            for local in sem_obra:
+                print(f'  {local}')
+
+def comando_importar_movimentacoes(args):
+    """Importa em massa o histórico de movimentações de uma planilha CSV ou Excel"""
+    with app.app_context():
+        with open(args.arquivo, 'rb') as arquivo, Planilha(arquivo, args.arquivo) as planilha:
+            resultado = importar_movimentacoes(db.session, planilha, args.motivo, args.usuario)
+        if resultado['erros']:
+            db.session.rollback()
+            print(f'❌ {len(resultado["erros"])} linha(s) com erro; nada foi importado')
+            for erro in resultado['erros'][:50]:
+                print(f'  linha {erro["linha"]}: {"; ".join(erro["erros"])}')
+            sys.exit(1)
+        if not resultado['importadas']:
+            print('Nenhuma movimentação na planilha')
+            return
+        db.session.commit()
+        print(f'✅ {resultado["importadas"]} movimentação(ões) importada(s) para {resultado["produtos"]} produto(s) '
+              f'({resultado["inicio"]:%Y-%m-%d} a {resultado["fim"]:%Y-%m-%d})')
+        if resultado['estoqueNegativo']:
+            print(f'[AVISO] {resultado["estoqueNegativo"]} produto(s) com estoque negativo em algum ponto do histórico')
+
+def _exigir_postgres():
+    if db.engine.dialect.name != 'postgresql':
+        print('❌ Particionamento disponível apenas no Postgres')
+        sys.exit(1)
+
+def comando_particionar(args):
+    """Converte movimentacoes_estoque em tabela particionada por mês (ou cria as partições futuras)"""
+    with app.app_context():
+        _exigir_postgres()
+        connection = db.session.connection()
+        if tabela_particionada(connection):
+            criadas = criar_particoes_futuras(connection, args.meses_futuros)
+            db.session.commit()
+            print(f'Tabela já particionada; {len(criadas)} partição(ões) futura(s) criada(s)')
+            return
+        particoes = particionar_movimentacoes(connection, args.meses_futuros)
+        db.session.commit()
+        print(f'✅ movimentacoes_estoque particionada em {len(particoes)} partições mensais')
+
+def comando_arquivar(args):
+    """Arquiva em .csv.gz e remove as partições mais antigas que a retenção"""
+    with app.app_context():
+        _exigir_postgres()
+        with db.engine.connect() as connection:
+            if not tabela_particionada(connection):
+                print('❌ movimentacoes_estoque não está particionada (execute "particionar" antes)')
+                sys.exit(1)
+        arquivos = arquivar_particoes(db.engine, args.retencao_meses, args.diretorio)
+        print(f'✅ {len(arquivos)} partição(ões) arquivada(s)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tarefas de manutenção do banco de dados')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    indices = subparsers.add_parser('indices', help='Cria os índices ausentes (CONCURRENTLY no Postgres)')
+    indices.add_argument('--sem-concorrencia', action='store_true',
+                         help='Usa CREATE INDEX comum no Postgres (bloqueia escritas na tabela)')
+    indices.add_argument('--apenas-relatorio', action='store_true',
+                         help='Apenas lista os índices ausentes e os planos atuais')
+    indices.set_defaults(funcao=comando_indices)
+
+    limpar = subparsers.add_parser('limpar-idempotencia', help='Remove Idempotency-Keys expiradas')
+    limpar.set_defaults(funcao=comando_limpar_idempotencia)
+
+    snapshot = subparsers.add_parser('snapshot', help='Grava um snapshot do estoque de todos os produtos')
+    snapshot.add_argument('--forcar', action='store_true', help='Grava mesmo que o último snapshot seja recente')
+    snapshot.set_defaults(funcao=comando_snapshot)
+
+    consumo = subparsers.add_parser('consumo', help='Recalcula o consumo mensal a partir das movimentações (preserva os meses arquivados)')
+    consumo.add_argument('--produto', type=int, action='append', help='Recalcula apenas este produto (pode repetir)')
+    consumo.set_defaults(funcao=comando_consumo)
+
+    resumo = subparsers.add_parser('resumo', help='Consolida os deltas pendentes do resumo de estoque')
+    resumo.add_argument('--recalcular', action='store_true',
+                        help='Reconstrói o resumo a partir dos produtos (com o sistema parado)')
+    resumo.set_defaults(funcao=comando_resumo)
+
+    atribuir = subparsers.add_parser('atribuir-obras', help='Atribui as dispensações antigas às obras pelo motivo')
+    atribuir.set_defaults(funcao=comando_atribuir_obras)
+
+    importar = subparsers.add_parser('importar-movimentacoes', help='Importa histórico de movimentações de uma planilha')
+    importar.add_argument('arquivo', help='Arquivo .csv ou .xlsx')
+    importar.add_argument('--usuario', default='Sistema', help='Usuário das linhas sem a coluna usuario')
+    importar.add_argument('--motivo', default='Importação de histórico', help='Motivo das linhas sem a coluna motivo')
+    importar.set_defaults(funcao=comando_importar_movimentacoes)
+
+    importacoes = subparsers.add_parser('importacoes-planilha', help='Processa as importações de planilha pendentes')
+    importacoes.set_defaults(funcao=comando_importacoes_planilha)
+
+    particionar = subparsers.add_parser('particionar', help='Particiona movimentacoes_estoque por mês (Postgres)')
+    particionar.add_argument('--meses-futuros', type=int, default=3, help='Partições a criar além do mês atual')
+    particionar.set_defaults(funcao=comando_particionar)
+
+    arquivar = subparsers.add_parser('arquivar', help='Arquiva e remove partições antigas de movimentacoes_estoque')
+    arquivar.add_argument('--retencao-meses', type=int, required=True, help='Meses completos mantidos no banco')
+    arquivar.add_argument('--diretorio', default=ARQUIVO_DIRETORIO, help='Destino dos arquivos .csv.gz')
+    arquivar.set_defaults(funcao=comando_arquivar)
+
+    args = parser.parse_args(argv)
+    args.funcao(args)
+
+if __name__ == '__main__':
+    main()
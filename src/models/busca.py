@@ -0,0 +1,130 @@
+import re
+from sqlalchemy import text
+from src.models.user import db
+
+# Busca textual de produtos por nome, código e descrição.
+# SQLite: tabela FTS5 de conteúdo externo mantida por triggers, sem acentos (remove_diacritics).
+# Postgres: tsvector em português + trigramas (pg_trgm) sobre o texto sem acentos (unaccent),
+# ambos com índices GIN de expressão.
+
+# Expressões usadas tanto nos índices quanto nas consultas (precisam ser idênticas)
+PG_VETOR = (
+    "setweight(to_tsvector('portuguese', produtos_unaccent(coalesce(nome, ''))), 'A') || "
+    "setweight(to_tsvector('simple', produtos_unaccent(coalesce(codigo, ''))), 'A') || "
+    "setweight(to_tsvector('portuguese', produtos_unaccent(coalesce(descricao, ''))), 'C')"
+)
+PG_TRIGRAMA = "produtos_unaccent(lower(coalesce(nome, '') || ' ' || coalesce(codigo, '')))"
+
+PG_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # unaccent() não é IMMUTABLE, então não pode ser usada diretamente em índices
+    """CREATE OR REPLACE FUNCTION produtos_unaccent(text) RETURNS text
+       LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+       AS $$ SELECT public.unaccent('public.unaccent', $1) $$""",
+    f"CREATE INDEX IF NOT EXISTS ix_produtos_busca_vetor ON produtos USING gin (({PG_VETOR}))",
+    f"CREATE INDEX IF NOT EXISTS ix_produtos_busca_trigrama ON produtos USING gin (({PG_TRIGRAMA}) gin_trgm_ops)"
+]
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS produtos_fts USING fts5(
+           nome, codigo, descricao,
+           content='produtos', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS produtos_fts_ai AFTER INSERT ON produtos BEGIN
+           INSERT INTO produtos_fts(rowid, nome, codigo, descricao)
+           VALUES (new.id, new.nome, new.codigo, new.descricao);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS produtos_fts_ad AFTER DELETE ON produtos BEGIN
+           INSERT INTO produtos_fts(produtos_fts, rowid, nome, codigo, descricao)
+           VALUES ('delete', old.id, old.nome, old.codigo, old.descricao);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS produtos_fts_au AFTER UPDATE OF nome, codigo, descricao ON produtos BEGIN
+           INSERT INTO produtos_fts(produtos_fts, rowid, nome, codigo, descricao)
+           VALUES ('delete', old.id, old.nome, old.codigo, old.descricao);
+           INSERT INTO produtos_fts(rowid, nome, codigo, descricao)
+           VALUES (new.id, new.nome, new.codigo, new.descricao);
+       END"""
+]
+
+COLUNAS_RESULTADO = 'p.id, p.nome, p.codigo, p.categoria, p.estoque, p.unidade, p.preco'
+
+def configurar_busca():
+    """Cria (se necessário) a estrutura de busca textual do banco em uso. Retorna False quando
+    o banco não suporta a busca indexada e a consulta deve usar o fallback com LIKE."""
+    dialeto = db.engine.dialect.name
+    try:
+        if dialeto == 'sqlite':
+            # Os triggers somem quando a tabela produtos é recriada (drop_all/create_all)
+            indexado = db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'produtos_fts_ai'"
+            )).first() is not None
+            for ddl in SQLITE_DDL:
+                db.session.execute(text(ddl))
+            if not indexado:
+                # Indexar os produtos que já existiam antes dos triggers
+                db.session.execute(text("INSERT INTO produtos_fts(produtos_fts) VALUES ('rebuild')"))
+        elif dialeto == 'postgresql':
+            for ddl in PG_DDL:
+                db.session.execute(text(ddl))
+        else:
+            return False
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f'[AVISO] Busca indexada indisponível ({dialeto}): {e}')
+        return False
+
+def _termos(q):
+    # Apenas letras e números: evita injeção de operadores na sintaxe do FTS5 e do tsquery
+    return [termo for termo in re.split(r'[\W_]+', q.lower()) if termo]
+
+def buscar_produtos(q, limite, indexada=True):
+    """Produtos ativos que casam com todos os termos de ``q`` (como prefixo, para a busca
+    funcionar enquanto se digita), ordenados por relevância. Retorna linhas com as colunas de COLUNAS_RESULTADO e ``rank``."""
+    termos = _termos(q)
+    if not termos:
+        return []
+    dialeto = db.engine.dialect.name
+
+    if indexada and dialeto == 'sqlite':
+        match = ' AND '.join(f'"{termo}"*' for termo in termos)
+        return db.session.execute(text(f"""
+            SELECT {COLUNAS_RESULTADO}, -bm25(produtos_fts, 10.0, 8.0, 1.0) AS rank
+            FROM produtos_fts JOIN produtos p ON p.id = produtos_fts.rowid
+            WHERE produtos_fts MATCH :match AND p.ativo = 1
+            ORDER BY bm25(produtos_fts, 10.0, 8.0, 1.0)
+            LIMIT :limite
+        """), {'match': match, 'limite': limite}).all()
+
+    if indexada and dialeto == 'postgresql':
+        tsquery = ' & '.join(f'{termo}:*' for termo in termos)
+        texto = ' '.join(termos)
+        return db.session.execute(text(f"""
+            SELECT {COLUNAS_RESULTADO},
+                   ts_rank({PG_VETOR}, consulta) + similarity({PG_TRIGRAMA}, produtos_unaccent(:texto)) AS rank
+            FROM produtos p, to_tsquery('portuguese', produtos_unaccent(:tsquery)) consulta
+            WHERE p.ativo
+              AND ({PG_VETOR} @@ consulta
+                   OR {PG_TRIGRAMA} LIKE '%' || produtos_unaccent(:texto) || '%'
+                   OR {PG_TRIGRAMA} % produtos_unaccent(:texto))
+            ORDER BY rank DESC, p.nome
+            LIMIT :limite
+        """), {'tsquery': tsquery, 'texto': texto, 'limite': limite}).all()
+
+    # Fallback sem índice textual: LIKE em nome, código e descrição
+    filtros = ' AND '.join(
+        f"(lower(p.nome) LIKE :t{i} OR lower(p.codigo) LIKE :t{i} OR lower(coalesce(p.descricao, '')) LIKE :t{i})"
+        for i in range(len(termos))
+    )
+    parametros = {f't{i}': f'%{termo}%' for i, termo in enumerate(termos)}
+    parametros['limite'] = limite
+    return db.session.execute(text(f"""
+        SELECT {COLUNAS_RESULTADO}, 0 AS rank
+        FROM produtos p
+        WHERE p.ativo = :ativo AND {filtros}
+        ORDER BY p.nome
+        LIMIT :limite
+    """), {**parametros, 'ativo': True}).all()
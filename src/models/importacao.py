@@ -0,0 +1,422 @@
+import io
+import os
+import json
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select, update
+from src.models.user import db
+from src.utils.importacao import (
+    ACOES_PREVIA, COLUNAS_OBRIGATORIAS_PRODUTO, classificar_produtos, gravar_produtos, produtos_alterados,
+    validar_planilha_produtos
+)
+from src.utils.planilha import Planilha
+
+# Importações de planilha em segundo plano. O upload grava o arquivo e as opções numa linha
+# de importacoes_planilha e responde 202; a tarefa periódica de cada worker reivindica as
+# importações pendentes com um UPDATE atômico (só um processo consegue), processa o arquivo
+# e registra progresso e relatório final na mesma linha. Como o arquivo fica no banco,
+# qualquer processo (ou servidor) pode processar a importação.
+#
+# Uma prévia (preview=true) valida e classifica as linhas sem gravar e guarda as linhas
+# validadas em ``dados`` com status 'previa'; o id funciona como token para confirmar a
+# gravação depois, sem ler o arquivo de novo.
+#
+# Em lotes (chunkSize=N), cada N linhas validadas são gravadas e confirmadas com um
+# checkpoint; uma importação interrompida ou com erro continua do último checkpoint.
+
+IMPORTACAO_INTERVALO_SEGUNDOS = float(os.environ.get('IMPORTACAO_INTERVALO_SEGUNDOS', '2'))
+# Sem sinal de vida por esse tempo, a importação em processamento é considerada abandonada
+# (worker reiniciado ou morto) e volta a ser reivindicável
+IMPORTACAO_TIMEOUT_SEGUNDOS = int(os.environ.get('IMPORTACAO_TIMEOUT_SEGUNDOS', '600'))
+IMPORTACAO_MAX_TENTATIVAS = 3
+IMPORTACAO_RETENCAO_DIAS = int(os.environ.get('IMPORTACAO_RETENCAO_DIAS', '7'))
+IMPORTACAO_PREVIA_HORAS = int(os.environ.get('IMPORTACAO_PREVIA_HORAS', '24'))
+# Intervalo da limpeza (abandonadas e antigas); a consulta da fila não escreve no banco
+IMPORTACAO_LIMPEZA_SEGUNDOS = float(os.environ.get('IMPORTACAO_LIMPEZA_SEGUNDOS', '3600'))
+LOTE_PROGRESSO = 5000
+
+
+class ImportacaoReivindicada(Exception):
+    """Outro worker reivindicou a importação (sinal de vida vencido) durante a gravação"""
+
+
+class PreviaDesatualizada(ValueError):
+    """Produtos da prévia alterados depois dela: a importação não pode ser retomada"""
+
+
+class ImportacaoPlanilha(db.Model):
+    __tablename__ = 'importacoes_planilha'
+
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    status = db.Column(db.String(20), nullable=False, default='pendente')  # 'pendente', 'processando', 'previa', 'concluida', 'erro'
+    nome_arquivo = db.Column(db.String(300), nullable=False)
+    arquivo = db.Column(db.LargeBinary)  # Conteúdo enviado; removido ao terminar
+    opcoes = db.Column(db.Text)  # JSON com as opções do upload
+    dados = db.Column(db.Text)  # JSON da prévia: linhas validadas, avisos e estado dos produtos
+    linhas_lidas = db.Column(db.Integer, default=0)
+    linhas_validas = db.Column(db.Integer, default=0)
+    linhas_gravadas = db.Column(db.Integer, default=0)
+    checkpoint = db.Column(db.Integer)  # Em lotes: linhas validadas já gravadas (próxima a gravar)
+    produtos_criados = db.Column(db.Integer, default=0)  # Em lotes: totais dos lotes já gravados
+    produtos_atualizados = db.Column(db.Integer, default=0)
+    resultado = db.Column(db.Text)  # JSON: created, updated, warnings, errors (ou a prévia)
+    erro = db.Column(db.Text)
+    worker = db.Column(db.String(200))
+    tentativas = db.Column(db.Integer, nullable=False, default=0)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    data_inicio = db.Column(db.DateTime)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow)  # Também o sinal de vida do worker
+    data_fim = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Fila: pendentes e em processamento, por ordem de chegada
+        db.Index('ix_importacoes_planilha_status', status, data_criacao),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'nomeArquivo': self.nome_arquivo,
+            'opcoes': json.loads(self.opcoes) if self.opcoes else {},
+            'progresso': {
+                'linhasLidas': self.linhas_lidas or 0,
+                'linhasValidas': self.linhas_validas or 0,
+                'linhasGravadas': self.linhas_gravadas or 0,
+                'produtosCriados': self.produtos_criados or 0,
+                'produtosAtualizados': self.produtos_atualizados or 0
+            },
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'erro': self.erro,
+            'checkpoint': self.checkpoint,
+            'tentativas': self.tentativas,
+            'dataCriacao': self.data_criacao.isoformat() if self.data_criacao else None,
+            'dataInicio': self.data_inicio.isoformat() if self.data_inicio else None,
+            'dataAtualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None,
+            'dataFim': self.data_fim.isoformat() if self.data_fim else None,
+            'expiraEm': self.expira_em().isoformat() if self.status == 'previa' else None
+        }
+
+    def expira_em(self):
+        """Fim da validade da prévia"""
+        return (self.data_fim or self.data_criacao) + timedelta(hours=IMPORTACAO_PREVIA_HORAS)
+
+
+def criar_importacao(nome_arquivo, conteudo, opcoes, processar_agora=False):
+    """Registra uma importação (sem commit) e a retorna: pendente para o worker ou, com
+    ``processar_agora``, já reivindicada pelo processo atual"""
+    importacao = ImportacaoPlanilha(nome_arquivo=nome_arquivo, arquivo=conteudo, opcoes=json.dumps(opcoes))
+    if processar_agora:
+        importacao.status = 'processando'
+        importacao.worker = _identificacao_worker()
+        importacao.tentativas = 1
+        importacao.data_inicio = datetime.utcnow()
+    db.session.add(importacao)
+    return importacao
+
+
+def montar_previa(connection, validas, erros, avisos, atualizar_existentes=False):
+    """Classifica as linhas lidas. Retorna (prévia para a resposta, dados para confirmar a
+    gravação depois — None quando há erros, pois a planilha seria rejeitada)."""
+    linhas, estado = classificar_produtos(connection, validas, erros, atualizar_existentes)
+    resumo = dict.fromkeys(ACOES_PREVIA, 0)
+    for linha in linhas:
+        resumo[linha['action']] += 1
+    previa = {'summary': resumo, 'rows': linhas, 'warnings': avisos}
+    dados = None if erros else {'linhas': validas, 'avisos': avisos, 'estado': estado}
+    return previa, dados
+
+
+def criar_previa(nome_arquivo, opcoes, previa, dados, lidas):
+    """Registra a prévia pronta para confirmação (sem commit) e a retorna"""
+    agora = datetime.utcnow()
+    importacao = ImportacaoPlanilha(
+        nome_arquivo=nome_arquivo, status='previa', opcoes=json.dumps(opcoes), dados=json.dumps(dados),
+        resultado=json.dumps(previa), linhas_lidas=lidas, linhas_validas=len(dados['linhas']),
+        data_inicio=agora, data_fim=agora
+    )
+    db.session.add(importacao)
+    return importacao
+
+
+def confirmar_previa(importacao_id):
+    """Troca o status da prévia para 'processando' na transação da sessão. Só uma confirmação
+    consegue: as demais (ou uma prévia já gravada) retornam False."""
+    tabela = ImportacaoPlanilha.__table__
+    return db.session.execute(
+        update(tabela)
+        .where(tabela.c.id == importacao_id, tabela.c.status == 'previa')
+        .values(status='processando', worker=_identificacao_worker(), data_inicio=datetime.utcnow(),
+                data_atualizacao=datetime.utcnow())
+    ).rowcount == 1
+
+
+def gravar_importacao(importacao_id, validas, avisos, opcoes, estado=None, progresso=None, worker=None):
+    """Grava as linhas validadas e marca a importação como concluída na transação da sessão
+    (sem commit). Com ``estado`` (prévia), recusa a gravação se algum produto mudou desde a
+    prévia. Com ``worker``, a conclusão só é registrada se a importação ainda pertence a ele
+    (senão levanta ImportacaoReivindicada). Retorna o relatório (created, updated, warnings, errors)."""
+    if estado is not None:
+        alterados = produtos_alterados(db.session.connection(), estado)
+        if alterados:
+            raise PreviaDesatualizada(f'Produtos alterados desde a prévia: {", ".join(alterados[:20])}. Gere uma nova prévia')
+    criados, atualizados = gravar_produtos(
+        db.session, validas, opcoes.get('updateExisting', False), progresso=progresso
+    )
+    resultado = {'created': criados, 'updated': atualizados, 'warnings': avisos, 'errors': []}
+    if not _registrar(importacao_id, db.session.connection(), worker=worker, status='concluida', arquivo=None,
+                      dados=None, data_fim=datetime.utcnow(), linhas_gravadas=criados + atualizados,
+                      resultado=json.dumps(resultado)):
+        raise ImportacaoReivindicada(importacao_id)
+    return resultado
+
+
+def _identificacao_worker():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def reivindicar_importacao(worker):
+    """Marca a importação pendente (ou abandonada) mais antiga como em processamento por
+    ``worker`` e retorna seu id, ou None. A condição é repetida no UPDATE: se outro processo
+    reivindicar a mesma linha primeiro, este UPDATE não altera nada."""
+    tabela = ImportacaoPlanilha.__table__
+    agora = datetime.utcnow()
+    disponivel = or_(
+        tabela.c.status == 'pendente',
+        (tabela.c.status == 'processando')
+        & (tabela.c.data_atualizacao < agora - timedelta(seconds=IMPORTACAO_TIMEOUT_SEGUNDOS))
+        & (tabela.c.tentativas < IMPORTACAO_MAX_TENTATIVAS)
+    )
+    candidata = db.session.execute(
+        select(tabela.c.id).where(disponivel).order_by(tabela.c.data_criacao).limit(1)
+    ).scalar()
+    if candidata is None:
+        db.session.rollback()
+        return None
+    reivindicada = db.session.execute(
+        update(tabela)
+        .where(tabela.c.id == candidata, disponivel)
+        .values(status='processando', worker=worker, tentativas=tabela.c.tentativas + 1,
+                data_inicio=agora, data_atualizacao=agora)
+    ).rowcount
+    db.session.commit()
+    return candidata if reivindicada else None
+
+
+def _registrar(importacao_id, connection=None, worker=None, **valores):
+    """Atualiza a linha da importação (e o sinal de vida). Sem ``connection``, numa transação
+    própria e curta, visível para quem consulta o progresso enquanto a importação ainda está
+    aberta. Com ``worker``, só se a importação ainda pertence a ele. Retorna se a linha foi
+    atualizada."""
+    tabela = ImportacaoPlanilha.__table__
+    valores['data_atualizacao'] = datetime.utcnow()
+    stmt = update(tabela).where(tabela.c.id == importacao_id).values(**valores)
+    if worker is not None:
+        stmt = stmt.where(tabela.c.worker == worker)
+    if connection is not None:
+        return connection.execute(stmt).rowcount == 1
+    with db.engine.begin() as conexao_progresso:
+        return conexao_progresso.execute(stmt).rowcount == 1
+
+
+def gravar_em_lotes(importacao_id, dados, opcoes, checkpoint, criados=0, atualizados=0):
+    """Grava as linhas validadas a partir de ``checkpoint`` em transações de ``chunkSize``
+    linhas. Cada lote grava o novo checkpoint e os contadores (``criados``/``atualizados``
+    trazem os totais dos lotes anteriores) na mesma transação dos produtos, de modo que uma
+    importação interrompida continua do último lote gravado. O relatório, com os avisos, só
+    é gravado no último lote.
+
+    Com o estado de uma prévia, cada código é conferido no lote em que aparece pela
+    primeira vez. Retorna False se outro processo avançou o checkpoint (importação
+    reivindicada por outro worker): o lote atual é descartado."""
+    tabela = ImportacaoPlanilha.__table__
+    linhas = dados['linhas']
+    estado = dados.get('estado')
+    tamanho = int(opcoes['chunkSize'])
+    primeiros = {}
+    if estado is not None:
+        for indice, linha in enumerate(linhas):
+            primeiros.setdefault(linha['codigo'], indice)
+
+    inicio = checkpoint
+    while True:
+        lote = linhas[inicio:inicio + tamanho]
+        if estado is not None:
+            conferir = {
+                linha['codigo']: estado[linha['codigo']]
+                for linha in lote if inicio <= primeiros[linha['codigo']] < inicio + tamanho
+            }
+            alterados = produtos_alterados(db.session.connection(), conferir)
+            if alterados:
+                raise PreviaDesatualizada(f'Produtos alterados desde a prévia: {", ".join(alterados[:20])}. Gere uma nova prévia')
+        criados_lote, atualizados_lote = gravar_produtos(db.session, lote, opcoes.get('updateExisting', False))
+        criados += criados_lote
+        atualizados += atualizados_lote
+        fim = inicio + len(lote)
+        valores = {'checkpoint': fim, 'linhas_gravadas': fim, 'produtos_criados': criados,
+                   'produtos_atualizados': atualizados, 'data_atualizacao': datetime.utcnow()}
+        if fim >= len(linhas):
+            resultado = {'created': criados, 'updated': atualizados, 'warnings': dados['avisos'], 'errors': []}
+            valores.update(status='concluida', arquivo=None, dados=None, data_fim=datetime.utcnow(),
+                           resultado=json.dumps(resultado))
+        avancou = db.session.execute(
+            update(tabela).where(tabela.c.id == importacao_id, tabela.c.checkpoint == inicio).values(**valores)
+        ).rowcount
+        if not avancou:
+            db.session.rollback()
+            return False
+        db.session.commit()
+        if fim >= len(linhas):
+            return True
+        inicio = fim
+
+
+def processar_importacao(importacao_id):
+    """Lê, valida e grava a planilha da importação (ou as linhas de uma prévia confirmada).
+
+    Sem ``chunkSize``, os produtos e o status final são gravados na mesma transação: uma
+    importação interrompida não deixa escrita parcial e pode ser reprocessada. Com
+    ``chunkSize``, as linhas validadas ficam em ``dados`` e são gravadas em lotes com
+    checkpoint (gravar_em_lotes); uma importação interrompida ou com erro continua do
+    último checkpoint, sem ler nem validar a planilha de novo."""
+    importacao = db.session.get(ImportacaoPlanilha, importacao_id)
+    opcoes = json.loads(importacao.opcoes or '{}')
+    conteudo = importacao.arquivo or b''
+    nome_arquivo = importacao.nome_arquivo
+    dados = json.loads(importacao.dados) if importacao.dados else None
+    checkpoint = importacao.checkpoint
+    criados, atualizados = importacao.produtos_criados or 0, importacao.produtos_atualizados or 0
+    em_lotes = bool(opcoes.get('chunkSize'))
+    worker = importacao.worker
+    # Libera a leitura antes da validação (SQLite: as escritas de progresso usam outra conexão)
+    db.session.rollback()
+
+    def progresso_leitura(lidas, validas):
+        _registrar(importacao_id, worker=worker, linhas_lidas=lidas, linhas_validas=validas)
+
+    # Progresso e sinal de vida a cada lote gravado. No SQLite a transação de escrita
+    # bloqueia as demais conexões: o registro vai na própria transação (outro worker
+    # também não consegue reivindicar a importação antes do commit)
+    def progresso_gravacao(gravadas):
+        if db.engine.dialect.name == 'postgresql':
+            _registrar(importacao_id, worker=worker, linhas_gravadas=gravadas)
+        else:
+            _registrar(importacao_id, db.session.connection(), worker=worker, linhas_gravadas=gravadas)
+
+    try:
+        if dados is None:
+            with Planilha(io.BytesIO(conteudo), nome_arquivo, como_texto=True) as planilha:
+                ausentes = [coluna for coluna in COLUNAS_OBRIGATORIAS_PRODUTO if coluna not in planilha.colunas]
+                if ausentes:
+                    raise ValueError(f'Colunas obrigatórias ausentes: {", ".join(ausentes)}')
+                validas, erros, avisos = validar_planilha_produtos(
+                    db.session.connection(), planilha,
+                    validar_duplicados=opcoes.get('validateDuplicates', False),
+                    validar_precos=opcoes.get('validatePrices', False),
+                    validar_estoque=opcoes.get('validateStock', False),
+                    atualizar_existentes=opcoes.get('updateExisting', False),
+                    progresso=progresso_leitura,
+                    lote_progresso=LOTE_PROGRESSO
+                )
+            lidas = len(validas) + len(erros)
+            if opcoes.get('preview'):
+                previa, dados = montar_previa(db.session.connection(), validas, erros, avisos,
+                                              opcoes.get('updateExisting', False))
+                db.session.rollback()
+                _registrar(importacao_id, worker=worker, status='previa' if dados else 'erro', arquivo=None,
+                           dados=json.dumps(dados) if dados else None, data_fim=datetime.utcnow(),
+                           linhas_lidas=lidas, linhas_validas=len(validas), resultado=json.dumps(previa),
+                           erro=None if dados else 'Erros encontrados na planilha')
+                return
+            if erros:
+                db.session.rollback()
+                _registrar(importacao_id, worker=worker, status='erro', arquivo=None, data_fim=datetime.utcnow(),
+                           linhas_lidas=lidas, linhas_validas=len(validas), erro='Erros encontrados na planilha',
+                           resultado=json.dumps({'created': 0, 'updated': 0, 'warnings': avisos, 'errors': erros}))
+                return
+            if not em_lotes:
+                _registrar(importacao_id, worker=worker, linhas_lidas=lidas, linhas_validas=len(validas))
+                gravar_importacao(importacao_id, validas, avisos, opcoes, progresso=progresso_gravacao, worker=worker)
+                db.session.commit()
+                return
+            # Em lotes: as linhas validadas ficam guardadas para a retomada
+            db.session.rollback()
+            dados = {'linhas': validas, 'avisos': avisos, 'estado': None}
+            _registrar(importacao_id, worker=worker, dados=json.dumps(dados), linhas_lidas=lidas, linhas_validas=len(validas))
+
+        if not em_lotes:
+            gravar_importacao(importacao_id, dados['linhas'], dados['avisos'], opcoes,
+                              estado=dados['estado'], progresso=progresso_gravacao, worker=worker)
+            db.session.commit()
+            return
+        if checkpoint is None:
+            checkpoint = criados = atualizados = 0
+            _registrar(importacao_id, worker=worker, checkpoint=0, produtos_criados=0, produtos_atualizados=0)
+        gravar_em_lotes(importacao_id, dados, opcoes, checkpoint, criados, atualizados)
+    except ImportacaoReivindicada:
+        # O outro worker grava a importação; as escritas deste são descartadas
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        if em_lotes and dados is not None and not isinstance(e, PreviaDesatualizada):
+            # Mantém as linhas validadas e o checkpoint para retomar_importacao()
+            _registrar(importacao_id, worker=worker, status='erro', data_fim=datetime.utcnow(), erro=str(e))
+        else:
+            _registrar(importacao_id, worker=worker, status='erro', arquivo=None, dados=None,
+                       data_fim=datetime.utcnow(), erro=str(e))
+
+
+def retomar_importacao(importacao_id, status='pendente'):
+    """Volta para ``status`` a importação em lotes que terminou com erro depois de guardar as
+    linhas validadas ('pendente' para o worker, 'processando' para retomar no processo atual).
+    Retorna False se a importação não pode ser retomada."""
+    tabela = ImportacaoPlanilha.__table__
+    retomada = db.session.execute(
+        update(tabela)
+        .where(tabela.c.id == importacao_id, tabela.c.status == 'erro', tabela.c.dados.isnot(None))
+        .values(status=status, erro=None, data_fim=None, worker=_identificacao_worker(),
+                data_atualizacao=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return retomada == 1
+
+
+def limpar_importacoes_antigas():
+    """Tarefa periódica (IMPORTACAO_LIMPEZA_SEGUNDOS): marca como erro as importações
+    abandonadas depois de esgotar as tentativas e apaga as terminadas há mais de
+    IMPORTACAO_RETENCAO_DIAS e as prévias vencidas (IMPORTACAO_PREVIA_HORAS).
+    Retorna a quantidade removida."""
+    agora = datetime.utcnow()
+    tabela = ImportacaoPlanilha.__table__
+    db.session.execute(
+        update(tabela)
+        .where(tabela.c.status == 'processando',
+               tabela.c.data_atualizacao < agora - timedelta(seconds=IMPORTACAO_TIMEOUT_SEGUNDOS),
+               tabela.c.tentativas >= IMPORTACAO_MAX_TENTATIVAS)
+        .values(status='erro', arquivo=None, data_fim=agora,
+                erro='Importação interrompida repetidamente; envie a planilha novamente')
+    )
+    removidas = db.session.execute(
+        tabela.delete().where(or_(
+            tabela.c.status.in_(('concluida', 'erro')) & (tabela.c.data_fim < agora - timedelta(days=IMPORTACAO_RETENCAO_DIAS)),
+            (tabela.c.status == 'previa') & (tabela.c.data_fim < agora - timedelta(hours=IMPORTACAO_PREVIA_HORAS))
+        ))
+    ).rowcount
+    db.session.commit()
+    return removidas
+
+
+def processar_importacoes_pendentes():
+    """Tarefa periódica: processa as importações pendentes até a fila esvaziar. Com a fila
+    vazia, só lê o banco. Retorna a quantidade processada."""
+    worker = _identificacao_worker()
+    processadas = 0
+    while True:
+        importacao_id = reivindicar_importacao(worker)
+        if importacao_id is None:
+            break
+        processar_importacao(importacao_id)
+        processadas += 1
+    return processadas
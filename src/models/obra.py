@@ -1,5 +1,10 @@
 from src.models.user import db
+from src.models.serializacao import Serializador, iso, json_lista
+from src.models.produto import Produto, MovimentacaoEstoque
+from src.models.sistema import obter_geracoes
+from sqlalchemy import func, select, update
 from datetime import datetime
+import unicodedata
 import json
 
 class Obra(db.Model):
@@ -123,3 +128,174 @@ class Lixeira(db.Model):
             'etapa': self.etapa.to_dict() if self.etapa else None
         }
 
+# Serializadores de linhas Core no mesmo formato de to_dict()
+SERIALIZADOR_OBRA = Serializador(Obra, [
+    ('id', ('id',), None),
+    ('nome', ('nome',), None),
+    ('localizacao', ('localizacao',), None),
+    ('valor', ('valor',), None),
+    ('status', ('status',), None),
+    ('progresso', ('progresso',), None),
+    ('dataInicio', ('data_inicio',), iso),
+    ('dataCriacao', ('data_criacao',), iso),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+SERIALIZADOR_ETAPA = Serializador(Etapa, [
+    ('id', ('id',), None),
+    ('obraId', ('obra_id',), None),
+    ('titulo', ('titulo',), None),
+    ('descricao', ('descricao',), None),
+    ('dataEtapa', ('data_etapa',), iso),
+    ('fotos', ('fotos',), json_lista),
+    ('deletado', ('deletado',), None),
+    ('dataExclusao', ('data_exclusao',), iso),
+    ('dataCriacao', ('data_criacao',), iso),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+SERIALIZADOR_MOBILIARIO = Serializador(Mobiliario, [
+    ('id', ('id',), None),
+    ('type', ('tipo',), None),
+    ('room', ('comodo',), None),
+    ('status', ('status',), None),
+    ('x', ('posicao_x',), None),
+    ('y', ('posicao_y',), None)
+])
+
+# Sem a etapa aninhada: a listagem da lixeira junta as etapas numa segunda consulta
+SERIALIZADOR_LIXEIRA = Serializador(Lixeira, [
+    ('id', ('id',), None),
+    ('etapaId', ('etapa_id',), None),
+    ('dataExclusao', ('data_exclusao',), iso),
+    ('usuarioExclusao', ('usuario_exclusao',), None)
+])
+
+def serializar_obras(obra_ids=None):
+    """Obras no formato de Obra.to_dict() usando três consultas Core (obras, etapas e mobiliário)
+    em vez de carregar os relacionamentos de cada obra. Retorna {obra_id: dict} na ordem das obras."""
+    query = SERIALIZADOR_OBRA.select().order_by(Obra.id)
+    etapas_query = SERIALIZADOR_ETAPA.select().where(Etapa.deletado.is_not(True)).order_by(Etapa.id)
+    mobiliario_query = SERIALIZADOR_MOBILIARIO.select(Mobiliario.obra_id).order_by(Mobiliario.id)
+    if obra_ids is not None:
+        obra_ids = list(obra_ids)
+        query = query.where(Obra.id.in_(obra_ids))
+        etapas_query = etapas_query.where(Etapa.obra_id.in_(obra_ids))
+        mobiliario_query = mobiliario_query.where(Mobiliario.obra_id.in_(obra_ids))
+    
+    obras = {}
+    for row in db.session.execute(query):
+        obra = SERIALIZADOR_OBRA.serializar(row)
+        obra['etapas'] = []
+        obra['furniture'] = []
+        obras[obra['id']] = obra
+    
+    serializar_etapa = SERIALIZADOR_ETAPA.serializar
+    for row in db.session.execute(etapas_query):
+        etapa = serializar_etapa(row)
+        if etapa['obraId'] in obras:
+            obras[etapa['obraId']]['etapas'].append(etapa)
+    
+    serializar_mobiliario = SERIALIZADOR_MOBILIARIO.serializar
+    for row in db.session.execute(mobiliario_query):
+        if row[-1] in obras:
+            obras[row[-1]]['furniture'].append(serializar_mobiliario(row))
+    
+    return obras
+
+
+# Atribuição das dispensações às obras. Dispensações antigas só guardam o destino como texto
+# no motivo ("Dispensação para <local_uso>"); o local é comparado com o nome (ou, na falta,
+# a localização) das obras, ignorando acentos, maiúsculas e espaços repetidos.
+PREFIXO_DISPENSACAO = 'Dispensação para '
+LOTE_ATRIBUICAO = 500
+
+def normalizar_nome(texto):
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(caractere for caractere in texto if not unicodedata.combining(caractere))
+    return ' '.join(texto.lower().split())
+
+def _mapa_obras(connection):
+    """{nome normalizado: obra_id}; nomes repetidos entre obras ficam de fora (ambíguos)"""
+    por_nome, por_localizacao = {}, {}
+    for obra_id, nome, localizacao in connection.execute(select(Obra.id, Obra.nome, Obra.localizacao)):
+        for mapa, valor in ((por_nome, nome), (por_localizacao, localizacao)):
+            chave = normalizar_nome(valor)
+            if chave:
+                mapa[chave] = None if chave in mapa else obra_id
+    mapa = {chave: obra_id for chave, obra_id in por_localizacao.items() if obra_id is not None}
+    mapa.update((chave, obra_id) for chave, obra_id in por_nome.items() if obra_id is not None)
+    return mapa
+
+# Mapa usado nas dispensações, por worker: (geração da coleção obras, mapa). É refeito só
+# quando a geração muda, com o mesmo atraso entre workers do cache de respostas.
+_mapa_obras_cache = (None, None)
+
+def obra_por_local(connection, local_uso):
+    """Id da obra correspondente ao local de uso informado na dispensação, ou None"""
+    global _mapa_obras_cache
+    geracao = obter_geracoes(['obras'])['obras']
+    lida, mapa = _mapa_obras_cache
+    if mapa is None or lida != geracao:
+        mapa = _mapa_obras(connection)
+        _mapa_obras_cache = (geracao, mapa)
+    return mapa.get(normalizar_nome(local_uso))
+
+def atribuir_obras_movimentacoes(connection):
+    """Preenche obra_id das dispensações antigas a partir do motivo.
+
+    Retorna (movimentações atualizadas, locais sem obra correspondente)."""
+    motivos = connection.execute(
+        select(MovimentacaoEstoque.motivo).distinct().where(
+            MovimentacaoEstoque.obra_id.is_(None),
+            MovimentacaoEstoque.tipo == 'saida',
+            MovimentacaoEstoque.motivo.like(f'{PREFIXO_DISPENSACAO}%')
+        )
+    ).scalars().all()
+    mapa = _mapa_obras(connection)
+    por_obra = {}
+    sem_obra = set()
+    for motivo in motivos:
+        local = motivo[len(PREFIXO_DISPENSACAO):]
+        obra_id = mapa.get(normalizar_nome(local))
+        if obra_id is None:
+            sem_obra.add(local)
+        else:
+            por_obra.setdefault(obra_id, []).append(motivo)
+
+    atualizadas = 0
+    for obra_id, motivos_obra in por_obra.items():
+        for inicio in range(0, len(motivos_obra), LOTE_ATRIBUICAO):
+            resultado = connection.execute(
+                update(MovimentacaoEstoque)
+                .where(
+                    MovimentacaoEstoque.obra_id.is_(None),
+                    MovimentacaoEstoque.tipo == 'saida',
+                    MovimentacaoEstoque.motivo.in_(motivos_obra[inicio:inicio + LOTE_ATRIBUICAO])
+                )
+                .values(obra_id=obra_id)
+                .execution_options(synchronize_session=False)
+            )
+            atualizadas += resultado.rowcount
+    return atualizadas, sorted(sem_obra)
+
+def custos_obra(connection, obra_id):
+    """Materiais dispensados para a obra, agrupados por produto (índice obra_id, produto_id).
+
+    O valor usa o preço atual de cada produto."""
+    quantidades = select(
+        MovimentacaoEstoque.produto_id.label('produto_id'),
+        func.sum(MovimentacaoEstoque.quantidade).label('quantidade'),
+        func.count().label('dispensacoes')
+    ).where(
+        MovimentacaoEstoque.obra_id == obra_id,
+        MovimentacaoEstoque.tipo == 'saida'
+    ).group_by(MovimentacaoEstoque.produto_id).subquery('quantidades')
+    return connection.execute(
+        select(
+            Produto.id, Produto.nome, Produto.codigo, Produto.categoria, Produto.unidade,
+            func.coalesce(Produto.preco, 0).label('preco'),
+            quantidades.c.quantidade, quantidades.c.dispensacoes
+        ).join(quantidades, quantidades.c.produto_id == Produto.id)
+        .order_by(Produto.nome, Produto.id)
+    ).all()
@@ -1,5 +1,10 @@
 from src.models.user import db
-from datetime import datetime
+from src.models.serializacao import Serializador, iso
+from src.utils.sql import insert_dialeto
+from sqlalchemy import event, func, inspect, literal, select, text, union_all
+from sqlalchemy.orm import Session
+from datetime import date, datetime, time, timedelta
+import os
 
 class Produto(db.Model):
     __tablename__ = 'produtos'
@@ -21,6 +26,17 @@ class Produto(db.Model):
     # Relacionamentos
     movimentacoes = db.relationship('MovimentacaoEstoque', backref='produto', lazy=True, cascade='all, delete-orphan')
     
+    __table_args__ = (
+        # Índice parcial só com os produtos em alerta, ordenado pelo déficit (estoque - estoque_minimo)
+        db.Index(
+            'ix_produtos_alerta_estoque',
+            estoque - estoque_minimo,
+            id,
+            postgresql_where=db.and_(ativo == True, estoque <= estoque_minimo),
+            sqlite_where=db.and_(ativo == True, estoque <= estoque_minimo)
+        ),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -52,6 +68,15 @@ class MovimentacaoEstoque(db.Model):
     observacoes = db.Column(db.Text)
     usuario = db.Column(db.String(100))
     data_movimentacao = db.Column(db.DateTime, default=datetime.utcnow)
+    obra_id = db.Column(db.Integer, db.ForeignKey('obras.id', ondelete='SET NULL'))  # Destino das dispensações
+    
+    __table_args__ = (
+        # Histórico por produto (get_movimentacoes_produto) e listagem geral por data com cursor
+        db.Index('ix_movimentacoes_produto_data', produto_id, data_movimentacao.desc(), id.desc()),
+        db.Index('ix_movimentacoes_data_id', data_movimentacao.desc(), id.desc()),
+        # Custos por obra (GET /obras/<id>/custos), agrupados por produto
+        db.Index('ix_movimentacoes_obra_produto', obra_id, produto_id),
+    )
     
     def to_dict(self):
         return {
@@ -65,6 +90,7 @@ class MovimentacaoEstoque(db.Model):
             'observacoes': self.observacoes,
             'usuario': self.usuario,
             'dataMovimentacao': self.data_movimentacao.isoformat() if self.data_movimentacao else None,
+            'obraId': self.obra_id,
             'produto': self.produto.to_dict() if self.produto else None
         }
 
@@ -88,3 +114,600 @@ class Categoria(db.Model):
             'dataCriacao': self.data_criacao.isoformat() if self.data_criacao else None
         }
 
+
+# Serializadores de linhas Core no mesmo formato de to_dict()
+SERIALIZADOR_PRODUTO = Serializador(Produto, [
+    ('id', ('id',), None),
+    ('nome', ('nome',), None),
+    ('categoria', ('categoria',), None),
+    ('codigo', ('codigo',), None),
+    ('estoque', ('estoque',), None),
+    ('estoqueMinimo', ('estoque_minimo',), None),
+    ('preco', ('preco',), None),
+    ('unidade', ('unidade',), None),
+    ('descricao', ('descricao',), None),
+    ('foto', ('foto',), None),
+    ('ativo', ('ativo',), None),
+    ('valorTotal', ('estoque', 'preco'), lambda estoque, preco: (estoque or 0) * preco),
+    ('dataCriacao', ('data_criacao',), iso),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+# Sem o produto aninhado: as listagens juntam o resumo do produto com um join
+SERIALIZADOR_MOVIMENTACAO = Serializador(MovimentacaoEstoque, [
+    ('id', ('id',), None),
+    ('produtoId', ('produto_id',), None),
+    ('tipo', ('tipo',), None),
+    ('quantidade', ('quantidade',), None),
+    ('quantidadeAnterior', ('quantidade_anterior',), None),
+    ('quantidadeAtual', ('quantidade_atual',), None),
+    ('motivo', ('motivo',), None),
+    ('observacoes', ('observacoes',), None),
+    ('usuario', ('usuario',), None),
+    ('dataMovimentacao', ('data_movimentacao',), iso),
+    ('obraId', ('obra_id',), None)
+])
+
+SERIALIZADOR_CATEGORIA = Serializador(Categoria, [
+    ('id', ('id',), None),
+    ('nome', ('nome',), None),
+    ('descricao', ('descricao',), None),
+    ('cor', ('cor',), None),
+    ('ativo', ('ativo',), None),
+    ('dataCriacao', ('data_criacao',), iso)
+])
+
+class ResumoEstoqueCategoria(db.Model):
+    __tablename__ = 'resumo_estoque_categoria'
+    
+    categoria = db.Column(db.String(100), primary_key=True)
+    produtos = db.Column(db.Integer, nullable=False, default=0)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+    valor_total = db.Column(db.Float, nullable=False, default=0)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'categoria': self.categoria,
+            'produtos': self.produtos,
+            'unidades': self.unidades,
+            'valorTotal': round(self.valor_total, 2),
+            'dataAtualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None
+        }
+
+class DeltaResumoEstoque(db.Model):
+    __tablename__ = 'deltas_resumo_estoque'
+    
+    # Variações do resumo ainda não somadas a resumo_estoque_categoria (ver aplicar_delta_resumo)
+    id = db.Column(db.Integer, primary_key=True)
+    categoria = db.Column(db.String(100), nullable=False)
+    produtos = db.Column(db.Integer, nullable=False, default=0)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+    valor_total = db.Column(db.Float, nullable=False, default=0)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+
+SERIALIZADOR_RESUMO = Serializador(ResumoEstoqueCategoria, [
+    ('categoria', ('categoria',), None),
+    ('produtos', ('produtos',), None),
+    ('unidades', ('unidades',), None),
+    ('valorTotal', ('valor_total',), lambda valor: round(valor, 2)),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+def _contribuicao(categoria, ativo, estoque, preco):
+    """Parcela de um produto no resumo: (produtos, unidades, valor)"""
+    if ativo is False or categoria is None:
+        return None
+    estoque = estoque or 0
+    return (1, estoque, estoque * (preco or 0))
+
+def _somar_delta(deltas, categoria, contribuicao, sinal):
+    if contribuicao is None:
+        return
+    atual = deltas.setdefault(categoria, [0, 0, 0.0])
+    for i, valor in enumerate(contribuicao):
+        atual[i] += sinal * valor
+
+CAMPOS_RESUMO = ('categoria', 'ativo', 'estoque', 'preco')
+
+def _valor_anterior(obj, campo):
+    """Valor do atributo antes das alterações pendentes no objeto"""
+    historico = inspect(obj).attrs[campo].history
+    if historico.deleted:
+        return historico.deleted[0]
+    return getattr(obj, campo)
+
+def delta_resumo(antes, depois):
+    """Variação do resumo {categoria: [produtos, unidades, valor]} entre dois estados dos mesmos
+    produtos, cada um uma sequência de (categoria, ativo, estoque, preco)"""
+    deltas = {}
+    for campos in antes:
+        _somar_delta(deltas, campos[0], _contribuicao(*campos), -1)
+    for campos in depois:
+        _somar_delta(deltas, campos[0], _contribuicao(*campos), 1)
+    return deltas
+
+def aplicar_delta_resumo(connection, deltas):
+    """Registra {categoria: (produtos, unidades, valor)} na transação da conexão.
+
+    Cada escrita insere as suas linhas em deltas_resumo_estoque em vez de atualizar a linha da
+    categoria, que ficaria travada até o commit e serializaria as escritas concorrentes em
+    produtos da mesma categoria; consolidar_resumo() soma os deltas ao resumo periodicamente."""
+    agora = datetime.utcnow()
+    linhas = [{
+        'categoria': categoria,
+        'produtos': produtos,
+        'unidades': unidades,
+        'valor_total': valor,
+        'data_criacao': agora
+    } for categoria, (produtos, unidades, valor) in sorted(deltas.items()) if produtos or unidades or valor]
+    if linhas:
+        connection.execute(DeltaResumoEstoque.__table__.insert(), linhas)
+
+def consolidar_resumo(connection):
+    """Soma ao resumo os deltas pendentes e os apaga. O DELETE ... RETURNING devolve exatamente
+    as linhas apagadas: deltas confirmados durante a consolidação ficam para a próxima.
+    Retorna a quantidade de deltas consolidados."""
+    deltas = DeltaResumoEstoque.__table__
+    linhas = connection.execute(
+        deltas.delete().returning(deltas.c.categoria, deltas.c.produtos, deltas.c.unidades, deltas.c.valor_total)
+    ).all()
+    somas = {}
+    for categoria, produtos, unidades, valor in linhas:
+        _somar_delta(somas, categoria, (produtos, unidades, valor), 1)
+    tabela = ResumoEstoqueCategoria.__table__
+    agora = datetime.utcnow()
+    for categoria in sorted(somas):
+        produtos, unidades, valor = somas[categoria]
+        if not produtos and not unidades and not valor:
+            continue
+        stmt = insert_dialeto(connection, tabela).values(
+            categoria=categoria, produtos=produtos, unidades=unidades,
+            valor_total=valor, data_atualizacao=agora
+        )
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=[tabela.c.categoria],
+            set_={
+                'produtos': tabela.c.produtos + stmt.excluded.produtos,
+                'unidades': tabela.c.unidades + stmt.excluded.unidades,
+                'valor_total': tabela.c.valor_total + stmt.excluded.valor_total,
+                'data_atualizacao': agora
+            }
+        ))
+    return len(linhas)
+
+RESUMO_CONSOLIDACAO_SEGUNDOS = float(os.environ.get('RESUMO_CONSOLIDACAO_SEGUNDOS', '60'))
+
+def manter_resumo_estoque():
+    """Tarefa periódica: consolida os deltas pendentes do resumo"""
+    consolidar_resumo(db.session.connection())
+    db.session.commit()
+
+def resumo_estoque(connection):
+    """Linhas (categoria, produtos, unidades, valor_total, data_atualizacao) do resumo somado aos
+    deltas ainda não consolidados, das categorias com produtos"""
+    resumo = ResumoEstoqueCategoria.__table__
+    deltas = DeltaResumoEstoque.__table__
+    uniao = union_all(
+        select(resumo.c.categoria, resumo.c.produtos, resumo.c.unidades, resumo.c.valor_total,
+               resumo.c.data_atualizacao.label('data')),
+        select(deltas.c.categoria, deltas.c.produtos, deltas.c.unidades, deltas.c.valor_total,
+               deltas.c.data_criacao.label('data'))
+    ).subquery('resumo')
+    produtos = func.sum(uniao.c.produtos)
+    return connection.execute(
+        select(uniao.c.categoria, produtos, func.sum(uniao.c.unidades), func.sum(uniao.c.valor_total),
+               func.max(uniao.c.data))
+        .group_by(uniao.c.categoria)
+        .having(produtos > 0)
+        .order_by(uniao.c.categoria)
+    ).all()
+
+def recalcular_resumo(connection, categorias=None):
+    """Reconstrói o resumo a partir da tabela de produtos (todas ou só as categorias informadas),
+    descartando os deltas pendentes delas. Deltas de transações concorrentes podem se perder:
+    usar com o sistema parado (inicialização, manutenção); as escritas usam aplicar_delta_resumo()."""
+    resumo = ResumoEstoqueCategoria.__table__
+    deltas = DeltaResumoEstoque.__table__
+    produtos = Produto.__table__
+    estoque = func.coalesce(produtos.c.estoque, 0)
+    query = select(
+        produtos.c.categoria,
+        func.count(),
+        func.coalesce(func.sum(estoque), 0),
+        func.coalesce(func.sum(estoque * produtos.c.preco), 0.0)
+    ).where(produtos.c.ativo == True).group_by(produtos.c.categoria)
+    
+    apagar = resumo.delete()
+    apagar_deltas = deltas.delete()
+    if categorias is not None:
+        categorias = list(categorias)
+        query = query.where(produtos.c.categoria.in_(categorias))
+        apagar = apagar.where(resumo.c.categoria.in_(categorias))
+        apagar_deltas = apagar_deltas.where(deltas.c.categoria.in_(categorias))
+    
+    linhas = connection.execute(query).all()
+    connection.execute(apagar)
+    connection.execute(apagar_deltas)
+    agora = datetime.utcnow()
+    if linhas:
+        connection.execute(resumo.insert(), [{
+            'categoria': categoria,
+            'produtos': total_produtos,
+            'unidades': unidades,
+            'valor_total': valor,
+            'data_atualizacao': agora
+        } for categoria, total_produtos, unidades, valor in linhas])
+
+def garantir_resumo_estoque():
+    """Preenche o resumo na inicialização quando ele ainda não existe (bancos anteriores à tabela)"""
+    if ResumoEstoqueCategoria.query.first() is None and Produto.query.first() is not None:
+        recalcular_resumo(db.session.connection())
+        db.session.commit()
+
+@event.listens_for(Session, 'before_flush')
+def _calcular_delta_resumo(session, flush_context, instances):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Produto):
+            _somar_delta(deltas, obj.categoria, _contribuicao(obj.categoria, obj.ativo, obj.estoque, obj.preco), 1)
+    for obj in session.deleted:
+        if isinstance(obj, Produto):
+            anterior = [_valor_anterior(obj, campo) for campo in CAMPOS_RESUMO]
+            _somar_delta(deltas, anterior[0], _contribuicao(*anterior), -1)
+    for obj in session.dirty:
+        if isinstance(obj, Produto) and session.is_modified(obj):
+            anterior = [_valor_anterior(obj, campo) for campo in CAMPOS_RESUMO]
+            _somar_delta(deltas, anterior[0], _contribuicao(*anterior), -1)
+            _somar_delta(deltas, obj.categoria, _contribuicao(obj.categoria, obj.ativo, obj.estoque, obj.preco), 1)
+    if deltas:
+        pendentes = session.info.setdefault('delta_resumo', {})
+        for categoria, delta in deltas.items():
+            _somar_delta(pendentes, categoria, delta, 1)
+
+@event.listens_for(Session, 'after_flush')
+def _aplicar_delta_resumo(session, flush_context):
+    deltas = session.info.pop('delta_resumo', None)
+    if deltas:
+        aplicar_delta_resumo(session.connection(), deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_delta_resumo(session):
+    session.info.pop('delta_resumo', None)
+
+class SnapshotEstoque(db.Model):
+    __tablename__ = 'snapshots_estoque'
+    
+    # Um lote por execução: todos os produtos com o mesmo data_referencia. O snapshot reflete
+    # as movimentações com data_movimentacao < data_referencia.
+    data_referencia = db.Column(db.DateTime, primary_key=True)
+    produto_id = db.Column(db.Integer, primary_key=True)
+    estoque = db.Column(db.Integer, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'dataReferencia': self.data_referencia.isoformat() if self.data_referencia else None,
+            'produtoId': self.produto_id,
+            'estoque': self.estoque
+        }
+
+def gerar_snapshot_estoque(connection, momento=None):
+    """Grava o estoque atual de todos os produtos como um lote de snapshot; retorna o momento.
+    Movimentações já gravadas com data >= momento são descontadas do estoque fotografado."""
+    momento = momento or datetime.utcnow()
+    produtos = Produto.__table__
+    movimentacoes = MovimentacaoEstoque.__table__
+    futuras = select(
+        movimentacoes.c.produto_id,
+        func.sum(movimentacoes.c.quantidade_atual - movimentacoes.c.quantidade_anterior).label('delta')
+    ).where(movimentacoes.c.data_movimentacao >= momento)\
+        .group_by(movimentacoes.c.produto_id).subquery('futuras')
+    connection.execute(SnapshotEstoque.__table__.insert().from_select(
+        ['data_referencia', 'produto_id', 'estoque'],
+        select(
+            literal(momento, db.DateTime), produtos.c.id,
+            func.coalesce(produtos.c.estoque, 0) - func.coalesce(futuras.c.delta, 0)
+        ).outerjoin(futuras, futuras.c.produto_id == produtos.c.id)
+    ))
+    return momento
+
+def _como_datetime(data):
+    if isinstance(data, date) and not isinstance(data, datetime):
+        return datetime.combine(data, time())
+    return data
+
+def ajustar_snapshots(connection, movimentacoes, sinal=1):
+    """Soma a variação de cada movimentação (dicts com as colunas de MovimentacaoEstoque) aos
+    lotes de snapshot posteriores à sua data: uma movimentação gravada depois do lote mas datada
+    antes dele (dispensação com data informada) não está no estoque fotografado"""
+    tabela = SnapshotEstoque.__table__
+    variacoes = {}
+    for mov in movimentacoes:
+        data = _como_datetime(mov.get('data_movimentacao'))
+        delta = (mov['quantidade_atual'] or 0) - (mov['quantidade_anterior'] or 0)
+        if data is not None and delta:
+            chave = (mov['produto_id'], data)
+            variacoes[chave] = variacoes.get(chave, 0) + sinal * delta
+    if not variacoes:
+        return
+    ultimo = connection.execute(select(func.max(tabela.c.data_referencia))).scalar()
+    linhas = [
+        {'p_produto_id': produto_id, 'p_data': data, 'p_delta': delta}
+        for (produto_id, data), delta in sorted(variacoes.items())
+        if ultimo is not None and data < ultimo and delta
+    ]
+    if linhas:
+        connection.execute(
+            tabela.update()
+            .where(tabela.c.produto_id == db.bindparam('p_produto_id'),
+                   tabela.c.data_referencia > db.bindparam('p_data'))
+            .values(estoque=tabela.c.estoque + db.bindparam('p_delta')),
+            linhas
+        )
+
+def podar_snapshots(connection, dias):
+    """Mantém todos os lotes dos últimos ``dias`` e apenas o primeiro lote de cada mês antes disso"""
+    tabela = SnapshotEstoque.__table__
+    limite = datetime.utcnow() - timedelta(days=dias)
+    antigos = connection.execute(
+        select(tabela.c.data_referencia).distinct()
+        .where(tabela.c.data_referencia < limite)
+        .order_by(tabela.c.data_referencia)
+    ).scalars().all()
+    
+    meses = set()
+    remover = []
+    for data_referencia in antigos:
+        mes = (data_referencia.year, data_referencia.month)
+        if mes in meses:
+            remover.append(data_referencia)
+        meses.add(mes)
+    for inicio in range(0, len(remover), 500):
+        connection.execute(tabela.delete().where(tabela.c.data_referencia.in_(remover[inicio:inicio + 500])))
+    return len(remover)
+
+def _ancora_estoque(connection, momento):
+    """Lote de snapshot mais próximo de ``momento`` (antes ou depois); o estoque atual dos
+    produtos serve de âncora posterior quando não há snapshot depois do momento.
+    Retorna (data_referencia ou None para o estoque atual, posterior)."""
+    tabela = SnapshotEstoque.__table__
+    anterior = connection.execute(
+        select(func.max(tabela.c.data_referencia)).where(tabela.c.data_referencia <= momento)
+    ).scalar()
+    posterior = connection.execute(
+        select(func.min(tabela.c.data_referencia)).where(tabela.c.data_referencia > momento)
+    ).scalar()
+    agora = datetime.utcnow()
+    
+    if anterior is not None and momento - anterior <= (posterior or agora) - momento:
+        return anterior, False
+    return posterior, True
+
+def estoque_em(connection, momento, categoria=None, produto_id=None):
+    """Estoque de cada produto em ``momento`` (movimentações com data < momento).
+
+    Parte do lote de snapshot mais próximo (ou do estoque atual) e reaplica apenas os deltas
+    (quantidade_atual - quantidade_anterior) das movimentações entre a âncora e o momento:
+    para frente a partir de um snapshot anterior, para trás a partir de um posterior.
+    Retorna (data da âncora ou None se for o estoque atual, linhas id/nome/codigo/categoria/unidade/estoque).
+    """
+    produtos = Produto.__table__
+    snapshots = SnapshotEstoque.__table__
+    movimentacoes = MovimentacaoEstoque.__table__
+    
+    data_ancora, posterior = _ancora_estoque(connection, momento)
+    
+    delta = func.sum(movimentacoes.c.quantidade_atual - movimentacoes.c.quantidade_anterior)
+    replay = select(movimentacoes.c.produto_id, delta.label('delta')).group_by(movimentacoes.c.produto_id)
+    if posterior:
+        replay = replay.where(movimentacoes.c.data_movimentacao >= momento)
+        if data_ancora is not None:
+            replay = replay.where(movimentacoes.c.data_movimentacao < data_ancora)
+    else:
+        replay = replay.where(movimentacoes.c.data_movimentacao >= data_ancora,
+                              movimentacoes.c.data_movimentacao < momento)
+    replay = replay.subquery('replay')
+    
+    if data_ancora is None:
+        base = func.coalesce(produtos.c.estoque, 0)
+        query = select(produtos.c.id)
+    else:
+        base = func.coalesce(snapshots.c.estoque, 0)
+        query = select(produtos.c.id).outerjoin(snapshots, db.and_(
+            snapshots.c.produto_id == produtos.c.id, snapshots.c.data_referencia == data_ancora
+        ))
+    sinal = -1 if posterior else 1
+    estoque = (base + sinal * func.coalesce(replay.c.delta, 0)).label('estoque')
+    
+    query = query.add_columns(
+        produtos.c.nome, produtos.c.codigo, produtos.c.categoria, produtos.c.unidade, estoque
+    ).outerjoin(replay, replay.c.produto_id == produtos.c.id)\
+        .where(produtos.c.data_criacao < momento)\
+        .order_by(produtos.c.nome, produtos.c.id)
+    if categoria:
+        query = query.where(produtos.c.categoria == categoria)
+    if produto_id is not None:
+        query = query.where(produtos.c.id == produto_id)
+    
+    return data_ancora, connection.execute(query).all()
+
+SNAPSHOT_INTERVALO_HORAS = float(os.environ.get('SNAPSHOT_INTERVALO_HORAS', '24'))
+SNAPSHOT_RETENCAO_DIAS = int(os.environ.get('SNAPSHOT_RETENCAO_DIAS', '90'))
+
+def manter_snapshots_estoque(forcar=False):
+    """Tarefa periódica: grava um lote quando o último tem mais de SNAPSHOT_INTERVALO_HORAS
+    e poda os lotes antigos. Retorna o momento do lote gravado ou None."""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # Vários workers executam a tarefa; só um grava o lote
+        if not connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:nome))'),
+                                  {'nome': SnapshotEstoque.__tablename__}).scalar():
+            db.session.rollback()
+            return None
+    
+    ultimo = connection.execute(select(func.max(SnapshotEstoque.data_referencia))).scalar()
+    momento = None
+    if forcar or ultimo is None or datetime.utcnow() - ultimo >= timedelta(hours=SNAPSHOT_INTERVALO_HORAS):
+        momento = gerar_snapshot_estoque(connection)
+        podar_snapshots(connection, SNAPSHOT_RETENCAO_DIAS)
+    db.session.commit()
+    return momento
+
+class ConsumoMensal(db.Model):
+    __tablename__ = 'consumo_mensal'
+    
+    produto_id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.Date, primary_key=True)  # Primeiro dia do mês (UTC)
+    entradas = db.Column(db.Integer, nullable=False, default=0)
+    saidas = db.Column(db.Integer, nullable=False, default=0)
+    movimentacoes = db.Column(db.Integer, nullable=False, default=0)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        # Totais por mês de todos os produtos (GET /produtos/consumo sem produto_id)
+        db.Index('ix_consumo_mensal_mes', mes, produto_id),
+    )
+    
+    def to_dict(self):
+        return {
+            'produtoId': self.produto_id,
+            'mes': self.mes.strftime('%Y-%m') if self.mes else None,
+            'entradas': self.entradas,
+            'saidas': self.saidas,
+            'movimentacoes': self.movimentacoes
+        }
+
+def _mes(data):
+    return date(data.year, data.month, 1)
+
+def parcela_consumo(tipo, quantidade, anterior, atual):
+    """(entradas, saidas) de uma movimentação: pelo tipo, ou pelo sinal da variação nos ajustes"""
+    if tipo == 'entrada':
+        return quantidade, 0
+    if tipo == 'saida':
+        return 0, quantidade
+    variacao = (atual or 0) - (anterior or 0)
+    return max(variacao, 0), max(-variacao, 0)
+
+def delta_consumo(movimentacoes, deltas=None, sinal=1):
+    """Acumula {(produto_id, mes): [entradas, saidas, movimentacoes]} a partir de dicts com as
+    colunas de MovimentacaoEstoque (as mesmas linhas usadas em inserts em massa)"""
+    deltas = {} if deltas is None else deltas
+    agora = datetime.utcnow()
+    for mov in movimentacoes:
+        entradas, saidas = parcela_consumo(
+            mov['tipo'], mov['quantidade'], mov['quantidade_anterior'], mov['quantidade_atual']
+        )
+        atual = deltas.setdefault((mov['produto_id'], _mes(mov.get('data_movimentacao') or agora)), [0, 0, 0])
+        atual[0] += sinal * entradas
+        atual[1] += sinal * saidas
+        atual[2] += sinal
+    return deltas
+
+def aplicar_delta_consumo(connection, deltas):
+    """Soma os deltas de delta_consumo() ao consumo mensal na transação da conexão"""
+    tabela = ConsumoMensal.__table__
+    agora = datetime.utcnow()
+    # Um único upsert executado em lote (executemany), na ordem das chaves para que
+    # transações concorrentes travem as linhas na mesma sequência
+    linhas = [
+        {'produto_id': produto_id, 'mes': mes, 'entradas': entradas, 'saidas': saidas,
+         'movimentacoes': movimentacoes, 'data_atualizacao': agora}
+        for (produto_id, mes), (entradas, saidas, movimentacoes) in sorted(deltas.items())
+        if entradas or saidas or movimentacoes
+    ]
+    if not linhas:
+        return
+    stmt = insert_dialeto(connection, tabela)
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=[tabela.c.produto_id, tabela.c.mes],
+        set_={
+            'entradas': tabela.c.entradas + stmt.excluded.entradas,
+            'saidas': tabela.c.saidas + stmt.excluded.saidas,
+            'movimentacoes': tabela.c.movimentacoes + stmt.excluded.movimentacoes,
+            'data_atualizacao': stmt.excluded.data_atualizacao
+        }
+    ), linhas)
+
+def _mes_sql(connection, coluna):
+    if connection.dialect.name == 'postgresql':
+        return func.cast(func.date_trunc('month', coluna), db.Date)
+    return func.date(coluna, 'start of month')
+
+def dia_sql(connection, coluna):
+    """Dia (sem hora) de uma coluna de data: a ordem das cadeias de movimentações é (dia, id)"""
+    if connection.dialect.name == 'postgresql':
+        return func.cast(coluna, db.Date)
+    return func.date(coluna)
+
+def recalcular_consumo(connection, produto_ids=None, desde=None):
+    """Reconstrói o consumo mensal a partir do ledger (todos ou só os produtos informados).
+    Com ``desde`` (primeiro dia de um mês), apenas os meses a partir dele são refeitos."""
+    consumo = ConsumoMensal.__table__
+    movimentacoes = MovimentacaoEstoque.__table__
+    variacao = movimentacoes.c.quantidade_atual - movimentacoes.c.quantidade_anterior
+    entradas = db.case(
+        (movimentacoes.c.tipo == 'entrada', movimentacoes.c.quantidade),
+        (movimentacoes.c.tipo == 'saida', 0),
+        (variacao > 0, variacao),
+        else_=0
+    )
+    saidas = db.case(
+        (movimentacoes.c.tipo == 'saida', movimentacoes.c.quantidade),
+        (movimentacoes.c.tipo == 'entrada', 0),
+        (variacao < 0, -variacao),
+        else_=0
+    )
+    mes = _mes_sql(connection, movimentacoes.c.data_movimentacao)
+    query = select(
+        movimentacoes.c.produto_id, mes, func.sum(entradas), func.sum(saidas), func.count(), literal(datetime.utcnow(), db.DateTime)
+    ).group_by(movimentacoes.c.produto_id, mes)
+    
+    apagar = consumo.delete()
+    if desde is not None:
+        query = query.where(movimentacoes.c.data_movimentacao >= datetime.combine(desde, time.min))
+        apagar = apagar.where(consumo.c.mes >= desde)
+    if produto_ids is not None:
+        produto_ids = list(produto_ids)
+        query = query.where(movimentacoes.c.produto_id.in_(produto_ids))
+        apagar = apagar.where(consumo.c.produto_id.in_(produto_ids))
+    
+    connection.execute(apagar)
+    connection.execute(consumo.insert().from_select(
+        ['produto_id', 'mes', 'entradas', 'saidas', 'movimentacoes', 'data_atualizacao'], query
+    ))
+
+def garantir_consumo_mensal():
+    """Preenche o consumo mensal na inicialização quando ele ainda não existe (bancos anteriores à tabela)"""
+    if ConsumoMensal.query.first() is None and MovimentacaoEstoque.query.first() is not None:
+        recalcular_consumo(db.session.connection())
+        db.session.commit()
+
+def _colunas_movimentacao(obj):
+    return {
+        'produto_id': obj.produto_id,
+        'tipo': obj.tipo,
+        'quantidade': obj.quantidade,
+        'quantidade_anterior': obj.quantidade_anterior,
+        'quantidade_atual': obj.quantidade_atual,
+        'data_movimentacao': obj.data_movimentacao
+    }
+
+@event.listens_for(Session, 'after_flush')
+def _aplicar_delta_consumo(session, flush_context):
+    # Em after_flush os novos objetos já têm produto_id e data_movimentacao preenchidos
+    deltas = delta_consumo(
+        _colunas_movimentacao(obj) for obj in session.new if isinstance(obj, MovimentacaoEstoque)
+    )
+    delta_consumo(
+        (_colunas_movimentacao(obj) for obj in session.deleted if isinstance(obj, MovimentacaoEstoque)),
+        deltas, sinal=-1
+    )
+    if deltas:
+        aplicar_delta_consumo(session.connection(), deltas)
+
+@event.listens_for(Session, 'after_flush')
+def _ajustar_snapshots_retroativos(session, flush_context):
+    novas = [_colunas_movimentacao(obj) for obj in session.new if isinstance(obj, MovimentacaoEstoque)]
+    if novas:
+        ajustar_snapshots(session.connection(), novas)
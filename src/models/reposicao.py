@@ -0,0 +1,132 @@
+import os
+import math
+from datetime import datetime, timedelta
+from statistics import NormalDist
+from sqlalchemy import func, select
+from src.models.produto import Produto, MovimentacaoEstoque, ConsumoMensal
+
+try:
+    import numpy as np
+    NUMPY_SUPPORT = True
+except ImportError:
+    NUMPY_SUPPORT = False
+
+# Ponto de reposição e dias de cobertura de todo o catálogo.
+# A demanda diária de cada produto é a série de saídas por dia na janela (dias sem saída
+# contam como zero). Em vez de montar a matriz densa produtos x dias, o banco devolve por
+# produto as estatísticas suficientes da série (soma e soma dos quadrados dos totais diários)
+# e o NumPy calcula média, variância, estoque de segurança e sugestões vetorizados.
+
+REPOSICAO_CACHE_SEGUNDOS = int(os.environ.get('REPOSICAO_CACHE_SEGUNDOS', '3600'))
+DIAS_POR_MES = 30.4375
+
+
+def _dia_sql(connection, coluna):
+    if connection.dialect.name == 'postgresql':
+        return func.date_trunc('day', coluna)
+    return func.date(coluna)
+
+
+def _somas_movimentacoes(connection, inicio):
+    """{produto_id: (soma, soma dos quadrados)} dos totais diários de saída desde ``inicio``"""
+    dia = _dia_sql(connection, MovimentacaoEstoque.data_movimentacao)
+    diario = select(
+        MovimentacaoEstoque.produto_id.label('produto_id'),
+        func.sum(MovimentacaoEstoque.quantidade).label('total')
+    ).where(
+        MovimentacaoEstoque.tipo == 'saida',
+        MovimentacaoEstoque.data_movimentacao >= inicio
+    ).group_by(MovimentacaoEstoque.produto_id, dia).subquery('diario')
+    return connection.execute(
+        select(diario.c.produto_id, func.sum(diario.c.total), func.sum(diario.c.total * diario.c.total))
+        .group_by(diario.c.produto_id)
+    ).all()
+
+
+def _somas_consumo(connection, inicio):
+    """Mesmas somas a partir do consumo mensal (totais mensais, mais rápido e menos preciso)"""
+    return connection.execute(
+        select(
+            ConsumoMensal.produto_id,
+            func.sum(ConsumoMensal.saidas),
+            func.sum(ConsumoMensal.saidas * ConsumoMensal.saidas)
+        ).where(ConsumoMensal.mes >= inicio.date().replace(day=1))
+        .group_by(ConsumoMensal.produto_id)
+    ).all()
+
+
+def calcular_reposicao(connection, janela=365, prazo=7, ciclo=30, nivel_servico=0.95, fonte='movimentacoes'):
+    """Calcula para os produtos ativos: demanda média e desvio diários, dias de cobertura,
+    ponto de reposição (demanda no prazo + estoque de segurança z * desvio * sqrt(prazo)) e
+    quantidade sugerida para cobrir o prazo e o ciclo até a próxima revisão.
+
+    Retorna um dict de arrays NumPy alinhados (um elemento por produto) mais a lista
+    ``produtos`` com (id, nome, codigo, categoria, unidade)."""
+    agora = datetime.utcnow()
+    inicio = agora - timedelta(days=janela)
+
+    produtos = connection.execute(
+        select(Produto.id, Produto.nome, Produto.codigo, Produto.categoria, Produto.unidade,
+               func.coalesce(Produto.estoque, 0), func.coalesce(Produto.estoque_minimo, 0), Produto.data_criacao)
+        .where(Produto.ativo == True)
+        .order_by(Produto.id)
+    ).all()
+    ids = np.array([row[0] for row in produtos], dtype=np.int64)
+    estoque = np.array([row[5] for row in produtos], dtype=np.float64)
+    estoque_minimo = np.array([row[6] for row in produtos], dtype=np.int64)
+    # Produtos criados dentro da janela: a média considera só os dias desde a criação
+    dias = np.array([
+        min(janela, max(1, (agora - row[7]).days)) if row[7] else janela for row in produtos
+    ], dtype=np.float64)
+
+    if fonte == 'consumo':
+        somas = _somas_consumo(connection, inicio)
+    else:
+        somas = _somas_movimentacoes(connection, inicio)
+    soma = np.zeros(len(ids))
+    soma_quadrados = np.zeros(len(ids))
+    if somas and len(ids):
+        dados = np.array(list(map(tuple, somas)), dtype=np.float64)
+        posicoes = np.searchsorted(ids, dados[:, 0].astype(np.int64))
+        validas = (posicoes < len(ids)) & (ids[np.minimum(posicoes, len(ids) - 1)] == dados[:, 0])
+        soma[posicoes[validas]] = dados[validas, 1]
+        soma_quadrados[posicoes[validas]] = dados[validas, 2]
+
+    if fonte == 'consumo':
+        # Série mensal: variância diária aproximada pela mensal / dias do mês (dias independentes)
+        meses = np.maximum(dias / DIAS_POR_MES, 1)
+        media_mensal = soma / meses
+        variancia = np.maximum(soma_quadrados / meses - media_mensal ** 2, 0) / DIAS_POR_MES
+        media = media_mensal / DIAS_POR_MES
+    else:
+        media = soma / dias
+        variancia = np.maximum(soma_quadrados / dias - media ** 2, 0)
+    desvio = np.sqrt(variancia)
+
+    z = NormalDist().inv_cdf(nivel_servico)
+    seguranca = z * desvio * math.sqrt(prazo)
+    ponto_reposicao = np.ceil(media * prazo + seguranca)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cobertura = np.where(media > 0, estoque / media, np.inf)
+    repor = (media > 0) & (estoque <= ponto_reposicao)
+    sugerida = np.where(repor, np.ceil(np.maximum(ponto_reposicao + media * ciclo - estoque, 0)), 0)
+
+    return {
+        'produtos': [tuple(row[:5]) for row in produtos],
+        'ids': ids,
+        'estoque': estoque.astype(np.int64),
+        'estoque_minimo': estoque_minimo,
+        'media': media,
+        'desvio': desvio,
+        'cobertura': cobertura,
+        'ponto_reposicao': ponto_reposicao.astype(np.int64),
+        'sugerida': sugerida.astype(np.int64),
+        'repor': repor,
+        'calculado_em': agora
+    }
+
+
+def tamanho_resultado(resultado):
+    """Estimativa em bytes do resultado, para o limite de memória do cache"""
+    arrays = sum(valor.nbytes for valor in resultado.values() if hasattr(valor, 'nbytes'))
+    return arrays + 200 * len(resultado['produtos'])
@@ -0,0 +1,79 @@
+import json
+from sqlalchemy import select
+
+
+def iso(valor):
+    return valor.isoformat() if valor is not None else None
+
+
+def json_lista(valor):
+    if not valor:
+        return []
+    try:
+        return json.loads(valor)
+    except (TypeError, ValueError):
+        return []
+
+
+def json_objeto(valor):
+    if not valor:
+        return {}
+    try:
+        return json.loads(valor)
+    except (TypeError, ValueError):
+        return {}
+
+
+class Serializador:
+    """Serializador pré-compilado de linhas Core (tuplas) para o formato JSON de to_dict().
+
+    ``campos`` é uma lista de (chave JSON, nomes das colunas, conversor). Sem conversor o valor
+    da coluna é usado diretamente; com conversor ele recebe os valores das colunas na ordem
+    informada. A função gerada acessa as posições da tupla diretamente, sem instanciar objetos
+    do ORM, e as colunas ficam em ``colunas`` na mesma ordem usada por ela.
+    """
+
+    __slots__ = ('model', 'campos', 'chaves', 'colunas', 'serializar', '_projecoes')
+
+    def __init__(self, model, campos):
+        self.model = model
+        self.campos = list(campos)
+        self.chaves = [chave for chave, _, _ in self.campos]
+        self._projecoes = {}
+
+        nomes = []
+        for _, colunas, _ in self.campos:
+            for nome in colunas:
+                if nome not in nomes:
+                    nomes.append(nome)
+        self.colunas = [getattr(model, nome) for nome in nomes]
+
+        namespace = {}
+        itens = []
+        for i, (chave, colunas, conversor) in enumerate(self.campos):
+            argumentos = ', '.join(f'row[{nomes.index(nome)}]' for nome in colunas)
+            if conversor is None:
+                itens.append(f'{chave!r}: {argumentos}')
+            else:
+                namespace[f'_conversor_{i}'] = conversor
+                itens.append(f'{chave!r}: _conversor_{i}({argumentos})')
+        codigo = 'def serializar(row):\n    return {' + ', '.join(itens) + '}\n'
+        exec(compile(codigo, f'<serializador {model.__name__}>', 'exec'), namespace)
+        self.serializar = namespace['serializar']
+
+    def select(self, *extras):
+        """select() das colunas do serializador seguidas de colunas extras (chaves de cursor, joins)"""
+        return select(*self.colunas, *extras)
+
+    def projetar(self, chaves):
+        """Serializador só com as chaves pedidas, na ordem de to_dict() (mantido em cache)"""
+        chaves = tuple(chave for chave in self.chaves if chave in set(chaves))
+        if chaves not in self._projecoes:
+            self._projecoes[chaves] = Serializador(
+                self.model, [campo for campo in self.campos if campo[0] in chaves]
+            )
+        return self._projecoes[chaves]
+
+    def lista(self, rows):
+        serializar = self.serializar
+        return [serializar(row) for row in rows]
@@ -1,6 +1,12 @@
 from src.models.user import db
+from src.models.serializacao import Serializador, iso, json_lista, json_objeto
+from sqlalchemy import event, func, select, union_all
+from sqlalchemy.orm import Session
 from datetime import datetime
 import json
+import os
+import threading
+import time
 
 class HistoricoAcesso(db.Model):
     __tablename__ = 'historico_acesso'
@@ -42,22 +48,26 @@ class HistoricoAcesso(db.Model):
     
     def _calcular_tempo_relativo(self):
         """Calcula o tempo relativo da ação"""
-        if not self.data_acao:
-            return 'Desconhecido'
-        
-        agora = datetime.utcnow()
-        diferenca = agora - self.data_acao
-        
-        if diferenca.days > 0:
-            return f'Há {diferenca.days} dia{"s" if diferenca.days > 1 else ""}'
-        elif diferenca.seconds > 3600:
-            horas = diferenca.seconds // 3600
-            return f'Há {horas} hora{"s" if horas > 1 else ""}'
-        elif diferenca.seconds > 60:
-            minutos = diferenca.seconds // 60
-            return f'Há {minutos} minuto{"s" if minutos > 1 else ""}'
-        else:
-            return 'Agora mesmo'
+        return calcular_tempo_relativo(self.data_acao)
+
+def calcular_tempo_relativo(data_acao):
+    """Calcula o tempo relativo de uma data em relação a agora"""
+    if not data_acao:
+        return 'Desconhecido'
+    
+    agora = datetime.utcnow()
+    diferenca = agora - data_acao
+    
+    if diferenca.days > 0:
+        return f'Há {diferenca.days} dia{"s" if diferenca.days > 1 else ""}'
+    elif diferenca.seconds > 3600:
+        horas = diferenca.seconds // 3600
+        return f'Há {horas} hora{"s" if horas > 1 else ""}'
+    elif diferenca.seconds > 60:
+        minutos = diferenca.seconds // 60
+        return f'Há {minutos} minuto{"s" if minutos > 1 else ""}'
+    else:
+        return 'Agora mesmo'
 
 class ConfiguracaoSistema(db.Model):
     __tablename__ = 'configuracoes_sistema'
@@ -73,21 +83,7 @@ class ConfiguracaoSistema(db.Model):
     data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def to_dict(self):
-        valor_processado = self.valor
-        
-        # Processar valor baseado no tipo
-        if self.tipo == 'number':
-            try:
-                valor_processado = float(self.valor) if '.' in str(self.valor) else int(self.valor)
-            except:
-                valor_processado = 0
-        elif self.tipo == 'boolean':
-            valor_processado = str(self.valor).lower() in ['true', '1', 'yes', 'sim']
-        elif self.tipo == 'json':
-            try:
-                valor_processado = json.loads(self.valor)
-            except:
-                valor_processado = {}
+        valor_processado = processar_valor_configuracao(self.valor, self.tipo)
         
         return {
             'id': self.id,
@@ -101,6 +97,26 @@ class ConfiguracaoSistema(db.Model):
             'dataAtualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None
         }
 
+def processar_valor_configuracao(valor, tipo):
+    """Converte o valor armazenado como texto de acordo com o tipo da configuração"""
+    valor_processado = valor
+    
+    # Processar valor baseado no tipo
+    if tipo == 'number':
+        try:
+            valor_processado = float(valor) if '.' in str(valor) else int(valor)
+        except:
+            valor_processado = 0
+    elif tipo == 'boolean':
+        valor_processado = str(valor).lower() in ['true', '1', 'yes', 'sim']
+    elif tipo == 'json':
+        try:
+            valor_processado = json.loads(valor)
+        except:
+            valor_processado = {}
+    
+    return valor_processado
+
 class Feed(db.Model):
     __tablename__ = 'feed'
     
@@ -174,3 +190,269 @@ class ComentarioFeed(db.Model):
             'dataComentario': self.data_comentario.isoformat() if self.data_comentario else None
         }
 
+
+class GeracaoColecao(db.Model):
+    __tablename__ = 'geracoes_colecao'
+    
+    nome = db.Column(db.String(100), primary_key=True)  # 'produtos', 'obras', 'movimentacoes_estoque'
+    geracao = db.Column(db.Integer, nullable=False, default=0)
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'nome': self.nome,
+            'geracao': self.geracao,
+            'dataAtualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None
+        }
+
+class IncrementoGeracao(db.Model):
+    __tablename__ = 'incrementos_geracao'
+    
+    # Uma linha por coleção alterada em cada transação, gravada na própria transação da
+    # escrita (só inserts: não trava a linha de geracoes_colecao). A geração de uma coleção é
+    # geracoes_colecao.geracao mais a contagem destas linhas; consolidar_geracoes() as soma
+    # periodicamente à tabela de gerações.
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_incrementos_geracao_nome', nome),
+    )
+
+class ChaveIdempotencia(db.Model):
+    __tablename__ = 'chaves_idempotencia'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(255), nullable=False)  # Cabeçalho Idempotency-Key
+    endpoint = db.Column(db.String(300), nullable=False)  # Caminho da requisição
+    impressao = db.Column(db.String(64), nullable=False)  # SHA-256 do corpo da requisição
+    status = db.Column(db.String(20), default='processando')  # 'processando', 'efetivada', 'concluida'
+    status_code = db.Column(db.Integer)
+    resposta = db.Column(db.Text)
+    mimetype = db.Column(db.String(100))
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
+    reservada_em = db.Column(db.DateTime)  # Início da execução atual (reserva com prazo)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+    
+    __table_args__ = (
+        db.UniqueConstraint('chave', 'endpoint', name='uq_chaves_idempotencia_chave_endpoint'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'chave': self.chave,
+            'endpoint': self.endpoint,
+            'status': self.status,
+            'statusCode': self.status_code,
+            'dataCriacao': self.data_criacao.isoformat() if self.data_criacao else None,
+            'expiraEm': self.expira_em.isoformat() if self.expira_em else None
+        }
+
+# Serializadores de linhas Core no mesmo formato de to_dict()
+SERIALIZADOR_HISTORICO = Serializador(HistoricoAcesso, [
+    ('id', ('id',), None),
+    ('usuario', ('usuario',), None),
+    ('acao', ('acao',), None),
+    ('entidade', ('entidade',), None),
+    ('entidadeId', ('entidade_id',), None),
+    ('descricao', ('descricao',), None),
+    ('detalhes', ('detalhes',), json_objeto),
+    ('status', ('status',), None),
+    ('ipAddress', ('ip_address',), None),
+    ('userAgent', ('user_agent',), None),
+    ('dataAcao', ('data_acao',), iso),
+    ('tempo', ('data_acao',), calcular_tempo_relativo)
+])
+
+SERIALIZADOR_CONFIGURACAO = Serializador(ConfiguracaoSistema, [
+    ('id', ('id',), None),
+    ('chave', ('chave',), None),
+    ('valor', ('valor', 'tipo'), processar_valor_configuracao),
+    ('tipo', ('tipo',), None),
+    ('descricao', ('descricao',), None),
+    ('categoria', ('categoria',), None),
+    ('editavel', ('editavel',), None),
+    ('dataCriacao', ('data_criacao',), iso),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+# Sem obra e comentários aninhados: a listagem do feed os junta em consultas separadas
+SERIALIZADOR_FEED = Serializador(Feed, [
+    ('id', ('id',), None),
+    ('usuario', ('usuario',), None),
+    ('titulo', ('titulo',), None),
+    ('conteudo', ('conteudo',), None),
+    ('tipo', ('tipo',), None),
+    ('obraId', ('obra_id',), None),
+    ('imagens', ('imagens',), json_lista),
+    ('tags', ('tags',), json_lista),
+    ('curtidas', ('curtidas',), None),
+    ('comentariosCount', ('comentarios_count',), None),
+    ('publico', ('publico',), None),
+    ('dataPublicacao', ('data_publicacao',), iso),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+SERIALIZADOR_COMENTARIO = Serializador(ComentarioFeed, [
+    ('id', ('id',), None),
+    ('feedId', ('feed_id',), None),
+    ('usuario', ('usuario',), None),
+    ('conteudo', ('conteudo',), None),
+    ('dataComentario', ('data_comentario',), iso)
+])
+
+SERIALIZADOR_GERACAO = Serializador(GeracaoColecao, [
+    ('nome', ('nome',), None),
+    ('geracao', ('geracao',), None),
+    ('dataAtualizacao', ('data_atualizacao',), iso)
+])
+
+# Coleções da API cujo conteúdo muda quando cada tabela é escrita
+COLECOES_POR_TABELA = {
+    'produtos': ('produtos', 'movimentacoes_estoque'),
+    'movimentacoes_estoque': ('movimentacoes_estoque',),
+    'consumo_mensal': ('movimentacoes_estoque',),
+    'obras': ('obras',),
+    'etapas': ('obras',),
+    'mobiliario': ('obras',)
+}
+
+COLECOES = sorted({colecao for colecoes in COLECOES_POR_TABELA.values() for colecao in colecoes})
+
+def garantir_geracoes():
+    """Cria as linhas de geração que ainda não existem (chamado na inicialização)"""
+    existentes = {nome for (nome,) in db.session.query(GeracaoColecao.nome).all()}
+    for nome in COLECOES:
+        if nome not in existentes:
+            db.session.add(GeracaoColecao(nome=nome, geracao=0))
+    db.session.commit()
+
+def registrar_incrementos(session, colecoes):
+    """Grava na transação da sessão um incremento para cada coleção ainda não registrada
+    nesta transação; a nova geração fica visível junto com os dados, no commit"""
+    registradas = session.info.setdefault('colecoes_registradas', set())
+    novas = sorted(set(colecoes) - registradas)
+    if not novas:
+        return
+    agora = datetime.utcnow()
+    session.connection().execute(
+        IncrementoGeracao.__table__.insert(), [{'nome': nome, 'data_criacao': agora} for nome in novas]
+    )
+    registradas.update(novas)
+
+def consolidar_geracoes(connection):
+    """Soma às gerações os incrementos pendentes e os apaga na mesma transação (DELETE ...
+    RETURNING: incrementos confirmados durante a consolidação ficam para a próxima).
+    Retorna a quantidade consolidada."""
+    incrementos = IncrementoGeracao.__table__
+    tabela = GeracaoColecao.__table__
+    linhas = connection.execute(
+        incrementos.delete().returning(incrementos.c.nome, incrementos.c.data_criacao)
+    ).all()
+    somas = {}
+    for nome, data_criacao in linhas:
+        quantidade, data = somas.get(nome, (0, data_criacao))
+        somas[nome] = (quantidade + 1, max(data, data_criacao))
+    # Ordem fixa para que consolidações concorrentes travem as linhas na mesma sequência
+    for nome in sorted(somas):
+        quantidade, data = somas[nome]
+        result = connection.execute(
+            tabela.update()
+            .where(tabela.c.nome == nome)
+            .values(geracao=tabela.c.geracao + quantidade,
+                    data_atualizacao=db.case((tabela.c.data_atualizacao > data, tabela.c.data_atualizacao), else_=data))
+        )
+        if result.rowcount == 0:
+            connection.execute(tabela.insert().values(nome=nome, geracao=quantidade, data_atualizacao=data))
+    return len(linhas)
+
+GERACOES_CONSOLIDACAO_SEGUNDOS = float(os.environ.get('GERACOES_CONSOLIDACAO_SEGUNDOS', '60'))
+
+def manter_geracoes():
+    """Tarefa periódica: consolida os incrementos de geração pendentes"""
+    consolidar_geracoes(db.session.connection())
+    db.session.commit()
+
+def colecoes_das_tabelas(tabelas):
+    return {colecao for tabela in tabelas for colecao in COLECOES_POR_TABELA.get(tabela, ())}
+
+def marcar_tabelas_alteradas(session, *tabelas):
+    """Registra as coleções alteradas por escritas feitas fora do ORM (update/insert em massa),
+    na transação da sessão"""
+    colecoes = colecoes_das_tabelas(tabelas)
+    if colecoes:
+        registrar_incrementos(session, colecoes)
+
+# Gerações lidas por este processo: {nome: (geracao, data_atualizacao, lido_em)}.
+# Cada worker relê a tabela no máximo uma vez por janela, então outros workers enxergam
+# escritas com atraso máximo de CACHE_JANELA_SEGUNDOS; escritas do próprio worker
+# invalidam a leitura imediatamente após o commit.
+JANELA_GERACOES = float(os.environ.get('CACHE_JANELA_SEGUNDOS', '1'))
+_geracoes_lidas = {}
+_geracoes_lock = threading.Lock()
+
+def obter_geracoes(colecoes, janela=None):
+    """Retorna {nome: (geracao, data_atualizacao)} sem carregar as linhas das coleções"""
+    janela = JANELA_GERACOES if janela is None else janela
+    agora = time.monotonic()
+    with _geracoes_lock:
+        lidas = {nome: _geracoes_lidas.get(nome) for nome in colecoes}
+    
+    vencidas = [nome for nome, lida in lidas.items() if lida is None or agora - lida[2] >= janela]
+    if vencidas:
+        # Geração consolidada mais incrementos pendentes numa única consulta (mesmo snapshot),
+        # para que uma consolidação concorrente não faça a geração voltar atrás
+        geracoes = GeracaoColecao.__table__
+        incrementos = IncrementoGeracao.__table__
+        uniao = union_all(
+            select(geracoes.c.nome, geracoes.c.geracao.label('geracao'), geracoes.c.data_atualizacao.label('data'))
+            .where(geracoes.c.nome.in_(vencidas)),
+            select(incrementos.c.nome, func.count().label('geracao'), func.max(incrementos.c.data_criacao).label('data'))
+            .where(incrementos.c.nome.in_(vencidas)).group_by(incrementos.c.nome)
+        ).subquery('uniao')
+        rows = db.session.execute(
+            select(uniao.c.nome, func.sum(uniao.c.geracao), func.max(uniao.c.data)).group_by(uniao.c.nome)
+        ).all()
+        encontradas = {nome: (int(geracao), data_atualizacao, agora) for nome, geracao, data_atualizacao in rows}
+        for nome in vencidas:
+            lidas[nome] = encontradas.get(nome, (0, None, agora))
+        with _geracoes_lock:
+            _geracoes_lidas.update({nome: lidas[nome] for nome in vencidas})
+    
+    return {nome: (geracao, data_atualizacao) for nome, (geracao, data_atualizacao, _) in lidas.items()}
+
+def esquecer_geracoes(colecoes=None):
+    """Força a releitura das gerações informadas (ou de todas) na próxima consulta"""
+    with _geracoes_lock:
+        if colecoes is None:
+            _geracoes_lidas.clear()
+        for nome in colecoes or ():
+            _geracoes_lidas.pop(nome, None)
+
+@event.listens_for(Session, 'before_flush')
+def _registrar_colecoes_alteradas(session, flush_context, instances):
+    objetos = list(session.new) + list(session.deleted)
+    objetos += [obj for obj in session.dirty if session.is_modified(obj)]
+    tabelas = {getattr(obj, '__tablename__', None) for obj in objetos}
+    session.info.setdefault('colecoes_alteradas', set()).update(colecoes_das_tabelas(tabelas))
+
+# Os incrementos são gravados na transação da escrita (insert-only, sem travar a linha da
+# coleção): a nova geração é confirmada junto com os dados ou descartada com eles.
+@event.listens_for(Session, 'after_flush')
+def _incrementar_geracoes_alteradas(session, flush_context):
+    alteradas = session.info.pop('colecoes_alteradas', None)
+    if alteradas:
+        registrar_incrementos(session, alteradas)
+
+@event.listens_for(Session, 'after_commit')
+def _esquecer_geracoes_confirmadas(session):
+    confirmadas = session.info.pop('colecoes_registradas', None)
+    if confirmadas:
+        esquecer_geracoes(confirmadas)
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_colecoes_alteradas(session):
+    session.info.pop('colecoes_alteradas', None)
+    session.info.pop('colecoes_registradas', None)
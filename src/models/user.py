@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from src.models.serializacao import Serializador
 
 db = SQLAlchemy()
 
@@ -16,3 +17,9 @@ class User(db.Model):
             'username': self.username,
             'email': self.email
         }
+
+SERIALIZADOR_USER = Serializador(User, [
+    ('id', ('id',), None),
+    ('username', ('username',), None),
+    ('email', ('email',), None)
+])
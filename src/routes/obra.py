@@ -1,6 +1,12 @@
 from flask import Blueprint, request, jsonify
 from src.models.user import db
-from src.models.obra import Obra, Etapa, Mobiliario, Lixeira
+from src.models.obra import Obra, Etapa, Mobiliario, Lixeira, serializar_obras
+from src.models.obra import SERIALIZADOR_ETAPA, SERIALIZADOR_MOBILIARIO, SERIALIZADOR_LIXEIRA, custos_obra
+from src.models.produto import MovimentacaoEstoque
+from src.models.sistema import marcar_tabelas_alteradas
+from src.utils.http_cache import condicional
+from src.utils.idempotencia import idempotente
+from sqlalchemy import update
 from datetime import datetime, date
 import json
 
@@ -10,8 +16,9 @@ obra_bp = Blueprint('obra', __name__)
 @obra_bp.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,If-None-Match,If-Modified-Since,Idempotency-Key')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,Last-Modified')
     return response
 
 @obra_bp.route('/obras', methods=['OPTIONS'])
@@ -20,14 +27,16 @@ def handle_options():
 
 # OBRAS CRUD
 @obra_bp.route('/obras', methods=['GET'])
+@condicional('obras')
 def get_obras():
     try:
-        obras = Obra.query.all()
-        return jsonify([obra.to_dict() for obra in obras]), 200
+        obras = serializar_obras()
+        return jsonify(list(obras.values())), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @obra_bp.route('/obras', methods=['POST'])
+@idempotente
 def create_obra():
     try:
         data = request.get_json()
@@ -97,6 +106,14 @@ def update_obra(obra_id):
 def delete_obra(obra_id):
     try:
         obra = Obra.query.get_or_404(obra_id)
+        # ON DELETE SET NULL explícito: o SQLite não aplica as chaves estrangeiras
+        db.session.execute(
+            update(MovimentacaoEstoque)
+            .where(MovimentacaoEstoque.obra_id == obra_id)
+            .values(obra_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        marcar_tabelas_alteradas(db.session, MovimentacaoEstoque.__tablename__)
         db.session.delete(obra)
         db.session.commit()
         
@@ -105,12 +122,54 @@ def delete_obra(obra_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@obra_bp.route('/obras/<int:obra_id>/custos', methods=['GET'])
+@condicional('obras', 'produtos', 'movimentacoes_estoque')
+def get_custos_obra(obra_id):
+    """Materiais dispensados para a obra e o valor a preço atual, agrupados por produto"""
+    try:
+        obra = db.session.get(Obra, obra_id)
+        if obra is None:
+            return jsonify({'error': 'Obra não encontrada'}), 404
+        
+        materiais = []
+        total_quantidade = 0
+        total_valor = 0.0
+        for row in custos_obra(db.session.connection(), obra_id):
+            valor = row.quantidade * row.preco
+            materiais.append({
+                'produtoId': row.id,
+                'nome': row.nome,
+                'codigo': row.codigo,
+                'categoria': row.categoria,
+                'unidade': row.unidade,
+                'quantidade': row.quantidade,
+                'dispensacoes': row.dispensacoes,
+                'precoUnitario': row.preco,
+                'valorTotal': round(valor, 2)
+            })
+            total_quantidade += row.quantidade
+            total_valor += valor
+        
+        return jsonify({
+            'obra': {'id': obra.id, 'nome': obra.nome, 'valor': obra.valor},
+            'materiais': materiais,
+            'total': {
+                'produtos': len(materiais),
+                'quantidade': total_quantidade,
+                'valor': round(total_valor, 2)
+            }
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ETAPAS CRUD
 @obra_bp.route('/obras/<int:obra_id>/etapas', methods=['GET'])
 def get_etapas(obra_id):
     try:
-        etapas = Etapa.query.filter_by(obra_id=obra_id, deletado=False).all()
-        return jsonify([etapa.to_dict() for etapa in etapas]), 200
+        rows = db.session.execute(
+            SERIALIZADOR_ETAPA.select().where(Etapa.obra_id == obra_id, Etapa.deletado == False)
+        )
+        return jsonify(SERIALIZADOR_ETAPA.lista(rows)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -233,8 +292,18 @@ def permanent_delete_etapa(etapa_id):
 @obra_bp.route('/lixeira', methods=['GET'])
 def get_lixeira():
     try:
-        lixeira_items = Lixeira.query.all()
-        return jsonify([item.to_dict() for item in lixeira_items]), 200
+        itens = SERIALIZADOR_LIXEIRA.lista(db.session.execute(SERIALIZADOR_LIXEIRA.select()))
+        
+        # Etapas das entradas da lixeira numa única consulta
+        etapa_ids = {item['etapaId'] for item in itens}
+        etapas = {}
+        if etapa_ids:
+            rows = db.session.execute(SERIALIZADOR_ETAPA.select().where(Etapa.id.in_(etapa_ids)))
+            etapas = {etapa['id']: etapa for etapa in SERIALIZADOR_ETAPA.lista(rows)}
+        for item in itens:
+            item['etapa'] = etapas.get(item['etapaId'])
+        
+        return jsonify(itens), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -260,8 +329,8 @@ def limpar_lixeira():
 @obra_bp.route('/obras/<int:obra_id>/mobiliario', methods=['GET'])
 def get_mobiliario(obra_id):
     try:
-        mobiliario = Mobiliario.query.filter_by(obra_id=obra_id).all()
-        return jsonify([mob.to_dict() for mob in mobiliario]), 200
+        rows = db.session.execute(SERIALIZADOR_MOBILIARIO.select().where(Mobiliario.obra_id == obra_id))
+        return jsonify(SERIALIZADOR_MOBILIARIO.lista(rows)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1,25 +1,46 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from src.models.user import db
-from src.models.produto import Produto, MovimentacaoEstoque, Categoria
-from datetime import datetime
+from src.models.produto import Produto, MovimentacaoEstoque, Categoria, SERIALIZADOR_PRODUTO, SERIALIZADOR_MOVIMENTACAO, SERIALIZADOR_RESUMO
+from src.models.produto import ConsumoMensal, aplicar_delta_resumo, aplicar_delta_consumo, ajustar_snapshots, delta_consumo, estoque_em, resumo_estoque
+from src.models.obra import Obra, obra_por_local
+from src.models.busca import buscar_produtos
+from src.models.importacao import ImportacaoPlanilha, confirmar_previa, criar_importacao, criar_previa, gravar_importacao, montar_previa
+from src.models.importacao import processar_importacao, retomar_importacao
+from src.models.reposicao import REPOSICAO_CACHE_SEGUNDOS, calcular_reposicao, tamanho_resultado
+from src.models.sistema import marcar_tabelas_alteradas
+from src.utils.cache import CacheLRU, cache_resposta
+from src.utils.http_cache import condicional
+from src.utils.idempotencia import idempotente
+from src.utils.paginacao import parse_limite, parse_bool, encode_cursor, decode_cursor
+from src.utils.exportacao import csv_por_copy, csv_por_lotes, xlsx_temporario, ler_e_remover
+from src.utils.importacao import COLUNAS_OBRIGATORIAS_PRODUTO, gravar_produtos, importar_movimentacoes, validar_planilha_produtos
+from src.utils.planilha import Planilha, extensao_planilha
+from sqlalchemy import select, insert, update, tuple_, case, func, or_
+from datetime import datetime, timedelta
 import json
-import csv
-import io
 import os
+import time
 try:
     import openpyxl
     EXCEL_SUPPORT = True
 except ImportError:
     EXCEL_SUPPORT = False
 
+try:
+    import numpy as np
+    NUMPY_SUPPORT = True
+except ImportError:
+    NUMPY_SUPPORT = False
+
 produto_bp = Blueprint('produto', __name__)
 
 # CORS headers
 @produto_bp.after_request
 def after_request(response):
     response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,If-None-Match,If-Modified-Since,Idempotency-Key')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+    response.headers.add('Access-Control-Expose-Headers', 'ETag,Last-Modified')
     return response
 
 @produto_bp.route('/produtos', methods=['OPTIONS'])
@@ -27,15 +48,466 @@ def handle_options():
     return '', 200
 
 # PRODUTOS CRUD
+def _parse_campos(valor):
+    """Valida o parâmetro fields= e retorna o serializador projetado com os campos pedidos"""
+    if not valor:
+        return SERIALIZADOR_PRODUTO
+    campos = [campo.strip() for campo in valor.split(',') if campo.strip()]
+    invalidos = [campo for campo in campos if campo not in SERIALIZADOR_PRODUTO.chaves]
+    if invalidos:
+        raise ValueError(f'Campos inválidos: {", ".join(invalidos)}')
+    return SERIALIZADOR_PRODUTO.projetar(campos)
+
 @produto_bp.route('/produtos', methods=['GET'])
+@condicional('produtos')
+@cache_resposta('produtos')
 def get_produtos():
+    """Lista produtos ativos paginados por cursor (keyset).
+
+    Parâmetros: limit, cursor, ordem (nome|id), fields (lista separada por vírgula),
+    categoria, codigo (prefixo) e estoque_baixo. A listagem completa sem paginação
+    só é retornada com todos=true.
+    """
+    try:
+        ordem = request.args.get('ordem', 'nome')
+        if ordem not in ['nome', 'id']:
+            return jsonify({'error': 'Parâmetro ordem deve ser nome ou id'}), 400
+        
+        serializador = _parse_campos(request.args.get('fields'))
+        todos = parse_bool(request.args.get('todos'))
+        limite = parse_limite(request.args.get('limit'))
+        
+        chave = [Produto.nome, Produto.id] if ordem == 'nome' else [Produto.id]
+        
+        # Apenas as colunas dos campos pedidos, seguidas das colunas da chave do cursor
+        query = serializador.select(*chave).where(Produto.ativo == True)
+        
+        categoria = request.args.get('categoria')
+        if categoria:
+            query = query.where(Produto.categoria == categoria)
+        
+        codigo = request.args.get('codigo')
+        if codigo:
+            query = query.where(Produto.codigo.startswith(codigo, autoescape=True))
+        
+        if parse_bool(request.args.get('estoque_baixo')):
+            query = query.where(Produto.estoque <= Produto.estoque_minimo)
+        
+        if not todos:
+            cursor = request.args.get('cursor')
+            if cursor:
+                valores = decode_cursor(cursor, len(chave))
+                if ordem == 'nome':
+                    query = query.where(tuple_(Produto.nome, Produto.id) > tuple_(str(valores[0]), int(valores[1])))
+                else:
+                    query = query.where(Produto.id > int(valores[0]))
+            query = query.limit(limite + 1)
+        
+        rows = db.session.execute(query.order_by(*chave)).all()
+        
+        if todos:
+            return jsonify(serializador.lista(rows)), 200
+        
+        proximo_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            proximo_cursor = encode_cursor(list(rows[-1][-len(chave):]))
+        
+        return jsonify({
+            'items': serializador.lista(rows),
+            'nextCursor': proximo_cursor,
+            'limit': limite
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@produto_bp.route('/produtos/<int:produto_id>', methods=['GET'])
+@condicional('produtos')
+@cache_resposta('produtos')
+def get_produto(produto_id):
+    try:
+        row = db.session.execute(SERIALIZADOR_PRODUTO.select().where(Produto.id == produto_id)).first()
+        if row is None:
+            return jsonify({'error': 'Produto não encontrado'}), 404
+        return jsonify(SERIALIZADOR_PRODUTO.serializar(row)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ALERTAS DE ESTOQUE BAIXO
+# Mesmo predicado do índice parcial ix_produtos_alerta_estoque, para que o banco o utilize
+FILTRO_ALERTA = (Produto.ativo == True, Produto.estoque <= Produto.estoque_minimo)
+DEFICIT_ALERTA = Produto.estoque - Produto.estoque_minimo
+SEVERIDADE_ALERTA = case(
+    (Produto.estoque <= 0, 'esgotado'),
+    (Produto.estoque * 2 <= Produto.estoque_minimo, 'critico'),
+    else_='baixo'
+)
+SEVERIDADES = ['esgotado', 'critico', 'baixo']
+
+@produto_bp.route('/produtos/alertas', methods=['GET'])
+@condicional('produtos')
+def get_alertas_estoque():
+    """Produtos com estoque <= estoque_minimo, classificados em esgotado, critico e baixo.
+
+    Com contagem=true retorna apenas os totais por severidade. Caso contrário lista os
+    produtos do mais ao menos crítico, paginados por cursor (limit, cursor), com filtros
+    opcionais severidade e categoria.
+    """
+    try:
+        categoria = request.args.get('categoria')
+        severidade = request.args.get('severidade')
+        if severidade and severidade not in SEVERIDADES:
+            return jsonify({'error': f'Severidade deve ser uma de: {", ".join(SEVERIDADES)}'}), 400
+        
+        filtros = list(FILTRO_ALERTA)
+        if categoria:
+            filtros.append(Produto.categoria == categoria)
+        
+        if parse_bool(request.args.get('contagem')):
+            rows = db.session.execute(
+                select(SEVERIDADE_ALERTA, func.count()).where(*filtros).group_by(SEVERIDADE_ALERTA)
+            ).all()
+            contagem = {nome: 0 for nome in SEVERIDADES}
+            contagem.update({nome: total for nome, total in rows})
+            contagem['total'] = sum(contagem[nome] for nome in SEVERIDADES)
+            return jsonify(contagem), 200
+        
+        if severidade:
+            filtros.append(SEVERIDADE_ALERTA == severidade)
+        
+        limite = parse_limite(request.args.get('limit'))
+        query = select(
+            Produto.id, Produto.nome, Produto.codigo, Produto.categoria, Produto.estoque,
+            Produto.estoque_minimo, Produto.unidade, DEFICIT_ALERTA.label('deficit'),
+            SEVERIDADE_ALERTA.label('severidade')
+        ).where(*filtros)
+        
+        cursor = request.args.get('cursor')
+        if cursor:
+            valores = decode_cursor(cursor, 2)
+            query = query.where(tuple_(DEFICIT_ALERTA, Produto.id) > tuple_(int(valores[0]), int(valores[1])))
+        
+        rows = db.session.execute(query.order_by(DEFICIT_ALERTA, Produto.id).limit(limite + 1)).all()
+        
+        proximo_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            proximo_cursor = encode_cursor([rows[-1].deficit, rows[-1].id])
+        
+        return jsonify({
+            'items': [{
+                'id': row.id,
+                'nome': row.nome,
+                'codigo': row.codigo,
+                'categoria': row.categoria,
+                'estoque': row.estoque,
+                'estoqueMinimo': row.estoque_minimo,
+                'unidade': row.unidade,
+                'severidade': row.severidade
+            } for row in rows],
+            'nextCursor': proximo_cursor,
+            'limit': limite
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# BUSCA DE PRODUTOS
+@produto_bp.route('/produtos/search', methods=['GET'])
+@condicional('produtos')
+def search_produtos():
+    """Busca por nome, código e descrição, sem acentos, por prefixo e ordenada por relevância"""
+    try:
+        q = request.args.get('q', '').strip()
+        if not q:
+            return jsonify({'error': 'Parâmetro q é obrigatório'}), 400
+        limite = parse_limite(request.args.get('limit'), padrao=20, maximo=100)
+        
+        rows = buscar_produtos(q, limite, indexada=current_app.config.get('BUSCA_INDEXADA', False))
+        
+        return jsonify({
+            'q': q,
+            'items': [{
+                'id': row.id,
+                'nome': row.nome,
+                'codigo': row.codigo,
+                'categoria': row.categoria,
+                'estoque': row.estoque,
+                'unidade': row.unidade,
+                'preco': row.preco,
+                'relevancia': float(row.rank)
+            } for row in rows]
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# RESUMO DO VALOR EM ESTOQUE
+@produto_bp.route('/produtos/resumo', methods=['GET'])
+@condicional('produtos')
+def get_resumo_estoque():
+    """Valor e unidades em estoque por categoria e no total, lidos da tabela de resumo
+    (mais os deltas ainda não consolidados)"""
+    try:
+        categorias = [SERIALIZADOR_RESUMO.serializar(row) for row in resumo_estoque(db.session.connection())]
+        
+        return jsonify({
+            'categorias': categorias,
+            'total': {
+                'produtos': sum(categoria['produtos'] for categoria in categorias),
+                'unidades': sum(categoria['unidades'] for categoria in categorias),
+                'valorTotal': round(sum(categoria['valorTotal'] for categoria in categorias), 2)
+            }
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# ESTOQUE EM UMA DATA PASSADA
+def _parse_momento(valor):
+    """YYYY-MM-DD (estoque ao fim do dia) ou data/hora ISO"""
+    if len(valor) == 10:
+        return datetime.strptime(valor, '%Y-%m-%d') + timedelta(days=1)
+    return datetime.fromisoformat(valor)
+
+@produto_bp.route('/produtos/estoque', methods=['GET'])
+@condicional('movimentacoes_estoque')
+@cache_resposta('movimentacoes_estoque')
+def get_estoque_em():
+    """Estoque de cada produto em uma data passada (em=YYYY-MM-DD, ao fim do dia, ou data/hora ISO),
+    calculado a partir do snapshot mais próximo mais as movimentações entre ele e a data.
+    Filtros opcionais categoria e produto_id."""
+    try:
+        em = request.args.get('em')
+        if not em:
+            return jsonify({'error': 'Parâmetro em é obrigatório (YYYY-MM-DD)'}), 400
+        momento = _parse_momento(em)
+        produto_id = request.args.get('produto_id')
+        
+        data_ancora, rows = estoque_em(
+            db.session.connection(), momento,
+            categoria=request.args.get('categoria'),
+            produto_id=int(produto_id) if produto_id else None
+        )
+        
+        return jsonify({
+            'em': momento.isoformat(),
+            'base': {
+                'tipo': 'snapshot' if data_ancora else 'atual',
+                'data': data_ancora.isoformat() if data_ancora else None
+            },
+            'items': [{
+                'id': row.id,
+                'nome': row.nome,
+                'codigo': row.codigo,
+                'categoria': row.categoria,
+                'unidade': row.unidade,
+                'estoque': row.estoque
+            } for row in rows]
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# CONSUMO MENSAL
+def _parse_mes(valor):
+    return datetime.strptime(valor, '%Y-%m').date()
+
+@produto_bp.route('/produtos/consumo', methods=['GET'])
+@condicional('movimentacoes_estoque')
+def get_consumo_mensal():
+    """Entradas e saídas por mês, lidas apenas da tabela consumo_mensal.
+
+    Filtros: produto_id, categoria, de e ate (YYYY-MM, inclusive). Por padrão retorna os
+    totais de cada mês; com por_produto=true retorna uma linha por produto e mês, paginada
+    por cursor (limit, cursor).
+    """
     try:
-        produtos = Produto.query.filter_by(ativo=True).all()
-        return jsonify([produto.to_dict() for produto in produtos]), 200
+        filtros = []
+        produto_id = request.args.get('produto_id')
+        if produto_id:
+            filtros.append(ConsumoMensal.produto_id == int(produto_id))
+        de = request.args.get('de')
+        if de:
+            filtros.append(ConsumoMensal.mes >= _parse_mes(de))
+        ate = request.args.get('ate')
+        if ate:
+            filtros.append(ConsumoMensal.mes <= _parse_mes(ate))
+        categoria = request.args.get('categoria')
+        if categoria:
+            filtros.append(ConsumoMensal.produto_id.in_(
+                select(Produto.id).where(Produto.categoria == categoria)
+            ))
+        
+        if not parse_bool(request.args.get('por_produto')):
+            rows = db.session.execute(
+                select(
+                    ConsumoMensal.mes,
+                    func.sum(ConsumoMensal.entradas).label('entradas'),
+                    func.sum(ConsumoMensal.saidas).label('saidas'),
+                    func.sum(ConsumoMensal.movimentacoes).label('movimentacoes')
+                ).where(*filtros).group_by(ConsumoMensal.mes).order_by(ConsumoMensal.mes)
+            ).all()
+            return jsonify({
+                'items': [{
+                    'mes': row.mes.strftime('%Y-%m'),
+                    'entradas': int(row.entradas),
+                    'saidas': int(row.saidas),
+                    'movimentacoes': int(row.movimentacoes)
+                } for row in rows]
+            }), 200
+        
+        limite = parse_limite(request.args.get('limit'))
+        query = select(
+            ConsumoMensal.produto_id, ConsumoMensal.mes, ConsumoMensal.entradas,
+            ConsumoMensal.saidas, ConsumoMensal.movimentacoes
+        ).where(*filtros)
+        
+        cursor = request.args.get('cursor')
+        if cursor:
+            mes_cursor, id_cursor = decode_cursor(cursor, 2)
+            query = query.where(tuple_(ConsumoMensal.mes, ConsumoMensal.produto_id) >
+                                tuple_(_parse_mes(mes_cursor), int(id_cursor)))
+        
+        rows = db.session.execute(
+            query.order_by(ConsumoMensal.mes, ConsumoMensal.produto_id).limit(limite + 1)
+        ).all()
+        
+        proximo_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            proximo_cursor = encode_cursor([rows[-1].mes.strftime('%Y-%m'), rows[-1].produto_id])
+        
+        return jsonify({
+            'items': [{
+                'produtoId': row.produto_id,
+                'mes': row.mes.strftime('%Y-%m'),
+                'entradas': row.entradas,
+                'saidas': row.saidas,
+                'movimentacoes': row.movimentacoes
+            } for row in rows],
+            'nextCursor': proximo_cursor,
+            'limit': limite
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# PONTO DE REPOSIÇÃO E DIAS DE COBERTURA
+cache_reposicao = CacheLRU(max_entradas=16)
+
+def _parametro_numerico(nome, padrao, minimo, maximo, tipo=int):
+    valor = request.args.get(nome)
+    try:
+        valor = tipo(valor) if valor not in (None, '') else padrao
+    except ValueError:
+        raise ValueError(f'Parâmetro {nome} deve ser numérico')
+    if not minimo <= valor <= maximo:
+        raise ValueError(f'Parâmetro {nome} deve estar entre {minimo} e {maximo}')
+    return valor
+
+@produto_bp.route('/produtos/reposicao', methods=['GET'])
+def get_reposicao():
+    """Ponto de reposição, dias de cobertura e quantidade sugerida dos produtos ativos.
+
+    Parâmetros do cálculo: janela (dias de histórico, padrão 365), prazo (dias de entrega,
+    padrão 7), ciclo (dias até a próxima revisão, padrão 30), nivel_servico (padrão 0.95) e
+    fonte (movimentacoes ou consumo). O cálculo de todo o catálogo fica em cache por
+    REPOSICAO_CACHE_SEGUNDOS. Filtros categoria e repor=true; lista do menor para o maior
+    número de dias de cobertura, paginada por cursor (limit, cursor).
+    """
+    try:
+        if not NUMPY_SUPPORT:
+            return jsonify({'error': 'Cálculo de reposição indisponível: instale o numpy'}), 400
+        janela = _parametro_numerico('janela', 365, 7, 1095)
+        prazo = _parametro_numerico('prazo', 7, 1, 365)
+        ciclo = _parametro_numerico('ciclo', 30, 0, 365)
+        nivel_servico = _parametro_numerico('nivel_servico', 0.95, 0.5, 0.999, float)
+        fonte = request.args.get('fonte', 'movimentacoes')
+        if fonte not in ('movimentacoes', 'consumo'):
+            return jsonify({'error': 'Fonte deve ser movimentacoes ou consumo'}), 400
+        limite = parse_limite(request.args.get('limit'))
+        
+        # REPOSICAO_CACHE_SEGUNDOS <= 0 desativa o cache
+        item = chave = None
+        if REPOSICAO_CACHE_SEGUNDOS > 0:
+            chave = (janela, prazo, ciclo, nivel_servico, fonte, int(time.time() // REPOSICAO_CACHE_SEGUNDOS))
+            item = cache_reposicao.get(chave)
+        if item is None:
+            resultado = calcular_reposicao(db.session.connection(), janela, prazo, ciclo, nivel_servico, fonte)
+            if chave is not None:
+                cache_reposicao.set(chave, resultado, tamanho_resultado(resultado))
+        else:
+            resultado = item[0]
+        
+        ids = resultado['ids']
+        cobertura = resultado['cobertura']
+        selecionados = np.ones(len(ids), dtype=bool)
+        categoria = request.args.get('categoria')
+        if categoria:
+            selecionados &= np.array([produto[3] == categoria for produto in resultado['produtos']], dtype=bool)
+        if parse_bool(request.args.get('repor')):
+            selecionados &= resultado['repor']
+        cursor = request.args.get('cursor')
+        if cursor:
+            cobertura_cursor, id_cursor = decode_cursor(cursor, 2)
+            cobertura_cursor = np.inf if cobertura_cursor is None else float(cobertura_cursor)
+            selecionados &= (cobertura > cobertura_cursor) | ((cobertura == cobertura_cursor) & (ids > int(id_cursor)))
+        
+        indices = np.flatnonzero(selecionados)
+        indices = indices[np.lexsort((ids[indices], cobertura[indices]))][:limite + 1]
+        proximo_cursor = None
+        if len(indices) > limite:
+            indices = indices[:limite]
+            ultimo = indices[-1]
+            proximo_cursor = encode_cursor([
+                None if np.isinf(cobertura[ultimo]) else float(cobertura[ultimo]), int(ids[ultimo])
+            ])
+        
+        items = []
+        for i in indices:
+            produto_id, nome, codigo, categoria_produto, unidade = resultado['produtos'][i]
+            items.append({
+                'id': produto_id,
+                'nome': nome,
+                'codigo': codigo,
+                'categoria': categoria_produto,
+                'unidade': unidade,
+                'estoque': int(resultado['estoque'][i]),
+                'estoqueMinimo': int(resultado['estoque_minimo'][i]),
+                'demandaMediaDiaria': round(float(resultado['media'][i]), 3),
+                'desvioDiario': round(float(resultado['desvio'][i]), 3),
+                'diasCobertura': None if np.isinf(cobertura[i]) else round(float(cobertura[i]), 1),
+                'pontoReposicao': int(resultado['ponto_reposicao'][i]),
+                'quantidadeSugerida': int(resultado['sugerida'][i]),
+                'repor': bool(resultado['repor'][i])
+            })
+        
+        return jsonify({
+            'parametros': {
+                'janela': janela,
+                'prazo': prazo,
+                'ciclo': ciclo,
+                'nivelServico': nivel_servico,
+                'fonte': fonte
+            },
+            'calculadoEm': resultado['calculado_em'].isoformat(),
+            'items': items,
+            'nextCursor': proximo_cursor,
+            'limit': limite
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @produto_bp.route('/produtos', methods=['POST'])
+@idempotente
 def create_produto():
     try:
         data = request.get_json()
@@ -88,11 +560,23 @@ def create_produto():
 
 # UPLOAD DE PLANILHA
 # DISPENSAÇÃO DE PRODUTOS
+def _obra_da_dispensacao(data, local_uso):
+    """obra_id informado (validado) ou a obra cujo nome corresponde ao local de uso.
+
+    Levanta LookupError quando o obra_id informado não existe."""
+    obra_id = data.get('obra_id')
+    if obra_id in (None, ''):
+        return obra_por_local(db.session.connection(), local_uso)
+    obra_id = int(obra_id)
+    if db.session.get(Obra, obra_id) is None:
+        raise LookupError('Obra não encontrada')
+    return obra_id
+
 @produto_bp.route('/produtos/<int:produto_id>/dispensar', methods=['POST'])
+@idempotente
 def dispensar_produto(produto_id):
     try:
         data = request.get_json()
-        produto = Produto.query.get_or_404(produto_id)
         
         quantidade = int(data['quantidade'])
         local_uso = data['local_uso']
@@ -104,29 +588,54 @@ def dispensar_produto(produto_id):
         else:
             data_dispensacao = datetime.utcnow().date()
         
-        # Verificar se há estoque suficiente
-        if produto.estoque < quantidade:
+        if quantidade <= 0:
+            return jsonify({'error': 'Quantidade deve ser maior que zero'}), 400
+        
+        try:
+            obra_id = _obra_da_dispensacao(data, local_uso)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Baixa atômica: a verificação de estoque e o decremento acontecem no mesmo UPDATE,
+        # então dispensações concorrentes não perdem atualizações nem deixam o estoque negativo
+        atualizado = db.session.execute(
+            update(Produto)
+            .where(Produto.id == produto_id, Produto.estoque >= quantidade)
+            .values(estoque=Produto.estoque - quantidade, data_atualizacao=datetime.utcnow())
+            .returning(Produto.estoque, Produto.preco, Produto.categoria, Produto.ativo)
+            .execution_options(synchronize_session=False)
+        ).first()
+        
+        if atualizado is None:
+            db.session.rollback()
+            if db.session.get(Produto, produto_id) is None:
+                return jsonify({'error': 'Produto não encontrado'}), 404
             return jsonify({'error': 'Estoque insuficiente'}), 400
         
-        # Atualizar estoque
-        estoque_anterior = produto.estoque
-        produto.estoque -= quantidade
-        produto.data_atualizacao = datetime.utcnow()
+        # O UPDATE não passa pelo flush do ORM: atualizar resumo e gerações explicitamente
+        if atualizado.ativo is not False:
+            aplicar_delta_resumo(db.session.connection(), {
+                atualizado.categoria: (0, -quantidade, -quantidade * atualizado.preco)
+            })
+        marcar_tabelas_alteradas(db.session, Produto.__tablename__)
         
-        # Registrar movimentação
+        # Registrar movimentação a partir do estoque retornado pelo UPDATE
         movimentacao = MovimentacaoEstoque(
             produto_id=produto_id,
             tipo='saida',
             quantidade=quantidade,
-            quantidade_anterior=estoque_anterior,
-            quantidade_atual=produto.estoque,
+            quantidade_anterior=atualizado.estoque + quantidade,
+            quantidade_atual=atualizado.estoque,
             motivo=f'Dispensação para {local_uso}',
             usuario=solicitante,
-            data_movimentacao=data_dispensacao
+            data_movimentacao=data_dispensacao,
+            obra_id=obra_id
         )
         db.session.add(movimentacao)
         db.session.commit()
         
+        produto = db.session.get(Produto, produto_id)
+        
         return jsonify({
             'message': 'Produto dispensado com sucesso',
             'produto': produto.to_dict(),
@@ -137,6 +646,127 @@ def dispensar_produto(produto_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@produto_bp.route('/produtos/dispensar-lote', methods=['POST'])
+@idempotente
+def dispensar_lote():
+    """Dispensa vários produtos numa única transação: ou todas as linhas são gravadas ou nenhuma.
+
+    Corpo: {"itens": [{"produto_id": 1, "quantidade": 2}, ...], "local_uso", "solicitante",
+    "data_dispensacao", "obra_id"}. Os produtos são travados em ordem de id (SELECT ... FOR UPDATE) para
+    que lotes concorrentes não entrem em deadlock, e as movimentações são inseridas em lote.
+    """
+    try:
+        data = request.get_json()
+        itens = data.get('itens') or []
+        local_uso = data['local_uso']
+        solicitante = data['solicitante']
+        data_dispensacao = data.get('data_dispensacao')
+        
+        if isinstance(data_dispensacao, str):
+            data_dispensacao = datetime.strptime(data_dispensacao, '%Y-%m-%d').date()
+        else:
+            data_dispensacao = datetime.utcnow().date()
+        
+        if not isinstance(itens, list) or not itens:
+            return jsonify({'error': 'Informe ao menos um item para dispensação'}), 400
+        
+        try:
+            obra_id = _obra_da_dispensacao(data, local_uso)
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Validar o formato das linhas antes de travar qualquer produto
+        errors = []
+        linhas = []
+        for linha, item in enumerate(itens, start=1):
+            try:
+                produto_id = int(item['produto_id'])
+                quantidade = int(item['quantidade'])
+            except (KeyError, TypeError, ValueError):
+                errors.append({'linha': linha, 'erros': ['produto_id e quantidade devem ser números inteiros']})
+                continue
+            if quantidade <= 0:
+                errors.append({'linha': linha, 'produto_id': produto_id, 'erros': ['Quantidade deve ser maior que zero']})
+                continue
+            linhas.append((linha, produto_id, quantidade))
+        
+        if errors:
+            return jsonify({'error': 'Itens inválidos na dispensação', 'details': errors}), 400
+        
+        ids = sorted({produto_id for _, produto_id, _ in linhas})
+        produtos = {
+            produto.id: produto
+            for produto in Produto.query.filter(Produto.id.in_(ids)).order_by(Produto.id).with_for_update().all()
+        }
+        
+        # Validar estoque considerando todas as linhas do mesmo produto
+        solicitado = {}
+        for linha, produto_id, quantidade in linhas:
+            solicitado[produto_id] = solicitado.get(produto_id, 0) + quantidade
+        for linha, produto_id, quantidade in linhas:
+            produto = produtos.get(produto_id)
+            if produto is None:
+                errors.append({'linha': linha, 'produto_id': produto_id, 'erros': ['Produto não encontrado']})
+            elif produto.estoque < solicitado[produto_id]:
+                errors.append({
+                    'linha': linha,
+                    'produto_id': produto_id,
+                    'erros': [f'Estoque insuficiente (disponível: {produto.estoque}, solicitado: {solicitado[produto_id]})']
+                })
+        
+        if errors:
+            db.session.rollback()
+            return jsonify({'error': 'Estoque insuficiente ou produtos inexistentes', 'details': errors}), 400
+        
+        agora = datetime.utcnow()
+        movimentacoes = []
+        for linha, produto_id, quantidade in linhas:
+            produto = produtos[produto_id]
+            estoque_anterior = produto.estoque
+            produto.estoque -= quantidade
+            produto.data_atualizacao = agora
+            movimentacoes.append({
+                'produto_id': produto_id,
+                'tipo': 'saida',
+                'quantidade': quantidade,
+                'quantidade_anterior': estoque_anterior,
+                'quantidade_atual': produto.estoque,
+                'motivo': f'Dispensação para {local_uso}',
+                'usuario': solicitante,
+                'data_movimentacao': data_dispensacao,
+                'obra_id': obra_id
+            })
+        
+        db.session.flush()
+        movimentacao_ids = db.session.scalars(
+            insert(MovimentacaoEstoque).returning(MovimentacaoEstoque.id, sort_by_parameter_order=True),
+            movimentacoes
+        ).all()
+        # O insert em massa não passa pelos eventos do ORM
+        aplicar_delta_consumo(db.session.connection(), delta_consumo(movimentacoes))
+        ajustar_snapshots(db.session.connection(), movimentacoes)
+        marcar_tabelas_alteradas(db.session, MovimentacaoEstoque.__tablename__)
+        db.session.commit()
+        
+        rows = db.session.execute(
+            _query_movimentacoes()
+            .where(MovimentacaoEstoque.id.in_(movimentacao_ids))
+            .order_by(MovimentacaoEstoque.id)
+        )
+        
+        return jsonify({
+            'message': f'{len(linhas)} itens dispensados com sucesso',
+            'produtos': [produtos[produto_id].to_dict() for produto_id in ids],
+            'movimentacoes': _serializar_movimentacoes(rows)
+        }), 200
+        
+    except (KeyError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Dados inválidos: {str(e)}'}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 # EDIÇÃO DE PRODUTOS
 @produto_bp.route('/produtos/<int:produto_id>', methods=['PUT'])
 def update_produto(produto_id):
@@ -228,6 +858,7 @@ def upload_foto_produto(produto_id):
         return jsonify({'error': str(e)}), 500
 
 @produto_bp.route('/produtos/upload', methods=['POST'])
+@idempotente
 def upload_planilha():
     try:
         if 'file' not in request.files:
@@ -238,13 +869,7 @@ def upload_planilha():
             return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
         
         # Validar extensão do arquivo (CSV, Excel)
-        allowed_extensions = ['.csv', '.xlsx', '.xls']
-        file_extension = None
-        for ext in allowed_extensions:
-            if file.filename.lower().endswith(ext):
-                file_extension = ext
-                break
-        
+        file_extension = extensao_planilha(file.filename)
         if not file_extension:
             return jsonify({'error': 'Apenas arquivos CSV (.csv), Excel (.xlsx, .xls) são suportados'}), 400
         
@@ -257,168 +882,81 @@ def upload_planilha():
         validate_prices = request.form.get('validatePrices', 'false').lower() == 'true'
         validate_stock = request.form.get('validateStock', 'false').lower() == 'true'
         update_existing = request.form.get('updateExisting', 'false').lower() == 'true'
+        # Prévia: valida e classifica as linhas sem gravar; o token confirma a gravação depois
+        preview = parse_bool(request.form.get('preview'))
+        # Em lotes: commit a cada chunkSize linhas, com checkpoint para retomar após falhas
+        chunk_size = request.form.get('chunkSize')
+        if chunk_size:
+            try:
+                chunk_size = int(chunk_size)
+                if chunk_size <= 0:
+                    raise ValueError
+            except ValueError:
+                return jsonify({'error': 'chunkSize deve ser um inteiro positivo'}), 400
+        else:
+            chunk_size = None
+        opcoes = {
+            'validateDuplicates': validate_duplicates,
+            'validatePrices': validate_prices,
+            'validateStock': validate_stock,
+            'updateExisting': update_existing,
+            'preview': preview,
+            'chunkSize': chunk_size
+        }
         
-        # Ler arquivo com suporte a CSV e Excel
-        try:
-            if file_extension == '.csv':
-                # Para CSV, tentar diferentes encodings e delimitadores
-                file_content = file.read()
-                content = None
-                
-                # Lista de encodings para tentar
-                encodings = ["iso-8859-1", "utf-8", "latin-1", "cp1252", "utf-8-sig"]
-                
-                for encoding in encodings:
-                    try:
-                        content = file_content.decode(encoding)
-                        # Tentar diferentes delimitadores
-                        for delimiter in [';', ',', '\t']:
-                            try:
-                                csv_reader = csv.DictReader(io.StringIO(content), delimiter=delimiter)
-                                fieldnames = csv_reader.fieldnames or []
-                                if len(fieldnames) > 1:  # Se tem mais de uma coluna, provavelmente é o delimitador correto
-                                    break
-                            except:
-                                continue
-                        if len(fieldnames) > 1:
-                            break
-                    except UnicodeDecodeError:
-                        continue
-                
-                if content is None or len(fieldnames) <= 1:
-                    return jsonify({'error': 'Não foi possível decodificar o arquivo CSV. Verifique o formato e a codificação.'}), 400
-            
-            elif file_extension in ['.xlsx', '.xls']:
-                if not EXCEL_SUPPORT:
-                    return jsonify({'error': 'Suporte a Excel não disponível. Use arquivos CSV.'}), 400
-                
-                file.seek(0)  # Reset file pointer
-                workbook = openpyxl.load_workbook(file, read_only=True)
-                worksheet = workbook.active
-                
-                # Converter para formato similar ao CSV
-                rows = list(worksheet.iter_rows(values_only=True))
-                if not rows:
-                    return jsonify({'error': 'Planilha Excel está vazia.'}), 400
-                
-                # Primeira linha como cabeçalho
-                fieldnames = [str(cell) if cell is not None else '' for cell in rows[0]]
-                
-                # Criar um leitor CSV simulado
-                csv_data = []
-                for row in rows[1:]:  # Pular cabeçalho
-                    row_dict = {}
-                    for i, cell in enumerate(row):
-                        if i < len(fieldnames):
-                            row_dict[fieldnames[i]] = str(cell) if cell is not None else ''
-                    csv_data.append(row_dict)
-                
-                # Simular csv_reader para compatibilidade
-                class ExcelReader:
-                    def __init__(self, data, fieldnames):
-                        self.data = data
-                        self.fieldnames = fieldnames
-                    
-                    def __iter__(self):
-                        return iter(self.data)
-                
-                csv_reader = ExcelReader(csv_data, fieldnames)
-            
-            else:
-                return jsonify({'error': 'Formato de arquivo não suportado.'}), 400
+        # Processamento em segundo plano (Prefer: respond-async ou async=true): a planilha é
+        # guardada numa importação pendente e o progresso é consultado em /produtos/upload/<id>
+        if _resposta_assincrona():
+            importacao = criar_importacao(file.filename, file.read(), opcoes)
+            db.session.commit()
+            return _resposta_em_segundo_plano(importacao.id, 'Planilha recebida; processamento em segundo plano')
         
+        # Em lotes no próprio pedido: a importação é registrada (com o arquivo) para que o
+        # checkpoint sobreviva a uma falha
+        if chunk_size and not preview:
+            importacao = criar_importacao(file.filename, file.read(), opcoes, processar_agora=True)
+            db.session.commit()
+            return _processar_no_pedido(importacao.id)
+        
+        # Ler arquivo com suporte a CSV e Excel: encoding e delimitador detectados no início
+        # do arquivo e linhas lidas em streaming
+        try:
+            planilha = Planilha(file.stream, file.filename, como_texto=True)
         except Exception as e:
             return jsonify({'error': f'Erro ao ler arquivo: {str(e)}'}), 400
         
-        # Validar colunas obrigatórias
-        required_columns = ['nome', 'categoria', 'codigo', 'estoque', 'estoque_minimo', 'preco']
-        missing_columns = [col for col in required_columns if col not in fieldnames]
-        if missing_columns:
-            return jsonify({
-                'error': f'Colunas obrigatórias ausentes: {", ".join(missing_columns)}',
-                'required_columns': required_columns,
-                'found_columns': fieldnames
-            }), 400
-        
-        # Validar dados linha por linha
-        errors = []
-        warnings = []
-        valid_rows = []
-        
-        for row_num, row in enumerate(csv_reader, start=2):  # Start at 2 because row 1 is header
-            row_errors = []
-            row_warnings = []
-            
-            # Validar campos obrigatórios
-            if not str(row.get('nome', '')).strip():
-                row_errors.append('Nome é obrigatório')
-            
-            if not str(row.get('categoria', '')).strip():
-                row_errors.append('Categoria é obrigatória')
+        with planilha:
+            fieldnames = planilha.colunas
             
-            if not str(row.get('codigo', '')).strip():
-                row_errors.append('Código é obrigatório')
-            
-            # Validar tipos de dados
-            try:
-                estoque = int(float(row.get('estoque', 0)))
-                if validate_stock and estoque < 0:
-                    row_errors.append('Estoque deve ser um número positivo')
-            except (ValueError, TypeError):
-                row_errors.append('Estoque deve ser um número válido')
-                estoque = 0
-            
-            try:
-                estoque_minimo = int(float(row.get('estoque_minimo', 0)))
-                if estoque_minimo < 0:
-                    row_errors.append('Estoque mínimo deve ser um número positivo')
-            except (ValueError, TypeError):
-                row_errors.append('Estoque mínimo deve ser um número válido')
-                estoque_minimo = 0
-            
-            try:
-                preco = float(row.get('preco', 0))
-                if validate_prices and preco <= 0:
-                    row_errors.append('Preço deve ser maior que zero')
-            except (ValueError, TypeError):
-                row_errors.append('Preço deve ser um número válido')
-                preco = 0.0
+            # Validar colunas obrigatórias
+            required_columns = COLUNAS_OBRIGATORIAS_PRODUTO
+            missing_columns = [col for col in required_columns if col not in fieldnames]
+            if missing_columns:
+                return jsonify({
+                    'error': f'Colunas obrigatórias ausentes: {", ".join(missing_columns)}',
+                    'required_columns': required_columns,
+                    'found_columns': fieldnames
+                }), 400
             
-            # Validar duplicatas por código
-            if validate_duplicates:
-                codigo = str(row.get('codigo', '')).strip()
-                existing_product = Produto.query.filter_by(codigo=codigo, ativo=True).first()
-                if existing_product:
-                    if update_existing:
-                        row_warnings.append(f'Produto com código {codigo} será atualizado')
-                    else:
-                        row_errors.append(f'Produto com código {codigo} já existe')
-            
-            # Se há erros, adicionar à lista de erros
-            if row_errors:
-                errors.append({
-                    'linha': row_num,
-                    'erros': row_errors
-                })
-            else:
-                # Adicionar warnings se houver
-                if row_warnings:
-                    warnings.append({
-                        'linha': row_num,
-                        'avisos': row_warnings
-                    })
-                
-                # Adicionar à lista de linhas válidas
-                valid_rows.append({
-                    'nome': str(row.get('nome', '')).strip(),
-                    'categoria': str(row.get('categoria', '')).strip(),
-                    'codigo': str(row.get('codigo', '')).strip(),
-                    'estoque': estoque,
-                    'estoque_minimo': estoque_minimo,
-                    'preco': preco,
-                    'unidade': str(row.get('unidade', 'unidade')).strip() or 'unidade',
-                    'descricao': str(row.get('descricao', '')).strip()
-                })
+            # Validar dados linha por linha; a existência dos códigos é consultada em lote
+            valid_rows, errors, warnings = validar_planilha_produtos(
+                db.session.connection(), planilha,
+                validar_duplicados=validate_duplicates,
+                validar_precos=validate_prices,
+                validar_estoque=validate_stock,
+                atualizar_existentes=update_existing
+            )
+        
+        if preview:
+            previa, dados = montar_previa(db.session.connection(), valid_rows, errors, warnings, update_existing)
+            token = None
+            expira_em = None
+            if dados is not None:
+                importacao = criar_previa(file.filename, opcoes, previa, dados, len(valid_rows) + len(errors))
+                db.session.commit()
+                token = importacao.id
+                expira_em = importacao.expira_em().isoformat()
+            return jsonify(dict(previa, message='Prévia da planilha; nada foi gravado', token=token, expiresAt=expira_em)), 200
         
         # Se há erros críticos, retornar sem processar
         if errors:
@@ -426,74 +964,8 @@ def upload_planilha():
                 'error': 'Erros encontrados na planilha',
                 'details': errors
             }), 400
-        # Processar linhas válidas
-        created_count = 0
-        updated_count = 0
-        
-        for row_data in valid_rows:
-            existing_product = Produto.query.filter_by(codigo=row_data['codigo'], ativo=True).first()
-            
-            if existing_product and update_existing:
-                # Atualizar produto existente
-                estoque_anterior = existing_product.estoque
-                
-                existing_product.nome = row_data['nome']
-                existing_product.categoria = row_data['categoria']
-                existing_product.estoque_minimo = row_data['estoque_minimo']
-                existing_product.preco = row_data['preco']
-                existing_product.unidade = row_data['unidade']
-                existing_product.descricao = row_data['descricao']
-                existing_product.data_atualizacao = datetime.utcnow()
-                
-                # Se o estoque foi alterado, registrar movimentação
-                if row_data['estoque'] != estoque_anterior:
-                    diferenca = row_data['estoque'] - estoque_anterior
-                    tipo_movimentacao = 'entrada' if diferenca > 0 else 'saida'
-                    
-                    movimentacao = MovimentacaoEstoque(
-                        produto_id=existing_product.id,
-                        tipo=tipo_movimentacao,
-                        quantidade=abs(diferenca),
-                        quantidade_anterior=estoque_anterior,
-                        quantidade_atual=row_data['estoque'],
-                        motivo='Atualização via planilha',
-                        usuario='Sistema'
-                    )
-                    db.session.add(movimentacao)
-                    existing_product.estoque = row_data['estoque']
-                
-                updated_count += 1
-            
-            elif not existing_product:
-                # Criar novo produto
-                produto = Produto(
-                    nome=row_data['nome'],
-                    categoria=row_data['categoria'],
-                    codigo=row_data['codigo'],
-                    estoque=row_data['estoque'],
-                    estoque_minimo=row_data['estoque_minimo'],
-                    preco=row_data['preco'],
-                    unidade=row_data['unidade'],
-                    descricao=row_data['descricao']
-                )
-                
-                db.session.add(produto)
-                db.session.flush()  # Para obter o ID
-                
-                # Registrar movimentação inicial se houver estoque
-                if produto.estoque > 0:
-                    movimentacao = MovimentacaoEstoque(
-                        produto_id=produto.id,
-                        tipo='entrada',
-                        quantidade=produto.estoque,
-                        quantidade_anterior=0,
-                        quantidade_atual=produto.estoque,
-                        motivo='Estoque inicial via planilha',
-                        usuario='Sistema'
-                    )
-                    db.session.add(movimentacao)
-                
-                created_count += 1
+        # Processar linhas válidas: upsert dos produtos e insert em massa das movimentações
+        created_count, updated_count = gravar_produtos(db.session, valid_rows, update_existing)
         
         # Salvar todas as alterações
         db.session.commit()
@@ -510,51 +982,374 @@ def upload_planilha():
         db.session.rollback()
         return jsonify({'error': f'Erro interno do servidor: {str(e)}'}), 500
 
+def _resposta_assincrona():
+    return parse_bool(request.form.get('async')) or 'respond-async' in request.headers.get('Prefer', '')
+
+def _resposta_em_segundo_plano(importacao_id, message):
+    response = jsonify({
+        'message': message,
+        'id': importacao_id,
+        'status': 'pendente',
+        'url': f'/api/produtos/upload/{importacao_id}'
+    })
+    response.headers['Location'] = f'/api/produtos/upload/{importacao_id}'
+    return response, 202
+
+def _processar_no_pedido(importacao_id):
+    """Processa a importação já reivindicada neste pedido e responde como o upload síncrono"""
+    processar_importacao(importacao_id)
+    db.session.expire_all()
+    importacao = db.session.get(ImportacaoPlanilha, importacao_id)
+    resultado = json.loads(importacao.resultado) if importacao.resultado else {}
+    if importacao.status == 'concluida':
+        return jsonify({
+            'message': 'Planilha processada com sucesso',
+            'id': importacao.id,
+            'created': resultado['created'],
+            'updated': resultado['updated'],
+            'warnings': resultado['warnings'],
+            'total_processed': resultado['created'] + resultado['updated']
+        }), 200
+    if resultado.get('errors'):
+        return jsonify({'error': 'Erros encontrados na planilha', 'details': resultado['errors'], 'id': importacao.id}), 400
+    if importacao.dados is None:
+        # Falhou antes de guardar as linhas validadas (arquivo ou colunas inválidos) ou a
+        # prévia ficou desatualizada: não pode ser retomada
+        return jsonify({'error': importacao.erro, 'id': importacao.id}), 400
+    # Os lotes até o checkpoint já foram gravados: não é 5xx, para que a Idempotency-Key guarde
+    # esta resposta e uma nova tentativa não comece outra importação em vez de retomar
+    return jsonify({
+        'error': f'Erro ao gravar planilha: {importacao.erro}',
+        'id': importacao.id,
+        'status': importacao.status,
+        'checkpoint': importacao.checkpoint,
+        'created': importacao.produtos_criados or 0,
+        'updated': importacao.produtos_atualizados or 0,
+        'resumeUrl': f'/api/produtos/upload/{importacao.id}/retomar'
+    }), 409
+
+@produto_bp.route('/produtos/upload/<importacao_id>/retomar', methods=['POST'])
+@idempotente
+def retomar_upload_planilha(importacao_id):
+    """Retoma do último checkpoint uma importação em lotes que terminou com erro"""
+    try:
+        importacao = db.session.get(ImportacaoPlanilha, importacao_id)
+        if importacao is None:
+            return jsonify({'error': 'Importação não encontrada'}), 404
+        assincrona = _resposta_assincrona()
+        if not retomar_importacao(importacao_id, 'pendente' if assincrona else 'processando'):
+            return jsonify({'error': 'Só importações em lotes interrompidas por erro podem ser retomadas',
+                            'status': importacao.status}), 409
+        if assincrona:
+            return _resposta_em_segundo_plano(importacao_id, 'Importação retomada em segundo plano')
+        return _processar_no_pedido(importacao_id)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro interno do servidor: {str(e)}'}), 500
+
+@produto_bp.route('/produtos/upload/<importacao_id>/confirmar', methods=['POST'])
+@idempotente
+def confirmar_upload_planilha(importacao_id):
+    """Grava a prévia gerada com preview=true (o id da importação é o token), sem ler a
+    planilha de novo. 409 se a prévia já foi confirmada ou se os produtos mudaram desde ela."""
+    try:
+        importacao = db.session.get(ImportacaoPlanilha, importacao_id)
+        if importacao is None:
+            return jsonify({'error': 'Prévia não encontrada'}), 404
+        if importacao.status != 'previa':
+            return jsonify({'error': 'A importação não é uma prévia pendente de confirmação', 'status': importacao.status}), 409
+        if importacao.expira_em() < datetime.utcnow():
+            return jsonify({'error': 'Prévia expirada; envie a planilha novamente'}), 410
+        dados = json.loads(importacao.dados)
+        opcoes = json.loads(importacao.opcoes or '{}')
+        
+        if _resposta_assincrona():
+            # O worker grava as linhas da prévia como numa importação em segundo plano
+            tabela = ImportacaoPlanilha.__table__
+            confirmada = db.session.execute(
+                update(tabela).where(tabela.c.id == importacao_id, tabela.c.status == 'previa')
+                .values(status='pendente', data_atualizacao=datetime.utcnow())
+            ).rowcount
+            db.session.commit()
+            if not confirmada:
+                return jsonify({'error': 'A prévia já foi confirmada'}), 409
+            return _resposta_em_segundo_plano(importacao_id, 'Prévia confirmada; gravação em segundo plano')
+        
+        if not confirmar_previa(importacao_id):
+            db.session.rollback()
+            return jsonify({'error': 'A prévia já foi confirmada'}), 409
+        if opcoes.get('chunkSize'):
+            db.session.commit()
+            return _processar_no_pedido(importacao_id)
+        try:
+            resultado = gravar_importacao(importacao_id, dados['linhas'], dados['avisos'], opcoes, estado=dados['estado'])
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 409
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Planilha processada com sucesso',
+            'created': resultado['created'],
+            'updated': resultado['updated'],
+            'warnings': resultado['warnings'],
+            'total_processed': resultado['created'] + resultado['updated']
+        }), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Erro interno do servidor: {str(e)}'}), 500
+
+@produto_bp.route('/produtos/upload/<importacao_id>', methods=['GET'])
+def status_upload_planilha(importacao_id):
+    """Progresso e, ao terminar, relatório (created, updated, warnings, errors) da importação"""
+    try:
+        importacao = db.session.get(ImportacaoPlanilha, importacao_id)
+        if importacao is None:
+            return jsonify({'error': 'Importação não encontrada'}), 404
+        return jsonify(importacao.to_dict())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
 
 # ENDPOINT PARA HISTÓRICO DE MOVIMENTAÇÕES
+def _query_movimentacoes():
+    """Movimentações com o resumo do produto obtido por join (sem carregar objetos do ORM)"""
+    return SERIALIZADOR_MOVIMENTACAO.select(
+        Produto.id, Produto.nome, Produto.categoria, Produto.codigo
+    ).outerjoin(Produto, Produto.id == MovimentacaoEstoque.produto_id)
+
+def _serializar_movimentacoes(rows):
+    serializar = SERIALIZADOR_MOVIMENTACAO.serializar
+    result = []
+    for row in rows:
+        mov_dict = serializar(row)
+        produto_id, nome, categoria, codigo = row[-4:]
+        mov_dict['produto'] = {
+            'id': produto_id,
+            'nome': nome,
+            'categoria': categoria,
+            'codigo': codigo
+        } if produto_id is not None else None
+        result.append(mov_dict)
+    return result
+
+def _filtros_movimentacoes(args):
+    """Filtros produto_id, tipo, usuario, de e ate (YYYY-MM-DD, inclusive) da query string"""
+    filtros = []
+    produto_id = args.get('produto_id')
+    if produto_id:
+        filtros.append(MovimentacaoEstoque.produto_id == int(produto_id))
+    tipo = args.get('tipo')
+    if tipo:
+        filtros.append(MovimentacaoEstoque.tipo == tipo)
+    usuario = args.get('usuario')
+    if usuario:
+        filtros.append(MovimentacaoEstoque.usuario == usuario)
+    de = args.get('de')
+    if de:
+        filtros.append(MovimentacaoEstoque.data_movimentacao >= datetime.strptime(de, '%Y-%m-%d'))
+    ate = args.get('ate')
+    if ate:
+        filtros.append(MovimentacaoEstoque.data_movimentacao < datetime.strptime(ate, '%Y-%m-%d') + timedelta(days=1))
+    return filtros
+
 @produto_bp.route('/produtos/movimentacoes', methods=['GET'])
+@condicional('movimentacoes_estoque')
 def get_movimentacoes():
+    """Movimentações da mais recente para a mais antiga, paginadas por cursor em
+    (data_movimentacao, id); as sem data vêm por último. Filtros: produto_id, tipo, usuario,
+    de e ate. A listagem completa sem paginação só é retornada com todos=true."""
     try:
-        # Buscar todas as movimentações ordenadas por data (mais recentes primeiro)
-        movimentacoes = MovimentacaoEstoque.query.order_by(MovimentacaoEstoque.data_movimentacao.desc()).all()
-        
-        # Converter para dict incluindo dados do produto
-        result = []
-        for mov in movimentacoes:
-            mov_dict = mov.to_dict()
-            if mov.produto:
-                mov_dict['produto'] = {
-                    'id': mov.produto.id,
-                    'nome': mov.produto.nome,
-                    'categoria': mov.produto.categoria,
-                    'codigo': mov.produto.codigo
-                }
-            result.append(mov_dict)
-        
-        return jsonify(result), 200
+        query = _query_movimentacoes().where(*_filtros_movimentacoes(request.args))
+        ordem = (MovimentacaoEstoque.data_movimentacao.desc().nulls_last(), MovimentacaoEstoque.id.desc())
+        
+        if parse_bool(request.args.get('todos')):
+            rows = db.session.execute(query.order_by(*ordem))
+            return jsonify(_serializar_movimentacoes(rows)), 200
+        
+        limite = parse_limite(request.args.get('limit'))
+        cursor = request.args.get('cursor')
+        if cursor:
+            data_cursor, id_cursor = decode_cursor(cursor, 2)
+            if data_cursor is None:
+                # Cursor já entre as movimentações sem data
+                query = query.where(MovimentacaoEstoque.data_movimentacao.is_(None),
+                                    MovimentacaoEstoque.id < int(id_cursor))
+            else:
+                query = query.where(or_(
+                    tuple_(MovimentacaoEstoque.data_movimentacao, MovimentacaoEstoque.id) <
+                    tuple_(datetime.fromisoformat(data_cursor), int(id_cursor)),
+                    MovimentacaoEstoque.data_movimentacao.is_(None)
+                ))
+        
+        rows = db.session.execute(query.order_by(*ordem).limit(limite + 1)).all()
+        
+        proximo_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            items = _serializar_movimentacoes(rows)
+            proximo_cursor = encode_cursor([items[-1]['dataMovimentacao'], items[-1]['id']])
+        else:
+            items = _serializar_movimentacoes(rows)
+        
+        return jsonify({
+            'items': items,
+            'nextCursor': proximo_cursor,
+            'limit': limite
+        }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @produto_bp.route('/produtos/movimentacoes/<int:produto_id>', methods=['GET'])
+@condicional('movimentacoes_estoque')
 def get_movimentacoes_produto(produto_id):
     try:
         # Buscar movimentações de um produto específico
-        movimentacoes = MovimentacaoEstoque.query.filter_by(produto_id=produto_id).order_by(MovimentacaoEstoque.data_movimentacao.desc()).all()
-        
-        result = []
-        for mov in movimentacoes:
-            mov_dict = mov.to_dict()
-            if mov.produto:
-                mov_dict['produto'] = {
-                    'id': mov.produto.id,
-                    'nome': mov.produto.nome,
-                    'categoria': mov.produto.categoria,
-                    'codigo': mov.produto.codigo
-                }
-            result.append(mov_dict)
-        
-        return jsonify(result), 200
+        rows = db.session.execute(
+            _query_movimentacoes()
+            .where(MovimentacaoEstoque.produto_id == produto_id)
+            .order_by(MovimentacaoEstoque.data_movimentacao.desc())
+        )
+        
+        return jsonify(_serializar_movimentacoes(rows)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# EXPORTAÇÃO EM STREAMING (CSV ou XLSX)
+COLUNAS_EXPORTACAO_MOVIMENTACOES = [
+    ('id', MovimentacaoEstoque.id),
+    ('data_movimentacao', MovimentacaoEstoque.data_movimentacao),
+    ('produto_id', MovimentacaoEstoque.produto_id),
+    ('codigo', Produto.codigo),
+    ('produto', Produto.nome),
+    ('categoria', Produto.categoria),
+    ('tipo', MovimentacaoEstoque.tipo),
+    ('quantidade', MovimentacaoEstoque.quantidade),
+    ('quantidade_anterior', MovimentacaoEstoque.quantidade_anterior),
+    ('quantidade_atual', MovimentacaoEstoque.quantidade_atual),
+    ('motivo', MovimentacaoEstoque.motivo),
+    ('observacoes', MovimentacaoEstoque.observacoes),
+    ('usuario', MovimentacaoEstoque.usuario)
+]
+
+# Mesmos nomes de coluna aceitos pelo upload de planilha
+COLUNAS_EXPORTACAO_PRODUTOS = [
+    ('id', Produto.id),
+    ('codigo', Produto.codigo),
+    ('nome', Produto.nome),
+    ('categoria', Produto.categoria),
+    ('unidade', Produto.unidade),
+    ('estoque', Produto.estoque),
+    ('estoque_minimo', Produto.estoque_minimo),
+    ('preco', Produto.preco),
+    ('descricao', Produto.descricao),
+    ('ativo', Produto.ativo)
+]
+
+def _resposta_exportacao(nome, colunas, query):
+    """Resposta em streaming no formato pedido (formato=csv|xlsx)"""
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'xlsx'):
+        raise ValueError('Formato deve ser csv ou xlsx')
+    cabecalho = [nome_coluna for nome_coluna, _ in colunas]
+    query = query.with_only_columns(*[coluna.label(nome_coluna) for nome_coluna, coluna in colunas])
+    arquivo = f'{nome}_{datetime.utcnow().strftime("%Y%m%d_%H%M%S")}.{formato}'
+    
+    if formato == 'xlsx':
+        if not EXCEL_SUPPORT:
+            raise ValueError('Suporte a Excel não disponível. Use formato=csv.')
+        rows = db.session.execute(query.execution_options(yield_per=1000))
+        try:
+            caminho = xlsx_temporario(nome, cabecalho, rows)
+        finally:
+            rows.close()
+        corpo = ler_e_remover(caminho)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    elif db.engine.dialect.name == 'postgresql':
+        corpo = csv_por_copy(db.engine, query, cabecalho)
+        mimetype = 'text/csv'
+    else:
+        corpo = csv_por_lotes(db.session, query, cabecalho)
+        mimetype = 'text/csv'
+    
+    response = Response(stream_with_context(corpo), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{arquivo}"'
+    return response
+
+@produto_bp.route('/produtos/movimentacoes/importar', methods=['POST'])
+@idempotente
+def importar_historico_movimentacoes():
+    """Importa em massa o histórico de movimentações de uma planilha (CSV ou Excel).
+
+    Colunas: codigo ou produto_id, tipo (entrada, saida, ajuste), quantidade,
+    data_movimentacao (ou data) e, opcionais, motivo, usuario e obra_id. A cadeia de
+    quantidades e o estoque dos produtos afetados são recalculados; qualquer erro cancela
+    a importação inteira."""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'Nenhum arquivo enviado'}), 400
+        file = request.files['file']
+        if not extensao_planilha(file.filename):
+            return jsonify({'error': 'Apenas arquivos CSV (.csv), Excel (.xlsx, .xls) são suportados'}), 400
+        
+        with Planilha(file.stream, file.filename) as planilha:
+            resultado = importar_movimentacoes(
+                db.session, planilha,
+                motivo_padrao=request.form.get('motivo') or 'Importação de histórico',
+                usuario_padrao=request.form.get('usuario') or 'Sistema'
+            )
+        
+        if resultado['erros']:
+            db.session.rollback()
+            return jsonify({'error': 'Erros encontrados na planilha', 'details': resultado['erros']}), 400
+        if not resultado['importadas']:
+            db.session.rollback()
+            return jsonify({'error': 'Nenhuma movimentação na planilha'}), 400
+        db.session.commit()
+        
+        for campo in ('inicio', 'fim'):
+            resultado[campo] = resultado[campo].isoformat()
+        del resultado['erros']
+        return jsonify(resultado), 200
+    
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@produto_bp.route('/produtos/movimentacoes/export', methods=['GET'])
+def export_movimentacoes():
+    """Exporta as movimentações (da mais recente para a mais antiga) em CSV ou XLSX, com os
+    mesmos filtros de /produtos/movimentacoes: produto_id, tipo, usuario, de e ate."""
+    try:
+        query = select(MovimentacaoEstoque.id)\
+            .outerjoin(Produto, Produto.id == MovimentacaoEstoque.produto_id)\
+            .where(*_filtros_movimentacoes(request.args))\
+            .order_by(MovimentacaoEstoque.data_movimentacao.desc(), MovimentacaoEstoque.id.desc())
+        return _resposta_exportacao('movimentacoes', COLUNAS_EXPORTACAO_MOVIMENTACOES, query)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@produto_bp.route('/produtos/export', methods=['GET'])
+def export_produtos():
+    """Exporta o catálogo em CSV ou XLSX. Filtros: categoria e inativos=true (inclui os inativos)."""
+    try:
+        query = select(Produto.id).order_by(Produto.nome, Produto.id)
+        if not parse_bool(request.args.get('inativos')):
+            query = query.where(Produto.ativo == True)
+        categoria = request.args.get('categoria')
+        if categoria:
+            query = query.where(Produto.categoria == categoria)
+        return _resposta_exportacao('produtos', COLUNAS_EXPORTACAO_PRODUTOS, query)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
@@ -1,8 +1,12 @@
 from flask import Blueprint, request, jsonify
 from src.models.user import db
 from src.models.sistema import HistoricoAcesso, ConfiguracaoSistema, Feed, ComentarioFeed
+from src.models.sistema import SERIALIZADOR_HISTORICO, SERIALIZADOR_CONFIGURACAO, SERIALIZADOR_FEED, SERIALIZADOR_COMENTARIO
+from src.models.obra import serializar_obras
+from sqlalchemy import select, func
 from datetime import datetime, timedelta
 import json
+import math
 
 sistema_bp = Blueprint('sistema', __name__)
 
@@ -18,6 +22,14 @@ def after_request(response):
 def handle_options():
     return '', 200
 
+def _paginar(query, page, per_page):
+    """Pagina um select() Core por offset, retornando (linhas, total, páginas) como o paginate()"""
+    page = max(page, 1)
+    per_page = max(per_page, 1)
+    total = db.session.execute(select(func.count()).select_from(query.order_by(None).subquery())).scalar()
+    rows = db.session.execute(query.limit(per_page).offset((page - 1) * per_page)).all()
+    return rows, total, math.ceil(total / per_page)
+
 # LOGIN
 @sistema_bp.route('/login', methods=['POST'])
 def login():
@@ -79,21 +91,19 @@ def get_historico_acesso():
         usuario = request.args.get('usuario')
         acao = request.args.get('acao')
         
-        query = HistoricoAcesso.query
+        query = SERIALIZADOR_HISTORICO.select()
         
         if usuario:
-            query = query.filter(HistoricoAcesso.usuario.ilike(f'%{usuario}%'))
+            query = query.where(HistoricoAcesso.usuario.ilike(f'%{usuario}%'))
         if acao:
-            query = query.filter_by(acao=acao)
+            query = query.where(HistoricoAcesso.acao == acao)
         
-        historico = query.order_by(HistoricoAcesso.data_acao.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        rows, total, pages = _paginar(query.order_by(HistoricoAcesso.data_acao.desc()), page, per_page)
         
         return jsonify({
-            'items': [item.to_dict() for item in historico.items],
-            'total': historico.total,
-            'pages': historico.pages,
+            'items': SERIALIZADOR_HISTORICO.lista(rows),
+            'total': total,
+            'pages': pages,
             'currentPage': page,
             'perPage': per_page
         }), 200
@@ -167,18 +177,18 @@ def get_configuracoes():
     try:
         categoria = request.args.get('categoria')
         
-        query = ConfiguracaoSistema.query
+        query = SERIALIZADOR_CONFIGURACAO.select()
         if categoria:
-            query = query.filter_by(categoria=categoria)
+            query = query.where(ConfiguracaoSistema.categoria == categoria)
         
-        configuracoes = query.all()
+        configuracoes = SERIALIZADOR_CONFIGURACAO.lista(db.session.execute(query))
         
         # Organizar por categoria
         resultado = {}
         for config in configuracoes:
-            if config.categoria not in resultado:
-                resultado[config.categoria] = {}
-            resultado[config.categoria][config.chave] = config.to_dict()
+            if config['categoria'] not in resultado:
+                resultado[config['categoria']] = {}
+            resultado[config['categoria']][config['chave']] = config
         
         return jsonify(resultado), 200
     except Exception as e:
@@ -235,21 +245,35 @@ def get_feed():
         obra_id = request.args.get('obra_id', type=int)
         tipo = request.args.get('tipo')
         
-        query = Feed.query.filter_by(publico=True)
+        query = SERIALIZADOR_FEED.select().where(Feed.publico == True)
         
         if obra_id:
-            query = query.filter_by(obra_id=obra_id)
+            query = query.where(Feed.obra_id == obra_id)
         if tipo:
-            query = query.filter_by(tipo=tipo)
-        
-        feed = query.order_by(Feed.data_publicacao.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+            query = query.where(Feed.tipo == tipo)
+        
+        rows, total, pages = _paginar(query.order_by(Feed.data_publicacao.desc()), page, per_page)
+        items = SERIALIZADOR_FEED.lista(rows)
+        
+        # Obras e comentários dos posts da página em consultas agrupadas
+        obras = serializar_obras({item['obraId'] for item in items if item['obraId']})
+        comentarios = {item['id']: [] for item in items}
+        if comentarios:
+            comentarios_rows = db.session.execute(
+                SERIALIZADOR_COMENTARIO.select()
+                .where(ComentarioFeed.feed_id.in_(list(comentarios)))
+                .order_by(ComentarioFeed.id)
+            )
+            for comentario in SERIALIZADOR_COMENTARIO.lista(comentarios_rows):
+                comentarios[comentario['feedId']].append(comentario)
+        for item in items:
+            item['obra'] = obras.get(item['obraId'])
+            item['comentarios'] = comentarios[item['id']]
         
         return jsonify({
-            'items': [item.to_dict() for item in feed.items],
-            'total': feed.total,
-            'pages': feed.pages,
+            'items': items,
+            'total': total,
+            'pages': pages,
             'currentPage': page,
             'perPage': per_page
         }), 200
@@ -334,8 +358,12 @@ def curtir_feed(feed_id):
 @sistema_bp.route('/feed/<int:feed_id>/comentarios', methods=['GET'])
 def get_comentarios_feed(feed_id):
     try:
-        comentarios = ComentarioFeed.query.filter_by(feed_id=feed_id).order_by(ComentarioFeed.data_comentario.asc()).all()
-        return jsonify([comentario.to_dict() for comentario in comentarios]), 200
+        rows = db.session.execute(
+            SERIALIZADOR_COMENTARIO.select()
+            .where(ComentarioFeed.feed_id == feed_id)
+            .order_by(ComentarioFeed.data_comentario.asc())
+        )
+        return jsonify(SERIALIZADOR_COMENTARIO.lista(rows)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
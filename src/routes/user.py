@@ -1,12 +1,12 @@
 from flask import Blueprint, jsonify, request
-from src.models.user import User, db
+from src.models.user import User, db, SERIALIZADOR_USER
 
 user_bp = Blueprint('user', __name__)
 
 @user_bp.route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    return jsonify([user.to_dict() for user in users])
+    rows = db.session.execute(SERIALIZADOR_USER.select())
+    return jsonify(SERIALIZADOR_USER.lista(rows))
 
 @user_bp.route('/users', methods=['POST'])
 def create_user():
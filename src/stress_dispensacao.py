@@ -0,0 +1,93 @@
+import os
+import sys
+import tempfile
+import threading
+
+# Banco SQLite temporário, a menos que STRESS_DATABASE_URL seja informado (use Postgres para
+# exercitar concorrência real entre transações)
+if 'STRESS_DATABASE_URL' in os.environ:
+    os.environ['DATABASE_URL'] = os.environ['STRESS_DATABASE_URL']
+else:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stress.db')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from src.main import app, db
+from src.models.produto import Produto, MovimentacaoEstoque
+
+ESTOQUE_INICIAL = int(os.environ.get('STRESS_ESTOQUE', '500'))
+THREADS = int(os.environ.get('STRESS_THREADS', '16'))
+REQUISICOES_POR_THREAD = int(os.environ.get('STRESS_REQUISICOES', '50'))
+QUANTIDADE = int(os.environ.get('STRESS_QUANTIDADE', '1'))
+
+def criar_produto():
+    with app.app_context():
+        produto = Produto(
+            nome='Produto stress',
+            categoria='Stress',
+            codigo=f'STRESS-{os.getpid()}-{threading.get_ident()}',
+            estoque=ESTOQUE_INICIAL,
+            estoque_minimo=0,
+            preco=1.0
+        )
+        db.session.add(produto)
+        db.session.commit()
+        return produto.id
+
+def dispensar(produto_id, resultados, lock):
+    client = app.test_client()
+    for _ in range(REQUISICOES_POR_THREAD):
+        response = client.post(f'/api/produtos/{produto_id}/dispensar', json={
+            'quantidade': QUANTIDADE,
+            'local_uso': 'Teste de concorrência',
+            'solicitante': 'stress'
+        })
+        with lock:
+            resultados[response.status_code] = resultados.get(response.status_code, 0) + 1
+
+def verificar(produto_id, resultados):
+    """Confere estoque final e cadeia do ledger; retorna a lista de violações encontradas"""
+    violacoes = []
+    with app.app_context():
+        produto = db.session.get(Produto, produto_id)
+        movimentacoes = MovimentacaoEstoque.query.filter_by(produto_id=produto_id, tipo='saida')\
+            .order_by(MovimentacaoEstoque.quantidade_anterior.desc()).all()
+
+        sucesso = resultados.get(200, 0)
+        if produto.estoque < 0:
+            violacoes.append(f'estoque negativo: {produto.estoque}')
+        if produto.estoque != ESTOQUE_INICIAL - sucesso * QUANTIDADE:
+            violacoes.append(f'estoque final {produto.estoque} != {ESTOQUE_INICIAL} - {sucesso} x {QUANTIDADE}')
+        if len(movimentacoes) != sucesso:
+            violacoes.append(f'{len(movimentacoes)} movimentações para {sucesso} dispensações aceitas')
+
+        # Cada movimentação deve começar onde a anterior terminou (nenhuma atualização perdida)
+        esperado = ESTOQUE_INICIAL
+        for mov in movimentacoes:
+            if mov.quantidade_anterior != esperado or mov.quantidade_atual != esperado - mov.quantidade:
+                violacoes.append(f'cadeia quebrada na movimentação {mov.id}: '
+                                 f'{mov.quantidade_anterior} -> {mov.quantidade_atual}, esperado {esperado}')
+                break
+            esperado = mov.quantidade_atual
+    return violacoes
+
+def main():
+    produto_id = criar_produto()
+    resultados = {}
+    lock = threading.Lock()
+    threads = [threading.Thread(target=dispensar, args=(produto_id, resultados, lock)) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f'Requisições por status: {dict(sorted(resultados.items()))}')
+    violacoes = verificar(produto_id, resultados)
+    if violacoes:
+        for violacao in violacoes:
+            print(f'[FALHA] {violacao}')
+        sys.exit(1)
+    print('[OK] Estoque nunca ficou negativo e nenhuma dispensação foi perdida')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, current_app
+from src.models.sistema import obter_geracoes
+
+CACHE_MAX_ENTRADAS = int(os.environ.get('CACHE_MAX_ENTRADAS', '512'))
+CACHE_MAX_MB = float(os.environ.get('CACHE_MAX_MB', '64'))
+
+
+class CacheLRU:
+    """LRU limitado por número de entradas e por bytes, seguro entre threads do mesmo worker"""
+
+    def __init__(self, max_entradas=CACHE_MAX_ENTRADAS, max_bytes=int(CACHE_MAX_MB * 1024 * 1024)):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None:
+                self._itens.move_to_end(chave)
+            return item
+
+    def set(self, chave, valor, tamanho):
+        if tamanho > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._itens.pop(chave, None)
+            if anterior is not None:
+                self.bytes -= anterior[1]
+            self._itens[chave] = (valor, tamanho)
+            self.bytes += tamanho
+            while len(self._itens) > self.max_entradas or self.bytes > self.max_bytes:
+                _, (_, tamanho_removido) = self._itens.popitem(last=False)
+                self.bytes -= tamanho_removido
+
+    def clear(self):
+        with self._lock:
+            self._itens.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._itens)
+
+
+cache_respostas = CacheLRU()
+
+
+def cache_resposta(*colecoes):
+    """Decorator de cache read-through das respostas 200 de um GET, por worker.
+
+    A chave inclui a URL completa e as gerações atuais das coleções: qualquer escrita que
+    incremente uma geração torna as entradas antigas inalcançáveis (e o LRU as descarta).
+    As gerações vêm de obter_geracoes(), que as relê no máximo uma vez por
+    CACHE_JANELA_SEGUNDOS, o atraso máximo com que um worker enxerga escritas de outro.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            geracoes = obter_geracoes(colecoes)
+            chave = (request.full_path, tuple(geracoes[nome][0] for nome in sorted(geracoes)))
+
+            item = cache_respostas.get(chave)
+            if item is not None:
+                corpo, mimetype = item[0]
+                return current_app.response_class(corpo, status=200, mimetype=mimetype)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                corpo = response.get_data()
+                cache_respostas.set(chave, (corpo, response.mimetype), len(corpo))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+import io
+import os
+import csv
+import queue
+import tempfile
+import threading
+from datetime import datetime
+
+try:
+    from openpyxl import Workbook
+    EXCEL_SUPPORT = True
+except ImportError:
+    EXCEL_SUPPORT = False
+
+# Exportação em streaming: as linhas são lidas do banco em lotes (yield_per ou COPY TO STDOUT)
+# e escritas na resposta à medida que chegam, com memória constante qualquer que seja o total.
+
+LOTE_LINHAS = 1000
+BLOCO_BYTES = 64 * 1024
+# Blocos de COPY aguardando o envio ao cliente (limita a memória quando o cliente é lento)
+FILA_BLOCOS = 16
+# Limite de linhas por planilha do formato XLSX (1.048.576 menos o cabeçalho)
+LINHAS_POR_PLANILHA = 1048575
+
+BOM = '\ufeff'  # Para o Excel reconhecer o CSV como UTF-8
+
+
+def _texto_csv(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat(sep=' ')
+    return valor
+
+
+def csv_por_lotes(session, query, cabecalho):
+    """Gera o CSV em blocos a partir de um cursor no servidor (yield_per)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write(BOM)
+    writer.writerow(cabecalho)
+    result = session.execute(query.execution_options(yield_per=LOTE_LINHAS))
+    try:
+        for row in result:
+            writer.writerow([_texto_csv(valor) for valor in row])
+            if buffer.tell() >= BLOCO_BYTES:
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+    finally:
+        result.close()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _EscritorFila:
+    """Objeto-arquivo entregue ao copy_expert: cada write vira um bloco na fila limitada"""
+
+    def __init__(self, fila, cancelado):
+        self.fila = fila
+        self.cancelado = cancelado
+
+    def write(self, dados):
+        while True:
+            if self.cancelado.is_set():
+                # Interrompe o COPY quando o cliente desiste do download
+                raise IOError('Exportação cancelada')
+            try:
+                self.fila.put(dados, timeout=1)
+                return len(dados)
+            except queue.Full:
+                continue
+
+
+def csv_por_copy(engine, query, cabecalho):
+    """Gera o CSV com COPY (consulta) TO STDOUT no Postgres.
+
+    O COPY roda numa thread com conexão própria e entrega os blocos por uma fila limitada;
+    este gerador os repassa ao cliente. Se o cliente desconectar, o gerador é fechado e o
+    COPY é interrompido no próximo bloco."""
+    compilado = query.compile(dialect=engine.dialect)
+    fila = queue.Queue(maxsize=FILA_BLOCOS)
+    cancelado = threading.Event()
+    fim = object()
+    erros = []
+
+    def copiar():
+        conexao = engine.raw_connection()
+        try:
+            cursor = conexao.cursor()
+            # mogrify aplica os parâmetros com o escape do próprio driver
+            consulta = cursor.mogrify(compilado.string, compilado.params).decode('utf-8')
+            cursor.copy_expert(f'COPY ({consulta}) TO STDOUT WITH (FORMAT csv)', _EscritorFila(fila, cancelado))
+            cursor.close()
+        except Exception as e:
+            erros.append(e)
+        finally:
+            conexao.rollback()
+            conexao.close()
+            while not cancelado.is_set():
+                try:
+                    fila.put(fim, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    buffer = io.StringIO()
+    buffer.write(BOM)
+    csv.writer(buffer).writerow(cabecalho)
+    yield buffer.getvalue().encode('utf-8')
+
+    thread = threading.Thread(target=copiar, name='exportacao-copy', daemon=True)
+    thread.start()
+    try:
+        while True:
+            bloco = fila.get()
+            if bloco is fim:
+                break
+            yield bloco
+        if erros:
+            raise erros[0]
+    finally:
+        cancelado.set()
+
+
+def xlsx_temporario(titulo, cabecalho, linhas):
+    """Grava as linhas num .xlsx temporário em modo write-only (sem manter as células em
+    memória) e retorna o caminho. Abre uma nova planilha a cada LINHAS_POR_PLANILHA linhas."""
+    workbook = Workbook(write_only=True)
+    planilha = None
+    contagem = LINHAS_POR_PLANILHA
+    for row in linhas:
+        if contagem >= LINHAS_POR_PLANILHA:
+            numero = len(workbook.worksheets) + 1
+            planilha = workbook.create_sheet(titulo if numero == 1 else f'{titulo} ({numero})')
+            planilha.append(cabecalho)
+            contagem = 0
+        planilha.append(list(row))
+        contagem += 1
+    if planilha is None:
+        workbook.create_sheet(titulo).append(cabecalho)
+
+    descritor, caminho = tempfile.mkstemp(suffix='.xlsx')
+    os.close(descritor)
+    try:
+        workbook.save(caminho)
+    except Exception:
+        os.remove(caminho)
+        raise
+    return caminho
+
+
+def ler_e_remover(caminho):
+    """Envia o arquivo em blocos e o apaga ao final (ou quando o cliente desconecta)"""
+    try:
+        with open(caminho, 'rb') as arquivo:
+            for bloco in iter(lambda: arquivo.read(BLOCO_BYTES), b''):
+                yield bloco
+    finally:
+        os.remove(caminho)
@@ -0,0 +1,55 @@
+from functools import wraps
+from datetime import datetime, timezone
+from flask import request, make_response, current_app
+from src.models.sistema import obter_geracoes
+
+
+def obter_validador(colecoes):
+    """Calcula ETag e Last-Modified das coleções a partir da tabela de gerações.
+
+    Last-Modified tem resolução de segundos: enquanto o segundo da última escrita não
+    terminou, outra escrita no mesmo segundo não mudaria o valor, então ele é omitido
+    (só a ETag valida a resposta)."""
+    geracoes = obter_geracoes(colecoes)
+    etag = '-'.join(f'{nome}.{geracoes[nome][0]}' for nome in sorted(geracoes))
+    datas = [data for _, data in geracoes.values() if data is not None]
+    ultima_modificacao = None
+    if datas and max(datas) < datetime.utcnow().replace(microsecond=0):
+        ultima_modificacao = max(datas).replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, ultima_modificacao
+
+
+def _nao_modificado(etag, ultima_modificacao):
+    # If-None-Match tem precedência sobre If-Modified-Since (RFC 9110)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and ultima_modificacao:
+        return ultima_modificacao <= request.if_modified_since
+    return False
+
+
+def _aplicar_validadores(response, etag, ultima_modificacao):
+    response.set_etag(etag, weak=True)
+    if ultima_modificacao:
+        response.last_modified = ultima_modificacao
+    response.headers['Cache-Control'] = 'no-cache'
+
+
+def condicional(*colecoes):
+    """Decorator de GET condicional: responde 304 sem executar a view quando
+    nenhuma das coleções foi alterada desde a versão que o cliente possui"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag, ultima_modificacao = obter_validador(colecoes)
+            if _nao_modificado(etag, ultima_modificacao):
+                response = current_app.response_class(status=304)
+                _aplicar_validadores(response, etag, ultima_modificacao)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                _aplicar_validadores(response, etag, ultima_modificacao)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,180 @@
+import os
+import random
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import request, jsonify, make_response, current_app
+from sqlalchemy import event, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from src.models.user import db
+from src.models.sistema import ChaveIdempotencia
+
+IDEMPOTENCIA_TTL_HORAS = float(os.environ.get('IDEMPOTENCIA_TTL_HORAS', '24'))
+# Fração das requisições com chave que também apagam as chaves expiradas
+IDEMPOTENCIA_LIMPEZA_PROBABILIDADE = 0.01
+# Prazo da reserva: uma chave 'processando' mais antiga que isso pertence a um processo que
+# morreu antes do commit da view e pode ser reassumida por uma nova tentativa
+IDEMPOTENCIA_RESERVA_SEGUNDOS = int(os.environ.get('IDEMPOTENCIA_RESERVA_SEGUNDOS', '600'))
+
+
+def _impressao_requisicao():
+    """SHA-256 do conteúdo da requisição, para recusar a mesma chave com outro corpo"""
+    impressao = hashlib.sha256()
+    if request.files or request.form:
+        for nome, valor in sorted(request.form.items(multi=True)):
+            impressao.update(f'{nome}={valor}\n'.encode('utf-8'))
+        for nome, arquivo in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            impressao.update(f'{nome}:{arquivo.filename}\n'.encode('utf-8'))
+            for bloco in iter(lambda: arquivo.stream.read(64 * 1024), b''):
+                impressao.update(bloco)
+            arquivo.stream.seek(0)
+    else:
+        impressao.update(request.get_data(cache=True))
+    return impressao.hexdigest()
+
+
+def limpar_chaves_expiradas():
+    """Apaga as chaves cujo TTL já passou; retorna quantas foram removidas"""
+    removidas = ChaveIdempotencia.query.filter(ChaveIdempotencia.expira_em < datetime.utcnow())\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return removidas
+
+
+def _replay(registro):
+    response = current_app.response_class(registro.resposta, status=registro.status_code, mimetype=registro.mimetype)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@event.listens_for(Session, 'before_commit')
+def _efetivar_chave(session):
+    # O primeiro commit da view marca a chave como 'efetivada' na mesma transação: se o
+    # processo morrer antes de guardar a resposta, sabe-se que o efeito já foi gravado
+    registro_id = session.info.pop('idempotencia_registro', None)
+    if registro_id is not None:
+        tabela = ChaveIdempotencia.__table__
+        session.execute(
+            update(tabela).where(tabela.c.id == registro_id, tabela.c.status == 'processando')
+            .values(status='efetivada')
+        )
+
+
+def _reassumir(registro, agora):
+    """Reassume a chave 'processando' cuja reserva venceu (a view nunca chegou ao commit).
+    Só uma requisição consegue; retorna True para ela."""
+    tabela = ChaveIdempotencia.__table__
+    limite = agora - timedelta(seconds=IDEMPOTENCIA_RESERVA_SEGUNDOS)
+    reassumida = db.session.execute(
+        update(tabela)
+        .where(
+            tabela.c.id == registro.id,
+            tabela.c.status == 'processando',
+            or_(tabela.c.reservada_em < limite,
+                tabela.c.reservada_em.is_(None) & (tabela.c.data_criacao < limite))
+        )
+        .values(reservada_em=agora)
+    ).rowcount
+    db.session.commit()
+    return reassumida == 1
+
+
+def _executar(registro_id, view, args, kwargs):
+    db.session.info['idempotencia_registro'] = registro_id
+    response = make_response(view(*args, **kwargs))
+    _finalizar(registro_id, response)
+    if random.random() < IDEMPOTENCIA_LIMPEZA_PROBABILIDADE:
+        limpar_chaves_expiradas()
+    return response
+
+
+def idempotente(view):
+    """Honra o cabeçalho Idempotency-Key: a primeira requisição com a chave é executada e sua
+    resposta guardada; repetições (mesma chave e mesmo endpoint) recebem a resposta guardada
+    sem executar a view de novo. Respostas 5xx não são guardadas, para permitir nova tentativa.
+
+    A reserva da chave tem prazo (IDEMPOTENCIA_RESERVA_SEGUNDOS): se o processo morrer antes
+    do commit da view, uma nova tentativa depois do prazo executa a view; se morrer depois do
+    commit e antes de guardar a resposta, as tentativas são informadas de que a requisição já
+    foi efetivada."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        chave = request.headers.get('Idempotency-Key')
+        if not chave:
+            return view(*args, **kwargs)
+        if len(chave) > 255:
+            return jsonify({'error': 'Idempotency-Key deve ter no máximo 255 caracteres'}), 400
+
+        endpoint = request.path
+        impressao = _impressao_requisicao()
+        agora = datetime.utcnow()
+
+        registro = ChaveIdempotencia.query.filter_by(chave=chave, endpoint=endpoint).first()
+        if registro is not None and registro.expira_em < agora:
+            db.session.delete(registro)
+            db.session.commit()
+            registro = None
+
+        if registro is None:
+            # Reservar a chave antes de executar: requisições simultâneas com a mesma chave
+            # esbarram na constraint única e não executam a view duas vezes
+            registro = ChaveIdempotencia(
+                chave=chave,
+                endpoint=endpoint,
+                impressao=impressao,
+                status='processando',
+                reservada_em=agora,
+                expira_em=agora + timedelta(hours=IDEMPOTENCIA_TTL_HORAS)
+            )
+            try:
+                db.session.add(registro)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                registro = ChaveIdempotencia.query.filter_by(chave=chave, endpoint=endpoint).first()
+                if registro is None:
+                    return jsonify({'error': 'Conflito ao registrar Idempotency-Key, tente novamente'}), 409
+            else:
+                return _executar(registro.id, view, args, kwargs)
+
+        if registro.impressao != impressao:
+            return jsonify({'error': 'Idempotency-Key já utilizada com outra requisição'}), 422
+        if registro.status == 'processando':
+            if _reassumir(registro, agora):
+                return _executar(registro.id, view, args, kwargs)
+            return jsonify({'error': 'Requisição com esta Idempotency-Key ainda em processamento'}), 409
+        if registro.status == 'efetivada':
+            inicio = registro.reservada_em or registro.data_criacao
+            if inicio >= agora - timedelta(seconds=IDEMPOTENCIA_RESERVA_SEGUNDOS):
+                return jsonify({'error': 'Requisição com esta Idempotency-Key ainda em processamento'}), 409
+            # O efeito foi gravado, mas o processo morreu antes de guardar a resposta
+            return jsonify({
+                'error': 'Requisição com esta Idempotency-Key já foi efetivada, mas a resposta original '
+                         'não foi registrada; consulte o recurso em vez de repetir',
+                'efetivada': True
+            }), 409
+        return _replay(registro)
+    return wrapper
+
+
+def _finalizar(registro_id, response):
+    """Guarda a resposta da view na chave reservada (ou libera a chave em caso de erro 5xx,
+    desde que a view não tenha chegado a efetivar nada)"""
+    try:
+        db.session.info.pop('idempotencia_registro', None)
+        db.session.rollback()
+        registro = db.session.get(ChaveIdempotencia, registro_id)
+        if registro is None:
+            return
+        if response.is_streamed or (response.status_code >= 500 and registro.status != 'efetivada'):
+            db.session.delete(registro)
+        else:
+            registro.status = 'concluida'
+            registro.status_code = response.status_code
+            registro.resposta = response.get_data(as_text=True)
+            registro.mimetype = response.mimetype
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f'[AVISO] Não foi possível gravar a resposta da Idempotency-Key {registro_id}: {e}')
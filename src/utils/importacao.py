@@ -0,0 +1,681 @@
+import io
+import csv
+from datetime import date, datetime
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, Text
+from sqlalchemy import and_, exists, func, literal, or_, select
+from src.models.user import db
+from src.models.obra import Obra
+from src.models.produto import Produto, MovimentacaoEstoque, SnapshotEstoque, aplicar_delta_resumo, delta_resumo
+from src.models.produto import aplicar_delta_consumo, ajustar_snapshots, delta_consumo, dia_sql
+from src.models.sistema import marcar_tabelas_alteradas
+from src.utils.sql import insert_dialeto
+
+# Importação em massa de histórico de movimentações (planilhas de sistemas antigos).
+# As linhas são validadas em streaming e gravadas numa tabela temporária (COPY FROM no
+# Postgres, executemany em lotes no SQLite); a partir dela a resolução dos códigos, a
+# inserção no ledger e o recálculo da cadeia quantidade_anterior/quantidade_atual, do
+# estoque dos produtos, dos snapshots e do consumo mensal são feitos com SQL em conjunto.
+
+LOTE_LINHAS = 5000
+LOTE_PRODUTOS = 500
+MAX_ERROS = 1000
+TIPOS = ('entrada', 'saida', 'ajuste')
+FORMATOS_DATA = ('%d/%m/%Y', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S')
+ALIASES_COLUNAS = {'data': 'data_movimentacao', 'produto': 'codigo'}
+
+_temporarias = MetaData()
+IMPORTACAO = Table(
+    'importacao_movimentacoes', _temporarias,
+    Column('linha', Integer, nullable=False),
+    Column('codigo', String(100)),
+    Column('produto_id', Integer),
+    Column('tipo', String(20), nullable=False),
+    Column('quantidade', Integer, nullable=False),
+    Column('delta', Integer, nullable=False),  # variação com sinal aplicada ao estoque
+    Column('motivo', Text),
+    Column('usuario', String(100)),
+    Column('data_movimentacao', DateTime, nullable=False),
+    Column('obra_id', Integer),
+    Index('ix_importacao_movimentacoes_produto', 'produto_id', 'data_movimentacao'),
+    prefixes=['TEMPORARY']
+)
+COLUNAS_IMPORTACAO = [coluna.name for coluna in IMPORTACAO.columns]
+
+
+def _data(valor):
+    if isinstance(valor, datetime):
+        return valor
+    if isinstance(valor, date):
+        return datetime.combine(valor, datetime.min.time())
+    texto = str(valor or '').strip()
+    try:
+        # ISO (AAAA-MM-DD[ HH:MM:SS]) é o formato mais comum e fromisoformat é bem mais rápido
+        return datetime.fromisoformat(texto)
+    except ValueError:
+        pass
+    for formato in FORMATOS_DATA:
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            continue
+    raise ValueError(f'Data inválida: {texto or "vazia"}')
+
+
+def _inteiro(valor, nome):
+    try:
+        numero = float(str(valor).strip().replace(',', '.'))
+    except (TypeError, ValueError):
+        raise ValueError(f'{nome} deve ser um número válido')
+    if numero != int(numero):
+        raise ValueError(f'{nome} deve ser um número inteiro')
+    return int(numero)
+
+
+def _texto(valor):
+    texto = str(valor).strip() if valor is not None else ''
+    return texto or None
+
+
+def validar_linha(row, motivo_padrao, usuario_padrao):
+    """Converte uma linha da planilha num registro da tabela temporária (levanta ValueError).
+
+    Em 'ajuste' a quantidade pode ser negativa (variação com sinal); entradas e saídas
+    exigem quantidade positiva."""
+    row = {ALIASES_COLUNAS.get(chave.lower(), chave.lower()): valor for chave, valor in row.items() if chave}
+    erros = []
+    tipo = (_texto(row.get('tipo')) or '').lower()
+    if tipo not in TIPOS:
+        erros.append(f'Tipo deve ser {", ".join(TIPOS)}')
+    quantidade = delta = 0
+    try:
+        quantidade = _inteiro(row.get('quantidade'), 'Quantidade')
+        if tipo == 'ajuste':
+            delta, quantidade = quantidade, abs(quantidade)
+        elif quantidade <= 0:
+            erros.append('Quantidade deve ser maior que zero')
+        else:
+            delta = quantidade if tipo == 'entrada' else -quantidade
+    except ValueError as e:
+        erros.append(str(e))
+    data_movimentacao = None
+    try:
+        data_movimentacao = _data(row.get('data_movimentacao'))
+    except ValueError as e:
+        erros.append(str(e))
+    codigo = _texto(row.get('codigo'))
+    produto_id = obra_id = None
+    try:
+        if _texto(row.get('produto_id')):
+            produto_id = _inteiro(row.get('produto_id'), 'produto_id')
+        elif not codigo:
+            erros.append('Informe o código ou o produto_id')
+        if _texto(row.get('obra_id')):
+            obra_id = _inteiro(row.get('obra_id'), 'obra_id')
+    except ValueError as e:
+        erros.append(str(e))
+    if erros:
+        raise ValueError('; '.join(erros))
+    return {
+        'codigo': codigo,
+        'produto_id': produto_id,
+        'tipo': tipo,
+        'quantidade': quantidade,
+        'delta': delta,
+        'motivo': _texto(row.get('motivo')) or motivo_padrao,
+        'usuario': _texto(row.get('usuario')) or usuario_padrao,
+        'data_movimentacao': data_movimentacao,
+        'obra_id': obra_id
+    }
+
+
+def _copiar_lote(connection, lote):
+    """Grava um lote na tabela temporária: COPY FROM STDIN no Postgres, executemany no SQLite"""
+    if connection.dialect.name != 'postgresql':
+        connection.execute(IMPORTACAO.insert(), lote)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for registro in lote:
+        writer.writerow([
+            registro['data_movimentacao'].isoformat() if coluna == 'data_movimentacao' else registro[coluna]
+            for coluna in COLUNAS_IMPORTACAO
+        ])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f'COPY {IMPORTACAO.name} ({", ".join(COLUNAS_IMPORTACAO)}) FROM STDIN WITH (FORMAT csv)', buffer
+        )
+    finally:
+        cursor.close()
+
+
+def _preparar_tabela(connection):
+    # No SQLite a tabela temporária vive enquanto a conexão do pool existir
+    IMPORTACAO.drop(connection, checkfirst=True)
+    IMPORTACAO.create(connection)
+
+
+def _carregar(connection, linhas, motivo_padrao, usuario_padrao):
+    """Valida as linhas em streaming e grava as válidas na tabela temporária.
+    Retorna (linhas gravadas, erros)."""
+    erros = []
+    total = 0
+    lote = []
+    for numero, row in linhas:
+        try:
+            registro = validar_linha(row, motivo_padrao, usuario_padrao)
+        except ValueError as e:
+            if len(erros) < MAX_ERROS:
+                erros.append({'linha': numero, 'erros': str(e).split('; ')})
+            continue
+        registro['linha'] = numero
+        lote.append(registro)
+        if len(lote) >= LOTE_LINHAS:
+            _copiar_lote(connection, lote)
+            total += len(lote)
+            lote = []
+    if lote:
+        _copiar_lote(connection, lote)
+        total += len(lote)
+    return total, erros
+
+
+def _erros_referencias(connection):
+    """Linhas com código, produto_id ou obra_id inexistentes (após a resolução dos códigos)"""
+    produtos = Produto.__table__
+    obras = Obra.__table__
+    connection.execute(
+        IMPORTACAO.update()
+        .where(IMPORTACAO.c.produto_id.is_(None))
+        .values(produto_id=select(produtos.c.id).where(produtos.c.codigo == IMPORTACAO.c.codigo).scalar_subquery())
+    )
+    sem_produto = ~exists().where(produtos.c.id == IMPORTACAO.c.produto_id)
+    sem_obra = IMPORTACAO.c.obra_id.is_not(None) & ~exists().where(obras.c.id == IMPORTACAO.c.obra_id)
+    rows = connection.execute(
+        select(IMPORTACAO.c.linha, IMPORTACAO.c.codigo, IMPORTACAO.c.produto_id, IMPORTACAO.c.obra_id, sem_produto)
+        .where(or_(sem_produto, sem_obra))
+        .order_by(IMPORTACAO.c.linha)
+        .limit(MAX_ERROS)
+    )
+    erros = []
+    for linha, codigo, produto_id, obra_id, falta_produto in rows:
+        if falta_produto:
+            mensagem = f'Produto com código {codigo} não encontrado' if codigo else f'Produto {produto_id} não encontrado'
+        else:
+            mensagem = f'Obra {obra_id} não encontrada'
+        erros.append({'linha': linha, 'erros': [mensagem]})
+    return erros
+
+
+def recalcular_cadeia(connection, produto_ids, ultimo_id):
+    """Recalcula quantidade_anterior/quantidade_atual das movimentações dos produtos com uma
+    soma acumulada em janela, e o estoque final de cada produto. Entradas e saídas usam tipo e
+    quantidade; ajustes, a variação já gravada.
+
+    As movimentações com id <= ``ultimo_id`` são o histórico já existente. Só entram na janela
+    as movimentações a partir do dia da importada mais antiga de cada produto, na ordem
+    (dia de data_movimentacao, id): as dispensações gravam só a data, então no mesmo dia vale a
+    ordem em que foram registradas, e as importadas ficam depois das existentes daquele dia. A
+    cadeia parte do estoque anterior à janela (estoque atual menos as variações existentes dentro
+    dela), e o estoque do produto recebe apenas as variações das movimentações novas."""
+    movimentacoes = MovimentacaoEstoque.__table__
+    produtos = Produto.__table__
+    variacao = movimentacoes.c.quantidade_atual - movimentacoes.c.quantidade_anterior
+    delta = db.case(
+        (movimentacoes.c.tipo == 'entrada', movimentacoes.c.quantidade),
+        (movimentacoes.c.tipo == 'saida', -movimentacoes.c.quantidade),
+        else_=func.coalesce(movimentacoes.c.quantidade_atual, 0) - func.coalesce(movimentacoes.c.quantidade_anterior, 0)
+    )
+    dia = dia_sql(connection, movimentacoes.c.data_movimentacao)
+    inicios = select(movimentacoes.c.produto_id, func.min(dia).label('inicio'))\
+        .where(movimentacoes.c.produto_id.in_(produto_ids), movimentacoes.c.id > ultimo_id)\
+        .group_by(movimentacoes.c.produto_id).subquery('inicios')
+    janela = movimentacoes.join(inicios, and_(
+        inicios.c.produto_id == movimentacoes.c.produto_id, dia >= inicios.c.inicio
+    ))
+    existentes = select(movimentacoes.c.produto_id, func.sum(variacao).label('variacao'))\
+        .select_from(janela).where(movimentacoes.c.id <= ultimo_id)\
+        .group_by(movimentacoes.c.produto_id).subquery('existentes')
+    bases = select(
+        produtos.c.id.label('produto_id'),
+        (func.coalesce(produtos.c.estoque, 0) - func.coalesce(existentes.c.variacao, 0)).label('base')
+    ).outerjoin(existentes, existentes.c.produto_id == produtos.c.id)\
+        .where(produtos.c.id.in_(produto_ids)).subquery('bases')
+    acumulado = bases.c.base + func.sum(delta).over(
+        partition_by=movimentacoes.c.produto_id,
+        order_by=(dia, movimentacoes.c.id),
+        rows=(None, 0)
+    )
+    cadeia = select(
+        movimentacoes.c.id,
+        (acumulado - delta).label('anterior'),
+        acumulado.label('atual')
+    ).select_from(janela).join(bases, bases.c.produto_id == movimentacoes.c.produto_id).subquery('cadeia')
+    alteradas = connection.execute(
+        movimentacoes.update()
+        .where(
+            movimentacoes.c.id == cadeia.c.id,
+            or_(movimentacoes.c.quantidade_anterior.is_distinct_from(cadeia.c.anterior),
+                movimentacoes.c.quantidade_atual.is_distinct_from(cadeia.c.atual))
+        )
+        .values(quantidade_anterior=cadeia.c.anterior, quantidade_atual=cadeia.c.atual)
+    ).rowcount
+
+    importadas = select(func.coalesce(func.sum(variacao), 0))\
+        .where(movimentacoes.c.produto_id == produtos.c.id, movimentacoes.c.id > ultimo_id).scalar_subquery()
+    connection.execute(
+        produtos.update()
+        .where(produtos.c.id.in_(produto_ids))
+        .values(estoque=func.coalesce(produtos.c.estoque, 0) + importadas, data_atualizacao=datetime.utcnow())
+    )
+    return alteradas
+
+
+def _ajustar_snapshots(connection, inicio):
+    """Soma às fotos de estoque posteriores a ``inicio`` as variações importadas anteriores a elas"""
+    snapshots = SnapshotEstoque.__table__
+    variacao = select(func.coalesce(func.sum(IMPORTACAO.c.delta), 0)).where(
+        IMPORTACAO.c.produto_id == snapshots.c.produto_id,
+        IMPORTACAO.c.data_movimentacao < snapshots.c.data_referencia
+    ).scalar_subquery()
+    connection.execute(
+        snapshots.update()
+        .where(snapshots.c.data_referencia > inicio,
+               snapshots.c.produto_id.in_(select(IMPORTACAO.c.produto_id).distinct()))
+        .values(estoque=snapshots.c.estoque + variacao)
+    )
+
+
+def importar_movimentacoes(session, linhas, motivo_padrao='Importação de histórico', usuario_padrao='Sistema'):
+    """Importa o histórico de movimentações na transação da sessão (sem commit).
+
+    ``linhas`` é um iterável de (número da linha, {coluna: valor}) com as colunas codigo ou
+    produto_id, tipo, quantidade, data_movimentacao (ou data) e, opcionais, motivo, usuario e
+    obra_id. Havendo qualquer erro nada é gravado: o retorno traz 'erros' e o chamador deve
+    fazer rollback. Retorna {'importadas', 'produtos', 'cadeiasAlteradas', 'estoqueNegativo',
+    'inicio', 'fim', 'erros'}."""
+    connection = session.connection()
+    movimentacoes = MovimentacaoEstoque.__table__
+    produtos = Produto.__table__
+    resultado = {'importadas': 0, 'produtos': 0, 'cadeiasAlteradas': 0, 'estoqueNegativo': 0,
+                 'inicio': None, 'fim': None, 'erros': []}
+
+    _preparar_tabela(connection)
+    # Em caso de exceção o rollback do chamador descarta a tabela temporária
+    total, erros = _carregar(connection, linhas, motivo_padrao, usuario_padrao)
+    if total:
+        erros = sorted(erros + _erros_referencias(connection), key=lambda erro: erro['linha'])[:MAX_ERROS]
+    if erros or not total:
+        IMPORTACAO.drop(connection)
+        resultado['erros'] = erros
+        return resultado
+
+    inicio, fim = connection.execute(
+        select(func.min(IMPORTACAO.c.data_movimentacao), func.max(IMPORTACAO.c.data_movimentacao))
+    ).first()
+    produto_ids = connection.execute(
+        select(IMPORTACAO.c.produto_id).distinct().order_by(IMPORTACAO.c.produto_id)
+    ).scalars().all()
+
+    # Trava os produtos afetados em ordem de id antes de reescrever as cadeias; o estado
+    # anterior dá o delta do resumo
+    campos_resumo = (produtos.c.categoria, produtos.c.ativo, produtos.c.estoque, produtos.c.preco)
+    antes = []
+    for posicao in range(0, len(produto_ids), LOTE_PRODUTOS):
+        antes += connection.execute(
+            select(*campos_resumo).where(produtos.c.id.in_(produto_ids[posicao:posicao + LOTE_PRODUTOS]))
+            .order_by(produtos.c.id).with_for_update()
+        ).all()
+
+    # Cadeia provisória: anterior 0 e atual = variação, de onde recalcular_cadeia lê os ajustes;
+    # as linhas com id acima de ultimo_id são as importadas
+    ultimo_id = connection.execute(select(func.coalesce(func.max(movimentacoes.c.id), 0))).scalar()
+    connection.execute(movimentacoes.insert().from_select(
+        ['produto_id', 'tipo', 'quantidade', 'quantidade_anterior', 'quantidade_atual',
+         'motivo', 'usuario', 'data_movimentacao', 'obra_id'],
+        select(
+            IMPORTACAO.c.produto_id, IMPORTACAO.c.tipo, IMPORTACAO.c.quantidade, literal(0),
+            IMPORTACAO.c.delta, IMPORTACAO.c.motivo, IMPORTACAO.c.usuario,
+            IMPORTACAO.c.data_movimentacao, IMPORTACAO.c.obra_id
+        ).order_by(IMPORTACAO.c.linha)
+    ))
+
+    alteradas = 0
+    for posicao in range(0, len(produto_ids), LOTE_PRODUTOS):
+        lote = produto_ids[posicao:posicao + LOTE_PRODUTOS]
+        alteradas += recalcular_cadeia(connection, lote, ultimo_id)
+
+    # Consumo mensal: soma só as linhas importadas (os meses arquivados continuam intactos)
+    aplicar_delta_consumo(connection, delta_consumo(connection.execute(select(
+        IMPORTACAO.c.produto_id, IMPORTACAO.c.tipo, IMPORTACAO.c.quantidade,
+        literal(0).label('quantidade_anterior'), IMPORTACAO.c.delta.label('quantidade_atual'),
+        IMPORTACAO.c.data_movimentacao
+    )).mappings()))
+
+    # Produtos com histórico anterior ao cadastro passam a existir desde a primeira movimentação
+    primeira = select(func.min(IMPORTACAO.c.data_movimentacao))\
+        .where(IMPORTACAO.c.produto_id == produtos.c.id).scalar_subquery()
+    connection.execute(
+        produtos.update()
+        .where(produtos.c.id.in_(select(IMPORTACAO.c.produto_id)), produtos.c.data_criacao > primeira)
+        .values(data_criacao=primeira)
+    )
+    _ajustar_snapshots(connection, inicio)
+
+    depois = connection.execute(
+        select(*campos_resumo).where(produtos.c.id.in_(select(IMPORTACAO.c.produto_id)))
+    ).all()
+    aplicar_delta_resumo(connection, delta_resumo(antes, depois))
+    negativos = connection.execute(
+        select(func.count(func.distinct(movimentacoes.c.produto_id))).where(
+            movimentacoes.c.produto_id.in_(select(IMPORTACAO.c.produto_id)),
+            movimentacoes.c.quantidade_atual < 0
+        )
+    ).scalar()
+    marcar_tabelas_alteradas(session, Produto.__tablename__, MovimentacaoEstoque.__tablename__, 'consumo_mensal')
+
+    IMPORTACAO.drop(connection)
+    resultado.update({
+        'importadas': total,
+        'produtos': len(produto_ids),
+        'cadeiasAlteradas': alteradas,
+        'estoqueNegativo': negativos,
+        'inicio': inicio,
+        'fim': fim
+    })
+    return resultado
+
+
+# Importação de produtos (upload de planilha). Os produtos existentes são buscados por
+# código em lotes de IN, os produtos são gravados com INSERT ... ON CONFLICT (codigo) DO
+# UPDATE e as movimentações com um único insert em massa; resumo, consumo mensal e gerações
+# são atualizados explicitamente, já que nada disso passa pelos eventos do ORM.
+
+LOTE_CODIGOS = 500
+LOTE_PRODUTOS_UPSERT = 1000
+COLUNAS_OBRIGATORIAS_PRODUTO = ['nome', 'categoria', 'codigo', 'estoque', 'estoque_minimo', 'preco']
+CAMPOS_PRODUTO = ('nome', 'categoria', 'estoque_minimo', 'preco', 'unidade', 'descricao', 'estoque')
+
+
+def produtos_por_codigo(connection, codigos, travar=False):
+    """{codigo: linha (id, codigo, ativo + CAMPOS_PRODUTO)} dos produtos existentes.
+    Com ``travar``, as linhas ficam bloqueadas (FOR UPDATE) até o fim da transação."""
+    produtos = Produto.__table__
+    colunas = [produtos.c.id, produtos.c.codigo, produtos.c.ativo] + [produtos.c[campo] for campo in CAMPOS_PRODUTO]
+    codigos = sorted(codigos)
+    existentes = {}
+    for posicao in range(0, len(codigos), LOTE_CODIGOS):
+        query = select(*colunas).where(produtos.c.codigo.in_(codigos[posicao:posicao + LOTE_CODIGOS]))
+        if travar:
+            query = query.order_by(produtos.c.id).with_for_update()
+        for row in connection.execute(query):
+            existentes[row.codigo] = row
+    return existentes
+
+
+def validar_linha_produto(row, validar_precos=False, validar_estoque=False):
+    """Valida uma linha da planilha de produtos. Retorna (dados normalizados, erros)."""
+    erros = []
+
+    if not str(row.get('nome', '')).strip():
+        erros.append('Nome é obrigatório')
+    if not str(row.get('categoria', '')).strip():
+        erros.append('Categoria é obrigatória')
+    if not str(row.get('codigo', '')).strip():
+        erros.append('Código é obrigatório')
+
+    try:
+        estoque = int(float(row.get('estoque', 0)))
+        if validar_estoque and estoque < 0:
+            erros.append('Estoque deve ser um número positivo')
+    except (ValueError, TypeError):
+        erros.append('Estoque deve ser um número válido')
+        estoque = 0
+
+    try:
+        estoque_minimo = int(float(row.get('estoque_minimo', 0)))
+        if estoque_minimo < 0:
+            erros.append('Estoque mínimo deve ser um número positivo')
+    except (ValueError, TypeError):
+        erros.append('Estoque mínimo deve ser um número válido')
+        estoque_minimo = 0
+
+    try:
+        preco = float(row.get('preco', 0))
+        if validar_precos and preco <= 0:
+            erros.append('Preço deve ser maior que zero')
+    except (ValueError, TypeError):
+        erros.append('Preço deve ser um número válido')
+        preco = 0.0
+
+    return {
+        'nome': str(row.get('nome', '')).strip(),
+        'categoria': str(row.get('categoria', '')).strip(),
+        'codigo': str(row.get('codigo', '')).strip(),
+        'estoque': estoque,
+        'estoque_minimo': estoque_minimo,
+        'preco': preco,
+        'unidade': str(row.get('unidade', 'unidade')).strip() or 'unidade',
+        'descricao': str(row.get('descricao', '')).strip()
+    }, erros
+
+
+def _verificar_codigos(connection, lote, validar_duplicados, atualizar_existentes, validas, erros, avisos):
+    """Confere um lote de linhas já validadas (número, dados, erros) contra os produtos existentes"""
+    existentes = produtos_por_codigo(connection, {dados['codigo'] for _, dados, _ in lote if dados['codigo']})
+    for numero, dados, erros_linha in lote:
+        avisos_linha = []
+        existente = existentes.get(dados['codigo'])
+        if existente is not None and existente.ativo is False:
+            # O código é único: o produto inativo não pode ser recriado nem é atualizado
+            erros_linha.append(f'Produto com código {dados["codigo"]} está inativo')
+        elif existente is not None and validar_duplicados:
+            if atualizar_existentes:
+                avisos_linha.append(f'Produto com código {dados["codigo"]} será atualizado')
+            else:
+                erros_linha.append(f'Produto com código {dados["codigo"]} já existe')
+
+        if erros_linha:
+            erros.append({'linha': numero, 'erros': erros_linha})
+            continue
+        if avisos_linha:
+            avisos.append({'linha': numero, 'avisos': avisos_linha})
+        dados['linha'] = numero
+        validas.append(dados)
+
+
+def validar_planilha_produtos(connection, linhas, validar_duplicados=False, validar_precos=False,
+                              validar_estoque=False, atualizar_existentes=False, progresso=None,
+                              lote_progresso=LOTE_LINHAS):
+    """Valida as linhas (número, {coluna: valor}) da planilha de produtos.
+
+    As linhas são lidas em lotes de LOTE_CODIGOS e os códigos de cada lote conferidos com
+    produtos_por_codigo(); só as linhas válidas já normalizadas ficam em memória.
+    ``progresso(lidas, validas)`` é chamado a cada ``lote_progresso`` linhas lidas.
+    Retorna (linhas válidas, erros, avisos)."""
+    validas, erros, avisos = [], [], []
+    lote = []
+    lidas = 0
+    for numero, row in linhas:
+        dados, erros_linha = validar_linha_produto(row, validar_precos, validar_estoque)
+        lote.append((numero, dados, erros_linha))
+        lidas += 1
+        if len(lote) == LOTE_CODIGOS:
+            _verificar_codigos(connection, lote, validar_duplicados, atualizar_existentes, validas, erros, avisos)
+            lote = []
+        if progresso is not None and lidas % lote_progresso == 0:
+            _verificar_codigos(connection, lote, validar_duplicados, atualizar_existentes, validas, erros, avisos)
+            lote = []
+            progresso(lidas, len(validas))
+    _verificar_codigos(connection, lote, validar_duplicados, atualizar_existentes, validas, erros, avisos)
+    return validas, erros, avisos
+
+
+# Valor gravado quando a coluna do produto está vazia, para comparar com a planilha
+VAZIOS_PRODUTO = {'estoque': 0, 'estoque_minimo': 0, 'preco': 0.0, 'unidade': 'unidade', 'descricao': ''}
+ACOES_PREVIA = ('create', 'update', 'unchanged', 'error')
+
+
+def _campos_produto(row):
+    valores = row._mapping
+    return {campo: VAZIOS_PRODUTO.get(campo) if valores[campo] is None else valores[campo] for campo in CAMPOS_PRODUTO}
+
+
+def classificar_produtos(connection, validas, erros, atualizar_existentes=False):
+    """Prévia da gravação: classifica cada linha em create, update, unchanged ou error, com as
+    diferenças campo a campo (before/after) das atualizações.
+
+    Os produtos existentes são lidos de uma vez com produtos_por_codigo() e as linhas são
+    comparadas na ordem em que gravar_produtos() as aplicaria (um código repetido é comparado
+    com a linha anterior). Retorna (linhas classificadas por número de linha, estado dos
+    produtos {codigo: campos ou None}) — o estado permite conferir na gravação que nada mudou."""
+    existentes = produtos_por_codigo(connection, {linha['codigo'] for linha in validas})
+    estado = {linha['codigo']: None for linha in validas}
+    estado.update({codigo: _campos_produto(row) for codigo, row in existentes.items()})
+    atuais = {codigo: campos for codigo, campos in estado.items() if campos is not None}
+
+    classificadas = [{'line': erro['linha'], 'action': 'error', 'errors': erro['erros']} for erro in erros]
+    for linha in validas:
+        codigo = linha['codigo']
+        atual = atuais.get(codigo)
+        if atual is None:
+            classificadas.append({'line': linha['linha'], 'action': 'create', 'code': codigo})
+        elif not atualizar_existentes:
+            classificadas.append({'line': linha['linha'], 'action': 'unchanged', 'code': codigo})
+            continue
+        else:
+            mudancas = {
+                campo: {'before': atual[campo], 'after': linha[campo]}
+                for campo in CAMPOS_PRODUTO if atual[campo] != linha[campo]
+            }
+            if mudancas:
+                classificadas.append({'line': linha['linha'], 'action': 'update', 'code': codigo, 'changes': mudancas})
+            else:
+                classificadas.append({'line': linha['linha'], 'action': 'unchanged', 'code': codigo})
+        atuais[codigo] = {campo: linha[campo] for campo in CAMPOS_PRODUTO}
+    classificadas.sort(key=lambda linha: linha['line'])
+    return classificadas, estado
+
+
+def produtos_alterados(connection, estado):
+    """Códigos cujo produto mudou desde ``estado`` (de classificar_produtos). As linhas ficam
+    bloqueadas até o fim da transação, para que a gravação em seguida use o mesmo estado."""
+    atuais = produtos_por_codigo(connection, estado.keys(), travar=True)
+    return sorted(
+        codigo for codigo, campos in estado.items()
+        if (_campos_produto(atuais[codigo]) if codigo in atuais else None) != campos
+    )
+
+
+def _planejar_produtos(linhas, existentes, atualizar_existentes):
+    """Aplica as linhas em ordem sobre os produtos existentes.
+    Retorna ({codigo: linha final}, movimentações, criados, atualizados)."""
+    estoques = {codigo: row.estoque or 0 for codigo, row in existentes.items()}
+    finais = {}
+    movimentacoes = []
+    criados = atualizados = 0
+    for linha in linhas:
+        codigo = linha['codigo']
+        existente = existentes.get(codigo)
+        if existente is not None and existente.ativo is False:
+            raise ValueError(f'Produto com código {codigo} está inativo')
+        if codigo in estoques:
+            if not atualizar_existentes:
+                continue
+            anterior = estoques[codigo]
+            if linha['estoque'] != anterior:
+                diferenca = linha['estoque'] - anterior
+                movimentacoes.append((codigo, 'entrada' if diferenca > 0 else 'saida', abs(diferenca),
+                                      anterior, linha['estoque'], 'Atualização via planilha'))
+            atualizados += 1
+        else:
+            if linha['estoque'] > 0:
+                movimentacoes.append((codigo, 'entrada', linha['estoque'], 0, linha['estoque'],
+                                      'Estoque inicial via planilha'))
+            criados += 1
+        estoques[codigo] = linha['estoque']
+        finais[codigo] = linha
+    return finais, movimentacoes, criados, atualizados
+
+def gravar_produtos(session, linhas, atualizar_existentes=False, usuario='Sistema', progresso=None):
+    """Cria e atualiza os produtos das linhas validadas na transação da sessão (sem commit).
+
+    Códigos existentes só são atualizados com ``atualizar_existentes``; a mudança de estoque
+    gera uma movimentação ('Atualização via planilha') e produtos novos com estoque recebem
+    a movimentação de estoque inicial. Códigos repetidos na planilha são aplicados em ordem.
+    Os novos são inseridos com ON CONFLICT DO NOTHING: um código criado por outra transação
+    nesse meio-tempo é travado e segue como existente.
+    ``progresso(gravados)`` é chamado depois de cada lote de produtos gravado.
+    Retorna (criados, atualizados)."""
+    connection = session.connection()
+    produtos = Produto.__table__
+    agora = datetime.utcnow()
+    existentes = produtos_por_codigo(connection, {linha['codigo'] for linha in linhas}, travar=True)
+    finais, movimentacoes, criados, atualizados = _planejar_produtos(linhas, existentes, atualizar_existentes)
+
+    def _valores(codigos):
+        return [
+            dict({campo: finais[codigo][campo] for campo in CAMPOS_PRODUTO}, codigo=codigo, data_atualizacao=agora)
+            for codigo in codigos
+        ]
+
+    ids = {}
+    gravados = 0
+    novos = _valores([codigo for codigo in finais if codigo not in existentes])
+    for posicao in range(0, len(novos), LOTE_PRODUTOS_UPSERT):
+        lote = novos[posicao:posicao + LOTE_PRODUTOS_UPSERT]
+        stmt = insert_dialeto(connection, produtos).on_conflict_do_nothing(index_elements=[produtos.c.codigo])\
+            .returning(produtos.c.id, produtos.c.codigo)
+        for produto_id, codigo in connection.execute(stmt, lote):
+            ids[codigo] = produto_id
+        gravados += len(lote)
+        if progresso is not None:
+            progresso(gravados)
+
+    conflitos = {valores['codigo'] for valores in novos} - set(ids)
+    if conflitos:
+        existentes.update(produtos_por_codigo(connection, conflitos, travar=True))
+        finais, movimentacoes, criados, atualizados = _planejar_produtos(linhas, existentes, atualizar_existentes)
+
+    ids.update((codigo, row.id) for codigo, row in existentes.items())
+    alterados = _valores([codigo for codigo in finais if codigo in existentes])
+    for posicao in range(0, len(alterados), LOTE_PRODUTOS_UPSERT):
+        lote = alterados[posicao:posicao + LOTE_PRODUTOS_UPSERT]
+        connection.execute(
+            produtos.update()
+            .where(produtos.c.codigo == db.bindparam('p_codigo'))
+            .values({campo: db.bindparam(f'p_{campo}') for campo in CAMPOS_PRODUTO + ('data_atualizacao',)}),
+            [{f'p_{campo}': valor for campo, valor in valores.items()} for valores in lote]
+        )
+        gravados += len(lote)
+        if progresso is not None:
+            progresso(gravados)
+
+    if movimentacoes:
+        registros = [{
+            'produto_id': ids[codigo],
+            'tipo': tipo,
+            'quantidade': quantidade,
+            'quantidade_anterior': anterior,
+            'quantidade_atual': atual,
+            'motivo': motivo,
+            'usuario': usuario,
+            'data_movimentacao': agora
+        } for codigo, tipo, quantidade, anterior, atual, motivo in movimentacoes]
+        connection.execute(MovimentacaoEstoque.__table__.insert(), registros)
+        aplicar_delta_consumo(connection, delta_consumo(registros))
+        ajustar_snapshots(connection, registros)
+
+    if finais:
+        antes = [
+            (row.categoria, row.ativo, row.estoque, row.preco)
+            for codigo, row in existentes.items() if codigo in finais
+        ]
+        depois = [
+            (linha['categoria'], existentes[codigo].ativo if codigo in existentes else True, linha['estoque'], linha['preco'])
+            for codigo, linha in finais.items()
+        ]
+        aplicar_delta_resumo(connection, delta_resumo(antes, depois))
+        marcar_tabelas_alteradas(session, Produto.__tablename__, MovimentacaoEstoque.__tablename__, 'consumo_mensal')
+    return criados, atualizados
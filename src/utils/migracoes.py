@@ -0,0 +1,169 @@
+from sqlalchemy import text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from src.models.user import db
+from src.utils.particionamento import tabela_particionada
+
+# Consultas representativas usadas no relatório de planos antes/depois da criação dos índices
+CONSULTAS_RELATORIO = {
+    'Histórico de um produto (get_movimentacoes_produto)': (
+        'SELECT id FROM movimentacoes_estoque WHERE produto_id = 1 '
+        'ORDER BY data_movimentacao DESC, id DESC'
+    ),
+    'Página do ledger por data (get_movimentacoes)': (
+        'SELECT id FROM movimentacoes_estoque '
+        'ORDER BY data_movimentacao DESC, id DESC LIMIT 50'
+    ),
+    'Alertas de estoque baixo (get_alertas_estoque)': (
+        'SELECT count(*) FROM produtos WHERE ativo = {verdadeiro} AND estoque <= estoque_minimo'
+    )
+}
+
+
+def _indices_existentes(connection, tabela):
+    if connection.dialect.name == 'postgresql':
+        # Índices inválidos (CONCURRENTLY interrompido) contam como ausentes
+        rows = connection.execute(text(
+            'SELECT c.relname FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_class t ON t.oid = i.indrelid '
+            'WHERE t.relname = :tabela AND t.relnamespace = current_schema()::regnamespace AND i.indisvalid'
+        ), {'tabela': tabela})
+    else:
+        rows = connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :tabela"
+        ), {'tabela': tabela})
+    return {nome for (nome,) in rows}
+
+
+def _tabelas_existentes(connection):
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text(
+            'SELECT tablename FROM pg_tables WHERE schemaname = current_schema()'
+        ))
+    else:
+        rows = connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    return {nome for (nome,) in rows}
+
+
+def indices_ausentes(engine):
+    """Índices declarados nos models que ainda não existem em tabelas já criadas"""
+    with engine.connect() as connection:
+        tabelas = _tabelas_existentes(connection)
+        ausentes = []
+        for tabela in db.metadata.sorted_tables:
+            if tabela.name not in tabelas:
+                continue
+            existentes = _indices_existentes(connection, tabela.name)
+            ausentes.extend(index for index in sorted(tabela.indexes, key=lambda ix: ix.name)
+                            if index.name not in existentes)
+    return ausentes
+
+
+def _colunas_existentes(connection, tabela):
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text(
+            'SELECT column_name FROM information_schema.columns '
+            'WHERE table_name = :tabela AND table_schema = current_schema()'
+        ), {'tabela': tabela})
+        return {nome for (nome,) in rows}
+    return {row[1] for row in connection.execute(text(f'PRAGMA table_info("{tabela}")'))}
+
+
+def colunas_ausentes(engine):
+    """Colunas declaradas nos models que ainda não existem em tabelas já criadas"""
+    with engine.connect() as connection:
+        tabelas = _tabelas_existentes(connection)
+        ausentes = []
+        for tabela in db.metadata.sorted_tables:
+            if tabela.name not in tabelas:
+                continue
+            existentes = _colunas_existentes(connection, tabela.name)
+            ausentes.extend(coluna for coluna in tabela.columns if coluna.name not in existentes)
+    return ausentes
+
+
+def adicionar_colunas_ausentes(engine, saida=print):
+    """Adiciona as colunas ausentes (create_all() não altera tabelas existentes).
+
+    Só colunas anuláveis e sem default no servidor, que os dois bancos adicionam sem
+    reescrever a tabela; as chaves estrangeiras vão junto na definição. Retorna os nomes."""
+    adicionadas = []
+    postgres = engine.dialect.name == 'postgresql'
+    for coluna in colunas_ausentes(engine):
+        if not coluna.nullable or coluna.server_default is not None:
+            raise ValueError(f'Coluna {coluna.table.name}.{coluna.name} exige migração manual')
+        definicao = str(CreateColumn(coluna).compile(dialect=engine.dialect))
+        for fk in coluna.foreign_keys:
+            definicao += f' REFERENCES {fk.column.table.name} ({fk.column.name})'
+            if fk.ondelete:
+                definicao += f' ON DELETE {fk.ondelete}'
+        # IF NOT EXISTS: vários workers podem aplicar a mesma migração ao iniciar
+        existe = ' IF NOT EXISTS' if postgres else ''
+        saida(f'Adicionando coluna {coluna.name} em {coluna.table.name}...')
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE {coluna.table.name} ADD COLUMN{existe} {definicao}'))
+        adicionadas.append(f'{coluna.table.name}.{coluna.name}')
+    return adicionadas
+
+
+def _remover_indice_invalido(connection, nome):
+    # Um CREATE INDEX CONCURRENTLY interrompido deixa um índice inválido com o mesmo nome
+    invalido = connection.execute(text(
+        'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = :nome AND NOT i.indisvalid'
+    ), {'nome': nome}).first()
+    if invalido:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{nome}"'))
+
+
+def _particionada(engine, tabela):
+    # CREATE INDEX CONCURRENTLY não é suportado na tabela pai de um particionamento
+    with engine.connect() as connection:
+        return tabela_particionada(connection, tabela)
+
+
+def criar_indices_ausentes(engine, concorrente=True, saida=print):
+    """Cria os índices ausentes em bancos existentes.
+
+    No Postgres usa CREATE INDEX CONCURRENTLY (fora de transação, sem bloquear escritas na
+    tabela), exceto em tabelas particionadas; no SQLite cria cada índice numa transação
+    curta. Retorna os nomes criados.
+    """
+    criados = []
+    postgres = engine.dialect.name == 'postgresql'
+    for index in indices_ausentes(engine):
+        saida(f'Criando índice {index.name} em {index.table.name}...')
+        if postgres and concorrente and not _particionada(engine, index.table.name):
+            opcoes = index.dialect_options['postgresql']
+            concorrente_anterior = opcoes['concurrently']
+            opcoes['concurrently'] = True
+            try:
+                with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    _remover_indice_invalido(connection, index.name)
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+            finally:
+                opcoes['concurrently'] = concorrente_anterior
+        else:
+            with engine.begin() as connection:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+        criados.append(index.name)
+    return criados
+
+
+def relatorio_planos(engine):
+    """Plano de execução das consultas de CONSULTAS_RELATORIO no banco atual: {titulo: [linhas]}"""
+    relatorio = {}
+    with engine.connect() as connection:
+        tabelas = _tabelas_existentes(connection)
+        if not {'movimentacoes_estoque', 'produtos'} <= tabelas:
+            return relatorio
+        postgres = connection.dialect.name == 'postgresql'
+        for titulo, consulta in CONSULTAS_RELATORIO.items():
+            consulta = consulta.format(verdadeiro='true' if postgres else '1')
+            if postgres:
+                rows = connection.execute(text(f'EXPLAIN {consulta}'))
+                relatorio[titulo] = [linha for (linha,) in rows]
+            else:
+                rows = connection.execute(text(f'EXPLAIN QUERY PLAN {consulta}'))
+                relatorio[titulo] = [row[-1] for row in rows]
+    return relatorio
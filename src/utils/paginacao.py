@@ -0,0 +1,36 @@
+import base64
+import json
+
+LIMITE_PADRAO = 50
+LIMITE_MAXIMO = 500
+
+
+def parse_limite(valor, padrao=LIMITE_PADRAO, maximo=LIMITE_MAXIMO):
+    """Converte o parâmetro ``limit`` da query string em um inteiro entre 1 e ``maximo``"""
+    try:
+        limite = int(valor) if valor not in (None, '') else padrao
+    except (TypeError, ValueError):
+        raise ValueError('Parâmetro limit deve ser um número inteiro')
+    return max(1, min(limite, maximo))
+
+
+def parse_bool(valor):
+    return str(valor or '').lower() in ['true', '1', 'yes', 'sim']
+
+
+def encode_cursor(valores):
+    """Gera um cursor opaco a partir dos valores da chave de ordenação da última linha"""
+    payload = json.dumps(valores, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, tamanho):
+    """Decodifica um cursor gerado por ``encode_cursor`` validando a quantidade de valores"""
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+    except Exception:
+        raise ValueError('Cursor inválido')
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        raise ValueError('Cursor inválido')
+    return valores
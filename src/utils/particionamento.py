@@ -0,0 +1,201 @@
+import os
+import gzip
+from datetime import date, datetime
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+from src.models.user import db
+from src.models.produto import MovimentacaoEstoque, SnapshotEstoque, estoque_em
+
+# Particionamento mensal opcional de movimentacoes_estoque (apenas Postgres).
+# A tabela pai mantém o nome original, então o model e os endpoints continuam lendo e
+# gravando em movimentacoes_estoque; o Postgres direciona cada linha para a partição do mês
+# de data_movimentacao (linhas sem data, ou fora das partições criadas, vão para a padrão).
+
+TABELA = MovimentacaoEstoque.__tablename__
+PARTICAO_PADRAO = f'{TABELA}_padrao'
+PARTICOES_FUTURAS_MESES = int(os.environ.get('PARTICOES_FUTURAS_MESES', '3'))
+ARQUIVO_DIRETORIO = os.environ.get(
+    'ARQUIVO_MOVIMENTACOES_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'arquivo')
+)
+
+
+def _somar_meses(mes, quantidade):
+    indice = mes.year * 12 + mes.month - 1 + quantidade
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _nome_particao(mes):
+    return f'{TABELA}_p{mes.year:04d}{mes.month:02d}'
+
+
+def tabela_particionada(connection, nome=TABELA):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text(
+        "SELECT 1 FROM pg_class WHERE relname = :nome AND relkind = 'p' "
+        "AND relnamespace = current_schema()::regnamespace"
+    ), {'nome': nome}).first() is not None
+
+
+def listar_particoes(connection):
+    """Partições mensais existentes: [(nome, inicio, fim)] em ordem cronológica (sem a padrão)"""
+    rows = connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = :tabela AND p.relnamespace = current_schema()::regnamespace'
+    ), {'tabela': TABELA}).scalars().all()
+    particoes = []
+    for nome in rows:
+        sufixo = nome[len(TABELA) + 2:]
+        if nome.startswith(f'{TABELA}_p') and len(sufixo) == 6 and sufixo.isdigit():
+            inicio = date(int(sufixo[:4]), int(sufixo[4:]), 1)
+            particoes.append((nome, inicio, _somar_meses(inicio, 1)))
+    return sorted(particoes, key=lambda particao: particao[1])
+
+
+def criar_particao(connection, mes):
+    """Cria a partição do mês movendo para ela as linhas do período que estejam na padrão.
+
+    ATTACH PARTITION recusa períodos com linhas na partição padrão, então a partição é criada
+    como tabela comum, recebe essas linhas e só então é anexada."""
+    nome = _nome_particao(mes)
+    inicio, fim = mes, _somar_meses(mes, 1)
+    parametros = {'inicio': inicio, 'fim': fim}
+    connection.execute(text(f'CREATE TABLE "{nome}" (LIKE {TABELA} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    connection.execute(text(
+        f'WITH movidas AS (DELETE FROM "{PARTICAO_PADRAO}" '
+        f'WHERE data_movimentacao >= :inicio AND data_movimentacao < :fim RETURNING *) '
+        f'INSERT INTO "{nome}" SELECT * FROM movidas'
+    ), parametros)
+    connection.execute(text(
+        f"ALTER TABLE {TABELA} ATTACH PARTITION \"{nome}\" FOR VALUES FROM ('{inicio}') TO ('{fim}')"
+    ))
+    return nome
+
+
+def criar_particoes_futuras(connection, meses=PARTICOES_FUTURAS_MESES):
+    """Garante partições do mês atual até ``meses`` meses à frente; retorna as criadas"""
+    existentes = {inicio for _, inicio, _ in listar_particoes(connection)}
+    atual = date.today().replace(day=1)
+    criadas = []
+    for deslocamento in range(meses + 1):
+        mes = _somar_meses(atual, deslocamento)
+        if mes not in existentes:
+            criadas.append(criar_particao(connection, mes))
+    return criadas
+
+
+def particionar_movimentacoes(connection, meses_futuros=PARTICOES_FUTURAS_MESES):
+    """Converte movimentacoes_estoque numa tabela particionada por mês de data_movimentacao.
+
+    Migração offline: copia todas as linhas numa única transação e trava a tabela durante a
+    cópia, então deve ser executada numa janela de manutenção. O id continua vindo da mesma
+    sequence; a chave primária passa a ser (id, data_movimentacao), exigência do Postgres
+    para tabelas particionadas.
+    """
+    if tabela_particionada(connection):
+        return []
+    sem_data = connection.execute(text(f'SELECT count(*) FROM {TABELA} WHERE data_movimentacao IS NULL')).scalar()
+    if sem_data:
+        # data_movimentacao passa a fazer parte da chave primária
+        raise ValueError(f'{sem_data} movimentações sem data_movimentacao; preencha as datas antes de particionar')
+    legado = f'{TABELA}_legado'
+    connection.execute(text(f'LOCK TABLE {TABELA} IN ACCESS EXCLUSIVE MODE'))
+    connection.execute(text(f'ALTER TABLE {TABELA} RENAME TO {legado}'))
+    connection.execute(text(
+        f'CREATE TABLE {TABELA} (LIKE {legado} INCLUDING DEFAULTS) PARTITION BY RANGE (data_movimentacao)'
+    ))
+    connection.execute(text(f'CREATE TABLE "{PARTICAO_PADRAO}" PARTITION OF {TABELA} DEFAULT'))
+
+    limites = connection.execute(text(f'SELECT min(data_movimentacao), max(data_movimentacao) FROM {legado}')).first()
+    atual = date.today().replace(day=1)
+    inicio = limites[0].date().replace(day=1) if limites[0] else atual
+    fim = max(limites[1].date().replace(day=1), atual) if limites[1] else atual
+    mes = inicio
+    while mes <= _somar_meses(fim, meses_futuros):
+        nome, proximo = _nome_particao(mes), _somar_meses(mes, 1)
+        connection.execute(text(
+            f"CREATE TABLE \"{nome}\" PARTITION OF {TABELA} FOR VALUES FROM ('{mes}') TO ('{proximo}')"
+        ))
+        mes = proximo
+
+    connection.execute(text(f'INSERT INTO {TABELA} SELECT * FROM {legado}'))
+    connection.execute(text(f'ALTER SEQUENCE {TABELA}_id_seq OWNED BY {TABELA}.id'))
+    connection.execute(text(f'DROP TABLE {legado}'))
+
+    # Chave, FK e índices do model, agora declarados na tabela pai e propagados às partições
+    connection.execute(text(f'ALTER TABLE {TABELA} ADD PRIMARY KEY (id, data_movimentacao)'))
+    connection.execute(text(
+        f'ALTER TABLE {TABELA} ADD CONSTRAINT {TABELA}_produto_id_fkey '
+        f'FOREIGN KEY (produto_id) REFERENCES produtos (id)'
+    ))
+    connection.execute(text(
+        f'ALTER TABLE {TABELA} ADD CONSTRAINT {TABELA}_obra_id_fkey '
+        f'FOREIGN KEY (obra_id) REFERENCES obras (id) ON DELETE SET NULL'
+    ))
+    for index in MovimentacaoEstoque.__table__.indexes:
+        connection.execute(CreateIndex(index))
+    return [nome for nome, _, _ in listar_particoes(connection)]
+
+
+def _gravar_snapshot_limite(connection, momento):
+    """Lote de snapshot no limite do período arquivado, para que consultas de estoque em
+    datas posteriores continuem exatas sem as movimentações arquivadas"""
+    existe = connection.execute(
+        SnapshotEstoque.__table__.select().where(SnapshotEstoque.data_referencia == momento).limit(1)
+    ).first()
+    if existe:
+        return
+    _, rows = estoque_em(connection, momento)
+    if rows:
+        connection.execute(SnapshotEstoque.__table__.insert(), [
+            {'data_referencia': momento, 'produto_id': row.id, 'estoque': row.estoque} for row in rows
+        ])
+
+
+def arquivar_particoes(engine, retencao_meses, diretorio=ARQUIVO_DIRETORIO, saida=print):
+    """Desanexa as partições que terminam antes de ``retencao_meses`` meses atrás, exporta cada
+    uma para <diretorio>/<particao>.csv.gz (COPY TO STDOUT) e a remove. Retorna os arquivos.
+
+    Os totais do consumo mensal ficam preservados; o estoque em datas dentro do período
+    arquivado passa a ser respondido apenas a partir dos snapshots."""
+    os.makedirs(diretorio, exist_ok=True)
+    limite = _somar_meses(date.today().replace(day=1), -retencao_meses)
+    arquivos = []
+    with engine.connect() as connection:
+        antigas = [particao for particao in listar_particoes(connection) if particao[2] <= limite]
+    for nome, inicio, fim in antigas:
+        caminho = os.path.join(diretorio, f'{nome}.csv.gz')
+        with engine.begin() as connection:
+            _gravar_snapshot_limite(connection, datetime.combine(fim, datetime.min.time()))
+            connection.execute(text(f'ALTER TABLE {TABELA} DETACH PARTITION "{nome}"'))
+            total = connection.execute(text(f'SELECT count(*) FROM "{nome}"')).scalar()
+
+            # O arquivo é gravado antes do DROP; se a exportação falhar a transação inteira
+            # é desfeita e a partição continua anexada
+            temporario = caminho + '.parcial'
+            cursor = connection.connection.cursor()
+            try:
+                with gzip.open(temporario, 'wb') as arquivo:
+                    cursor.copy_expert(f'COPY "{nome}" TO STDOUT WITH (FORMAT csv, HEADER true)', arquivo)
+            finally:
+                cursor.close()
+            connection.execute(text(f'DROP TABLE "{nome}"'))
+        os.replace(temporario, caminho)
+        saida(f'Partição {nome} ({inicio} a {fim}): {total} movimentações arquivadas em {caminho}')
+        arquivos.append(caminho)
+    return arquivos
+
+
+def manter_particoes():
+    """Tarefa periódica: cria as partições futuras quando a tabela está particionada"""
+    connection = db.session.connection()
+    # Vários workers executam a tarefa; só um cria as partições
+    bloqueio = connection.execute(text('SELECT pg_try_advisory_xact_lock(hashtext(:nome))'), {'nome': TABELA}).scalar()
+    if bloqueio and tabela_particionada(connection):
+        criadas = criar_particoes_futuras(connection)
+        if criadas:
+            print(f'Partições criadas: {", ".join(criadas)}')
+    db.session.commit()
@@ -0,0 +1,108 @@
+import io
+import csv
+
+try:
+    import openpyxl
+    EXCEL_SUPPORT = True
+except ImportError:
+    EXCEL_SUPPORT = False
+
+# Leitura em streaming de planilhas CSV e Excel: o encoding e o delimitador do CSV são
+# detectados numa amostra do início do arquivo e as linhas são lidas uma a uma, sem carregar
+# o arquivo inteiro em memória.
+
+AMOSTRA_BYTES = 64 * 1024
+DELIMITADORES = (';', ',', '\t')
+EXTENSOES = ('.csv', '.xlsx', '.xls')
+
+
+def extensao_planilha(nome_arquivo):
+    """Extensão suportada do arquivo (.csv, .xlsx, .xls) ou None"""
+    nome = (nome_arquivo or '').lower()
+    for extensao in EXTENSOES:
+        if nome.endswith(extensao):
+            return extensao
+    return None
+
+
+def detectar_encoding(amostra):
+    """UTF-8 (com ou sem BOM) quando a amostra é UTF-8 válido; senão cp1252 ou latin-1"""
+    try:
+        amostra.decode('utf-8')
+        return 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Caractere multibyte cortado no fim da amostra
+        if e.reason == 'unexpected end of data' and e.start >= len(amostra) - 3:
+            return 'utf-8-sig'
+    try:
+        amostra.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def detectar_delimitador(texto):
+    """Delimitador mais frequente na linha de cabeçalho"""
+    cabecalho = texto.split('\n', 1)[0]
+    return max(DELIMITADORES, key=cabecalho.count)
+
+
+class Planilha:
+    """Planilha aberta para leitura: ``colunas`` com o cabeçalho e iteração em
+    (número da linha, {coluna: valor}), pulando linhas vazias.
+
+    Os valores do CSV são textos; os do Excel, os valores das células (ou textos, com
+    ``como_texto``, células vazias como ''). Use como context manager para que o arquivo e
+    o workbook sejam fechados ao final."""
+
+    def __init__(self, arquivo, nome_arquivo, como_texto=False):
+        self.extensao = extensao_planilha(nome_arquivo)
+        self.como_texto = como_texto
+        self._workbook = None
+        self._texto = None
+        if self.extensao == '.csv':
+            amostra = arquivo.read(AMOSTRA_BYTES)
+            arquivo.seek(0)
+            self.encoding = detectar_encoding(amostra)
+            self.delimitador = detectar_delimitador(amostra.decode(self.encoding, errors='ignore'))
+            self._texto = io.TextIOWrapper(arquivo, encoding=self.encoding, newline='')
+            self._leitor = csv.reader(self._texto, delimiter=self.delimitador)
+            cabecalho = next(self._leitor, None)
+        elif self.extensao in ('.xlsx', '.xls'):
+            if not EXCEL_SUPPORT:
+                raise ValueError('Suporte a Excel não disponível. Use arquivos CSV.')
+            self._workbook = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+            self._leitor = self._workbook.active.iter_rows(values_only=True)
+            cabecalho = next(self._leitor, None)
+        else:
+            raise ValueError('Apenas arquivos CSV (.csv), Excel (.xlsx, .xls) são suportados')
+        if cabecalho is None:
+            self.fechar()
+            raise ValueError('Planilha vazia')
+        self.colunas = [str(coluna).strip() if coluna is not None else '' for coluna in cabecalho]
+
+    def __iter__(self):
+        numero = 1
+        for valores in self._leitor:
+            numero = self._leitor.line_num if self._texto is not None else numero + 1
+            if all(valor is None or str(valor).strip() == '' for valor in valores):
+                continue
+            if self.como_texto and self._workbook is not None:
+                valores = ['' if valor is None else str(valor) for valor in valores]
+            yield numero, dict(zip(self.colunas, valores))
+
+    def fechar(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+        if self._texto is not None:
+            # Devolve o arquivo ao chamador sem fechá-lo
+            self._texto.detach()
+            self._texto = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fechar()
+        return False
@@ -0,0 +1,10 @@
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def insert_dialeto(connection, tabela):
+    """Retorna o insert() do dialeto da conexão, que suporta ON CONFLICT (Postgres e SQLite)"""
+    if connection.dialect.name == 'postgresql':
+        return postgresql.insert(tabela)
+    if connection.dialect.name == 'sqlite':
+        return sqlite.insert(tabela)
+    raise NotImplementedError(f'Banco de dados não suportado: {connection.dialect.name}')
@@ -0,0 +1,28 @@
+import threading
+import time
+from src.models.user import db
+
+
+def iniciar_tarefa_periodica(app, nome, intervalo, funcao, atraso_inicial=60):
+    """Executa ``funcao`` a cada ``intervalo`` segundos numa thread daemon do worker.
+
+    Cada execução tem seu próprio app context e sessão; erros são registrados e a tarefa
+    continua na próxima rodada. O atraso inicial evita que scripts curtos que importam o
+    app (populate_db, manutencao) disparem a tarefa.
+    """
+    def executar():
+        time.sleep(atraso_inicial)
+        while True:
+            with app.app_context():
+                try:
+                    funcao()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f'[AVISO] Tarefa {nome} falhou: {e}')
+                finally:
+                    db.session.remove()
+            time.sleep(intervalo)
+
+    thread = threading.Thread(target=executar, name=nome, daemon=True)
+    thread.start()
+    return thread
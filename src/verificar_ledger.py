@@ -0,0 +1,212 @@
+import os
+import sys
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_right
+from datetime import datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import numpy as np
+from sqlalchemy import create_engine, case, func, select
+from src.models.produto import Produto, MovimentacaoEstoque, SnapshotEstoque, dia_sql
+
+# Verifica a consistência do ledger de estoque:
+#   - cadeia: quantidade_anterior de cada movimentação = quantidade_atual da anterior do produto
+#     (na primeira, 0 ou o estoque do snapshot no limite do período arquivado)
+#   - delta: quantidade_atual - quantidade_anterior coerente com tipo e quantidade
+#   - estoque: quantidade_atual da última movimentação = Produto.estoque
+# Os produtos são divididos em faixas de id processadas em paralelo; cada processo lê as
+# suas movimentações já ordenadas e faz as comparações vetorizadas com NumPy.
+#
+#   DATABASE_URL=... python src/verificar_ledger.py [--processos N] [--ordem dia|id|data] [--relatorio arquivo.csv]
+
+TIPO_ENTRADA = 1
+TIPO_SAIDA = 2
+CODIGO_TIPO = case(
+    (MovimentacaoEstoque.tipo == 'entrada', TIPO_ENTRADA),
+    (MovimentacaoEstoque.tipo == 'saida', TIPO_SAIDA),
+    else_=0
+)
+
+CABECALHO_RELATORIO = ['produto_id', 'movimentacao_id', 'problema', 'esperado', 'encontrado']
+
+_engines = {}
+
+def _engine(database_url):
+    # Um engine por processo do pool, reaproveitado entre as faixas
+    if database_url not in _engines:
+        _engines[database_url] = create_engine(database_url)
+    return _engines[database_url]
+
+def _faixas(database_url, quantidade):
+    """Divide o intervalo de ids de produtos em ``quantidade`` faixas [inicio, fim)"""
+    with _engine(database_url).connect() as connection:
+        minimo, maximo = connection.execute(select(func.min(Produto.id), func.max(Produto.id))).first()
+    if minimo is None:
+        return []
+    limites = np.unique(np.linspace(minimo, maximo + 1, quantidade + 1).astype(np.int64))
+    return list(zip(limites[:-1].tolist(), limites[1:].tolist()))
+
+def _estoques_no_limite(connection, produto_ids, datas):
+    """Estoque de cada produto no último snapshot até a data da sua primeira movimentação:
+    depois de um arquivamento a cadeia restante parte desse valor, não de 0"""
+    referencias = connection.execute(
+        select(SnapshotEstoque.data_referencia).distinct()
+        .where(SnapshotEstoque.data_referencia <= max(datas))
+        .order_by(SnapshotEstoque.data_referencia)
+    ).scalars().all()
+    por_referencia = {}
+    for produto_id, data in zip(produto_ids, datas):
+        posicao = bisect_right(referencias, data)
+        if posicao:
+            por_referencia.setdefault(referencias[posicao - 1], []).append(produto_id)
+    estoques = {}
+    for referencia, ids in por_referencia.items():
+        estoques.update(connection.execute(
+            select(SnapshotEstoque.produto_id, SnapshotEstoque.estoque)
+            .where(SnapshotEstoque.data_referencia == referencia, SnapshotEstoque.produto_id.in_(ids))
+        ).all())
+    return estoques
+
+def verificar_faixa(database_url, inicio, fim, ordem='dia'):
+    """Verifica os produtos com inicio <= id < fim. Retorna (movimentações lidas, problemas)."""
+    with _engine(database_url).connect() as connection:
+        ordenacao = [MovimentacaoEstoque.produto_id]
+        if ordem == 'dia':
+            # A mesma ordem em que importar_movimentacoes recalcula as cadeias
+            ordenacao.append(dia_sql(connection, MovimentacaoEstoque.data_movimentacao).nulls_first())
+        elif ordem == 'data':
+            ordenacao.append(MovimentacaoEstoque.data_movimentacao)
+        ordenacao.append(MovimentacaoEstoque.id)
+
+        movimentacoes = connection.execute(
+            select(
+                MovimentacaoEstoque.id, MovimentacaoEstoque.produto_id, CODIGO_TIPO,
+                MovimentacaoEstoque.quantidade, MovimentacaoEstoque.quantidade_anterior,
+                MovimentacaoEstoque.quantidade_atual, MovimentacaoEstoque.data_movimentacao
+            ).where(MovimentacaoEstoque.produto_id >= inicio, MovimentacaoEstoque.produto_id < fim)
+            .order_by(*ordenacao)
+        ).all()
+        produtos = connection.execute(
+            select(Produto.id, func.coalesce(Produto.estoque, 0))
+            .where(Produto.id >= inicio, Produto.id < fim)
+            .order_by(Produto.id)
+        ).all()
+
+        # Primeiras movimentações que não partem de 0: candidatas a início após arquivamento
+        inicios = {}
+        for posicao, row in enumerate(movimentacoes):
+            if (posicao == 0 or movimentacoes[posicao - 1][1] != row[1]) and row[4] and row[6] is not None:
+                inicios[row[1]] = row[6]
+        limite = _estoques_no_limite(connection, list(inicios), list(inicios.values())) if inicios else {}
+
+    problemas = []
+    produto_ids = np.array([row[0] for row in produtos], dtype=np.int64)
+    estoques = np.array([row[1] for row in produtos], dtype=np.int64)
+
+    if movimentacoes:
+        # Converter Row em tuple antes: o NumPy trata Row como sequência genérica (muito mais lento)
+        dados = np.array([tuple(row[:6]) for row in movimentacoes], dtype=np.int64)
+        ids, pid, tipo, quantidade, anterior, atual = dados.T
+        mesmo_produto = pid[1:] == pid[:-1]
+        primeira = np.concatenate(([True], ~mesmo_produto))
+        ultima = np.concatenate((~mesmo_produto, [True]))
+
+        # Cadeia: cada anterior continua do atual da movimentação anterior do mesmo produto; a
+        # primeira parte de 0 ou, se o início do histórico foi arquivado, do snapshot do limite
+        esperado_anterior = np.concatenate(([0], atual[:-1]))
+        esperado_anterior[primeira] = [limite.get(int(produto_id), 0) for produto_id in pid[primeira]]
+        for i in np.flatnonzero(anterior != esperado_anterior):
+            problema = 'inicio_cadeia' if primeira[i] else 'cadeia_quebrada'
+            problemas.append((int(pid[i]), int(ids[i]), problema, int(esperado_anterior[i]), int(anterior[i])))
+
+        # Delta coerente com tipo e quantidade (ajustes: apenas o valor absoluto)
+        delta = atual - anterior
+        esperado_delta = np.where(tipo == TIPO_SAIDA, -quantidade, quantidade)
+        encontrado_delta = np.where((tipo == TIPO_ENTRADA) | (tipo == TIPO_SAIDA), delta, np.abs(delta))
+        for i in np.flatnonzero(encontrado_delta != esperado_delta):
+            problemas.append((int(pid[i]), int(ids[i]), 'delta_incoerente', int(esperado_delta[i]), int(encontrado_delta[i])))
+
+        for i in np.flatnonzero(atual < 0):
+            problemas.append((int(pid[i]), int(ids[i]), 'estoque_negativo', 0, int(atual[i])))
+
+        # Última movimentação de cada produto x estoque atual
+        ultimos_pid = pid[ultima]
+        ultimos_atual = atual[ultima]
+        ultimos_ids = ids[ultima]
+        posicoes = np.searchsorted(produto_ids, ultimos_pid)
+        existe = (posicoes < len(produto_ids)) & (produto_ids[np.minimum(posicoes, len(produto_ids) - 1)] == ultimos_pid)
+        for i in np.flatnonzero(~existe):
+            problemas.append((int(ultimos_pid[i]), int(ultimos_ids[i]), 'produto_inexistente', 0, 0))
+        divergente = np.zeros(len(ultimos_pid), dtype=bool)
+        divergente[existe] = estoques[posicoes[existe]] != ultimos_atual[existe]
+        for i in np.flatnonzero(divergente):
+            problemas.append((int(ultimos_pid[i]), int(ultimos_ids[i]), 'estoque_divergente',
+                              int(ultimos_atual[i]), int(estoques[posicoes[i]])))
+        com_movimentacao = np.isin(produto_ids, ultimos_pid)
+    else:
+        com_movimentacao = np.zeros(len(produto_ids), dtype=bool)
+
+    # Produtos com estoque mas sem nenhuma movimentação registrada
+    for i in np.flatnonzero(~com_movimentacao & (estoques != 0)):
+        problemas.append((int(produto_ids[i]), None, 'sem_movimentacoes', 0, int(estoques[i])))
+
+    return len(movimentacoes), problemas
+
+def verificar_ledger(database_url, processos=None, ordem='dia', faixas_por_processo=4):
+    """Executa a verificação em paralelo. Retorna (movimentações lidas, problemas ordenados)."""
+    processos = processos or os.cpu_count() or 1
+    faixas = _faixas(database_url, processos * faixas_por_processo)
+    total = 0
+    problemas = []
+    with ProcessPoolExecutor(max_workers=processos) as pool:
+        futuros = [pool.submit(verificar_faixa, database_url, inicio, fim, ordem) for inicio, fim in faixas]
+        for futuro in futuros:
+            lidas, encontrados = futuro.result()
+            total += lidas
+            problemas.extend(encontrados)
+    problemas.sort(key=lambda problema: (problema[0], problema[1] or 0))
+    return total, problemas
+
+def main():
+    parser = argparse.ArgumentParser(description='Verifica a consistência do ledger de estoque')
+    parser.add_argument('--processos', type=int, default=None, help='Processos paralelos (padrão: núcleos da CPU)')
+    parser.add_argument('--ordem', choices=['dia', 'id', 'data'], default='dia',
+                        help='Ordem das movimentações de cada produto: dia (dia de data_movimentacao e id, a '
+                             'ordem das cadeias recalculadas na importação de histórico), id (ordem de gravação) '
+                             'ou data_movimentacao')
+    parser.add_argument('--relatorio', default=None, help='Arquivo CSV com as divergências')
+    args = parser.parse_args()
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        print('❌ Defina DATABASE_URL')
+        sys.exit(2)
+
+    inicio = time.perf_counter()
+    total, problemas = verificar_ledger(database_url, args.processos, args.ordem)
+    duracao = time.perf_counter() - inicio
+
+    relatorio = args.relatorio or os.path.join(
+        os.path.dirname(__file__), 'database', f'verificacao_ledger_{datetime.utcnow().strftime("%Y%m%d_%H%M%S")}.csv'
+    )
+    with open(relatorio, 'w', newline='', encoding='utf-8') as arquivo:
+        writer = csv.writer(arquivo)
+        writer.writerow(CABECALHO_RELATORIO)
+        writer.writerows(problemas)
+
+    por_tipo = {}
+    for problema in problemas:
+        por_tipo[problema[2]] = por_tipo.get(problema[2], 0) + 1
+    print(f'{total} movimentações verificadas em {duracao:.2f}s')
+    for nome, quantidade in sorted(por_tipo.items()):
+        print(f'  {nome}: {quantidade}')
+    print(f'Relatório: {relatorio}')
+    if problemas:
+        sys.exit(1)
+    print('✅ Nenhuma divergência encontrada')
+
+if __name__ == '__main__':
+    main()